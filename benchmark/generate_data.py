@@ -0,0 +1,302 @@
+"""Generate reproducible synthetic data for the benchmark suite.
+
+Files are written to a directory, one set per scale::
+
+    python generate_data.py --scale small --directory data
+
+The same scale and seed always produce the same records. The following
+files are created, prefixed by the scale:
+
+    .fa, .fa.fai       reference sequences
+    .fq                unaligned reads
+    .bam, .bam.bai     coordinate sorted alignments
+    .cram, .cram.crai  the same alignments in CRAM format
+    .vcf.gz, .tbi      variants with genotypes
+    .bcf, .bcf.csi     the same variants in BCF format
+    .bed.gz, .tbi      intervals
+"""
+
+import os
+import re
+import array
+import random
+import argparse
+
+import pysam
+import pysam.bcftools
+
+# number of records per scale
+SCALES = {
+    "small": dict(contigs=2,
+                  contig_length=200000,
+                  reads=20000,
+                  variants=2000,
+                  samples=10,
+                  intervals=20000),
+    "medium": dict(contigs=4,
+                   contig_length=1000000,
+                   reads=200000,
+                   variants=20000,
+                   samples=50,
+                   intervals=200000),
+    "large": dict(contigs=8,
+                  contig_length=5000000,
+                  reads=2000000,
+                  variants=200000,
+                  samples=100,
+                  intervals=2000000),
+}
+
+READ_LENGTH = 100
+
+
+def get_filenames(directory, scale):
+    '''return a dictionary with the filenames for *scale*.'''
+    prefix = os.path.join(directory, scale)
+    return dict(fasta=prefix + ".fa",
+                fastq=prefix + ".fq",
+                bam=prefix + ".bam",
+                cram=prefix + ".cram",
+                vcf=prefix + ".vcf.gz",
+                bcf=prefix + ".bcf",
+                bed=prefix + ".bed.gz")
+
+
+def get_contigs(scale):
+    '''return a list of (name, length) tuples for *scale*.'''
+    config = SCALES[scale]
+    return [("chr%i" % (x + 1), config["contig_length"])
+            for x in range(config["contigs"])]
+
+
+def random_sequence(rng, length):
+    return "".join(rng.choice("ACGT") for x in range(length))
+
+
+def write_fasta(filename, rng, contigs):
+    sequences = {}
+    with open(filename, "w") as outf:
+        for contig, length in contigs:
+            sequence = random_sequence(rng, length)
+            sequences[contig] = sequence
+            outf.write(">%s\n" % contig)
+            for x in range(0, length, 60):
+                outf.write(sequence[x:x + 60] + "\n")
+    pysam.faidx(filename)
+    return sequences
+
+
+def mutate(rng, sequence, rate=0.01):
+    '''introduce mismatches into *sequence*.'''
+    sequence = list(sequence)
+    for x in range(len(sequence)):
+        if rng.random() < rate:
+            sequence[x] = rng.choice("ACGT")
+    return "".join(sequence)
+
+
+def count_edits(sequence, reference, start, cigar):
+    '''return the edit distance (NM) of *sequence* aligned at *start*
+    of *reference*: mismatches plus inserted and deleted bases.'''
+    nm = 0
+    qpos, rpos = 0, start
+    for length, op in re.findall(r"(\d+)([MIDS])", cigar):
+        length = int(length)
+        if op == "M":
+            nm += sum(a != b for a, b in
+                      zip(sequence[qpos:qpos + length],
+                          reference[rpos:rpos + length]))
+            qpos += length
+            rpos += length
+        elif op == "I":
+            nm += length
+            qpos += length
+        elif op == "D":
+            nm += length
+            rpos += length
+        else:
+            qpos += length
+    return nm
+
+
+def simulate_reads(rng, sequences, contigs, nreads):
+    '''return a list of simulated alignments as tuples sorted by
+    position.'''
+    reads = []
+    for x in range(nreads):
+        tid = rng.randrange(len(contigs))
+        contig, length = contigs[tid]
+        start = rng.randrange(length - 2 * READ_LENGTH)
+        # a fraction of reads with soft clips, insertions and deletions
+        r = rng.random()
+        if r < 0.05:
+            cigar = "10S%iM" % (READ_LENGTH - 10)
+            sequence = random_sequence(rng, 10) + \
+                sequences[contig][start:start + READ_LENGTH - 10]
+        elif r < 0.08:
+            cigar = "50M2I%iM" % (READ_LENGTH - 52)
+            sequence = sequences[contig][start:start + 50] + \
+                random_sequence(rng, 2) + \
+                sequences[contig][start + 50:start + READ_LENGTH - 2]
+        elif r < 0.11:
+            cigar = "50M3D%iM" % (READ_LENGTH - 50)
+            sequence = sequences[contig][start:start + 50] + \
+                sequences[contig][start + 53:start + READ_LENGTH + 3]
+        else:
+            cigar = "%iM" % READ_LENGTH
+            sequence = sequences[contig][start:start + READ_LENGTH]
+        sequence = mutate(rng, sequence)
+        qualities = "".join(chr(33 + rng.randint(2, 40))
+                            for y in range(READ_LENGTH))
+        reads.append((tid, start, "read%i" % x, cigar, sequence,
+                      qualities, rng.randint(0, 60), rng.random() < 0.5,
+                      count_edits(sequence, sequences[contig], start,
+                                  cigar)))
+    reads.sort()
+    return reads
+
+
+def write_alignments(filename, mode, reads, contigs, reference=None):
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": contig, "LN": length}
+                     for contig, length in contigs],
+              "RG": [{"ID": "sample1", "SM": "sample1"}]}
+    if reference:
+        outf = pysam.AlignmentFile(filename, mode, header=header,
+                                   reference_filename=reference)
+    else:
+        outf = pysam.AlignmentFile(filename, mode, header=header)
+    for tid, start, name, cigar, sequence, qualities, mapq, reverse, nm \
+            in reads:
+        read = pysam.AlignedSegment()
+        read.query_name = name
+        read.flag = 16 if reverse else 0
+        read.reference_id = tid
+        read.reference_start = start
+        read.mapping_quality = mapq
+        read.cigarstring = cigar
+        read.query_sequence = sequence
+        read.query_qualities = array.array(
+            "B", [ord(x) - 33 for x in qualities])
+        read.set_tags([("RG", "sample1", "Z"),
+                       ("NM", nm, "i"),
+                       ("AS", READ_LENGTH - mapq // 10, "i"),
+                       ("XS", mapq // 2, "i")])
+        outf.write(read)
+    outf.close()
+    pysam.index(filename)
+
+
+def write_fastq(filename, reads):
+    with open(filename, "w") as outf:
+        for tid, start, name, cigar, sequence, qualities, mapq, reverse, \
+                nm in sorted(reads, key=lambda x: x[2]):
+            outf.write("@%s\n%s\n+\n%s\n" % (name, sequence, qualities))
+
+
+def write_variants(filename_vcf, filename_bcf, rng, sequences, contigs,
+                   nvariants, nsamples):
+    samples = ["sample%i" % x for x in range(nsamples)]
+    lines = ["##fileformat=VCFv4.2"]
+    lines.extend("##contig=<ID=%s,length=%i>" % x for x in contigs)
+    lines.extend([
+        '##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth">',
+        '##INFO=<ID=AF,Number=A,Type=Float,Description="Frequency">',
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+        '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Depth">',
+        '##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Quality">',
+        "\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL",
+                   "FILTER", "INFO", "FORMAT"] + samples)])
+
+    positions = set()
+    for x in range(nvariants):
+        tid = rng.randrange(len(contigs))
+        positions.add((tid, rng.randrange(1, contigs[tid][1])))
+    positions = sorted(positions)
+    genotypes = ("0/0", "0/1", "1/1", "./.")
+    for tid, pos in positions:
+        contig = contigs[tid][0]
+        ref = sequences[contig][pos - 1]
+        alt = rng.choice([x for x in "ACGT" if x != ref])
+        fields = [contig, str(pos), ".", ref, alt,
+                  str(rng.randint(10, 100)), "PASS",
+                  "DP=%i;AF=%.3f" % (rng.randint(10, 500), rng.random()),
+                  "GT:DP:GQ"]
+        fields.extend("%s:%i:%i" % (rng.choice(genotypes),
+                                    rng.randint(0, 50),
+                                    rng.randint(0, 99))
+                      for x in samples)
+        lines.append("\t".join(fields))
+
+    filename = filename_vcf[:-len(".gz")]
+    with open(filename, "w") as outf:
+        outf.write("\n".join(lines) + "\n")
+    pysam.tabix_index(filename, preset="vcf", force=True)
+
+    inf = pysam.VariantFile(filename_vcf)
+    outf = pysam.VariantFile(filename_bcf, "wb", header=inf.header)
+    for record in inf:
+        outf.write(record)
+    outf.close()
+    inf.close()
+    pysam.bcftools.index(filename_bcf)
+
+
+def write_intervals(filename, rng, contigs, nintervals):
+    intervals = []
+    for x in range(nintervals):
+        contig, length = rng.choice(contigs)
+        start = rng.randrange(length - 1000)
+        intervals.append((contig, start, start + rng.randint(1, 1000),
+                          "interval%i" % x, rng.randint(0, 1000),
+                          rng.choice("+-")))
+    intervals.sort()
+    filename = filename[:-len(".gz")]
+    with open(filename, "w") as outf:
+        for interval in intervals:
+            outf.write("%s\t%i\t%i\t%s\t%i\t%s\n" % interval)
+    pysam.tabix_index(filename, preset="bed", force=True)
+
+
+def generate(directory, scale, seed=1):
+    '''generate all files for *scale* in *directory*.
+
+    Returns a dictionary of filenames, see :func:`get_filenames`.
+    '''
+    if scale not in SCALES:
+        raise ValueError("unknown scale '%s', choose from %s" %
+                         (scale, ", ".join(sorted(SCALES))))
+    config = SCALES[scale]
+    filenames = get_filenames(directory, scale)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    rng = random.Random(seed * 1000 + sorted(SCALES).index(scale))
+    contigs = get_contigs(scale)
+    sequences = write_fasta(filenames["fasta"], rng, contigs)
+    reads = simulate_reads(rng, sequences, contigs, config["reads"])
+    write_fastq(filenames["fastq"], reads)
+    write_alignments(filenames["bam"], "wb", reads, contigs)
+    write_alignments(filenames["cram"], "wc", reads, contigs,
+                     reference=filenames["fasta"])
+    write_variants(filenames["vcf"], filenames["bcf"], rng, sequences,
+                   contigs, config["variants"], config["samples"])
+    write_intervals(filenames["bed"], rng, contigs, config["intervals"])
+    return filenames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=sorted(SCALES),
+                        action="append", dest="scales",
+                        help="scale of the data, can be given several "
+                        "times [small]")
+    parser.add_argument("--directory", default="data")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    for scale in sorted(set(args.scales or ["small"])):
+        generate(args.directory, scale, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+"""Run the benchmark suite on synthetic data and save the results.
+
+Data is created by :mod:`generate_data` if it does not exist::
+
+    python run_benchmarks.py --scale small --output results.json
+
+Each benchmark runs in a separate process, so that its peak memory
+can be measured. For every benchmark the best and median time of
+several repeats, the throughput in records and megabytes per second
+and the peak resident memory are recorded. Benchmarks consisting of
+many small queries also record the median and 95th percentile
+latency per query.
+
+Results are saved as JSON. Results of an earlier run, for example of
+a previous release, can be compared with::
+
+    python run_benchmarks.py --compare previous.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import resource
+import multiprocessing
+
+import pysam
+
+import generate_data
+
+# number of random queries per benchmark
+NQUERIES = 1000
+
+# size of queried regions
+REGION_SIZE = 1000
+
+BENCHMARKS = []
+
+
+def benchmark(name, filetype, queries=False):
+    '''register a benchmark.
+
+    The benchmark is called with the filenames of the data, a random
+    number generator and the scale. It returns the number of records
+    processed. Benchmarks of *queries* return a list of the number of
+    records per query and a list of the time taken by each query.
+    '''
+    def wrap(func):
+        BENCHMARKS.append((name, filetype, queries, func))
+        return func
+    return wrap
+
+
+def random_regions(rng, scale, n=NQUERIES, size=REGION_SIZE):
+    contigs = generate_data.get_contigs(scale)
+    regions = []
+    for x in range(n):
+        contig, length = rng.choice(contigs)
+        start = rng.randrange(length - size)
+        regions.append((contig, start, start + size))
+    return regions
+
+
+def time_queries(func, regions):
+    counts, latencies = [], []
+    for region in regions:
+        t = time.time()
+        counts.append(func(*region))
+        latencies.append(time.time() - t)
+    return counts, latencies
+
+
+@benchmark("bam_iterate", "bam")
+def bam_iterate(filenames, rng, scale):
+    with pysam.AlignmentFile(filenames["bam"]) as inf:
+        return sum(1 for read in inf.fetch(until_eof=True))
+
+
+@benchmark("cram_iterate", "cram")
+def cram_iterate(filenames, rng, scale):
+    with pysam.AlignmentFile(
+            filenames["cram"],
+            reference_filename=filenames["fasta"]) as inf:
+        return sum(1 for read in inf.fetch(until_eof=True))
+
+
+@benchmark("bam_fetch", "bam", queries=True)
+def bam_fetch(filenames, rng, scale):
+    with pysam.AlignmentFile(filenames["bam"]) as inf:
+        return time_queries(
+            lambda contig, start, end:
+            sum(1 for read in inf.fetch(contig, start, end)),
+            random_regions(rng, scale))
+
+
+@benchmark("cram_fetch", "cram", queries=True)
+def cram_fetch(filenames, rng, scale):
+    with pysam.AlignmentFile(
+            filenames["cram"],
+            reference_filename=filenames["fasta"]) as inf:
+        return time_queries(
+            lambda contig, start, end:
+            sum(1 for read in inf.fetch(contig, start, end)),
+            random_regions(rng, scale, n=NQUERIES // 10))
+
+
+@benchmark("bam_pileup", "bam")
+def bam_pileup(filenames, rng, scale):
+    n = 0
+    with pysam.AlignmentFile(filenames["bam"]) as inf:
+        for contig, length in generate_data.get_contigs(scale):
+            for column in inf.pileup(contig):
+                n += column.n
+    return n
+
+
+@benchmark("bam_count_coverage", "bam", queries=True)
+def bam_count_coverage(filenames, rng, scale):
+    with pysam.AlignmentFile(filenames["bam"]) as inf:
+        return time_queries(
+            lambda contig, start, end:
+            sum(sum(x) for x in inf.count_coverage(contig, start, end)),
+            random_regions(rng, scale, n=NQUERIES // 10))
+
+
+@benchmark("bam_tag_access", "bam")
+def bam_tag_access(filenames, rng, scale):
+    n = 0
+    with pysam.AlignmentFile(filenames["bam"]) as inf:
+        for read in inf.fetch(until_eof=True):
+            read.get_tag("NM")
+            read.get_tag("RG")
+            read.has_tag("XX")
+            read.get_tags()
+            n += 1
+    return n
+
+
+@benchmark("vcf_iterate", "vcf")
+def vcf_iterate(filenames, rng, scale):
+    return variant_iterate(filenames["vcf"])
+
+
+@benchmark("bcf_iterate", "bcf")
+def bcf_iterate(filenames, rng, scale):
+    return variant_iterate(filenames["bcf"])
+
+
+def variant_iterate(filename):
+    n = 0
+    with pysam.VariantFile(filename) as inf:
+        for record in inf:
+            record.info["DP"]
+            for sample in record.samples.values():
+                sample["GT"]
+            n += 1
+    return n
+
+
+@benchmark("vcf_fetch", "vcf", queries=True)
+def vcf_fetch(filenames, rng, scale):
+    return variant_fetch(filenames["vcf"], rng, scale)
+
+
+@benchmark("bcf_fetch", "bcf", queries=True)
+def bcf_fetch(filenames, rng, scale):
+    return variant_fetch(filenames["bcf"], rng, scale)
+
+
+def variant_fetch(filename, rng, scale):
+    with pysam.VariantFile(filename) as inf:
+        return time_queries(
+            lambda contig, start, end:
+            sum(1 for record in inf.fetch(contig, start, end)),
+            random_regions(rng, scale, size=REGION_SIZE * 10))
+
+
+@benchmark("fasta_fetch", "fasta", queries=True)
+def fasta_fetch(filenames, rng, scale):
+    with pysam.FastaFile(filenames["fasta"]) as inf:
+        return time_queries(
+            lambda contig, start, end:
+            len(inf.fetch(contig, start, end)),
+            random_regions(rng, scale))
+
+
+@benchmark("fastq_iterate", "fastq")
+def fastq_iterate(filenames, rng, scale):
+    with pysam.FastxFile(filenames["fastq"]) as inf:
+        return sum(1 for record in inf)
+
+
+@benchmark("tabix_iterate", "bed")
+def tabix_iterate(filenames, rng, scale):
+    with pysam.TabixFile(filenames["bed"]) as inf:
+        return sum(1 for row in inf.fetch(parser=pysam.asBed()))
+
+
+@benchmark("tabix_fetch", "bed", queries=True)
+def tabix_fetch(filenames, rng, scale):
+    with pysam.TabixFile(filenames["bed"]) as inf:
+        return time_queries(
+            lambda contig, start, end:
+            sum(1 for row in inf.fetch(contig, start, end,
+                                       parser=pysam.asBed())),
+            random_regions(rng, scale))
+
+
+def get_peak_memory():
+    '''return the peak resident memory of this process in bytes.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    if sys.platform != "darwin":
+        peak *= 1024
+    return peak
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_one(name, filenames, scale, seed):
+    '''run benchmark *name* once and return its time, the number of
+    records, latencies for query benchmarks and peak memory.'''
+    for benchmark_name, filetype, queries, func in BENCHMARKS:
+        if benchmark_name == name:
+            break
+    else:
+        raise ValueError("unknown benchmark %s" % name)
+
+    rng = random.Random(seed)
+    start = time.time()
+    result = func(filenames, rng, scale)
+    seconds = time.time() - start
+    if queries:
+        counts, latencies = result
+        return seconds, sum(counts), latencies, get_peak_memory()
+    return seconds, result, None, get_peak_memory()
+
+
+def run(name, filetype, filenames, scale, repeats, seed):
+    '''run benchmark *name* *repeats* times, each in a new process.'''
+    times, peaks, latencies = [], [], []
+    for repeat in range(repeats):
+        pool = multiprocessing.Pool(1)
+        try:
+            seconds, records, query_latencies, peak = pool.apply(
+                run_one, (name, filenames, scale, seed))
+        finally:
+            pool.close()
+            pool.join()
+        times.append(seconds)
+        peaks.append(peak)
+        if query_latencies:
+            latencies.extend(query_latencies)
+
+    best = min(times)
+    nbytes = os.path.getsize(filenames[filetype])
+    result = {
+        "records": records,
+        "repeats": repeats,
+        "seconds_best": best,
+        "seconds_median": percentile(times, 0.5),
+        "records_per_second": records / best if best > 0 else None,
+        "peak_memory_bytes": max(peaks),
+    }
+    if latencies:
+        result["queries"] = len(latencies) // repeats
+        result["latency_median"] = percentile(latencies, 0.5)
+        result["latency_p95"] = percentile(latencies, 0.95)
+    else:
+        # throughput on the file as stored
+        result["megabytes_per_second"] = \
+            nbytes / 1e6 / best if best > 0 else None
+    return result
+
+
+def compare(results, previous, threshold):
+    '''print the change in time relative to *previous* results and
+    return the number of benchmarks slower by more than *threshold*.'''
+    nslower = 0
+    print("%-20s %10s %10s %8s" % ("benchmark", "previous", "current",
+                                   "ratio"))
+    for name, result in sorted(results["benchmarks"].items()):
+        if name not in previous["benchmarks"]:
+            continue
+        old = previous["benchmarks"][name]["seconds_best"]
+        new = result["seconds_best"]
+        ratio = new / old if old > 0 else float("inf")
+        flag = ""
+        if ratio > 1.0 + threshold:
+            flag = "slower"
+            nslower += 1
+        print("%-20s %10.4f %10.4f %8.2f %s" % (name, old, new, ratio, flag))
+    return nslower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", default="small",
+                        choices=sorted(generate_data.SCALES))
+    parser.add_argument("--directory", default="data",
+                        help="directory with synthetic data [%(default)s]")
+    parser.add_argument("--output", default=None,
+                        help="JSON file to save results in "
+                        "[results_<scale>.json]")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--benchmark", action="append", dest="benchmarks",
+                        help="benchmark to run, can be given several "
+                        "times [all]")
+    parser.add_argument("--compare", default=None,
+                        help="JSON file with results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="report benchmarks slower than this "
+                        "fraction [%(default)s]")
+    args = parser.parse_args()
+
+    filenames = generate_data.get_filenames(args.directory, args.scale)
+    if not all(os.path.exists(x) for x in filenames.values()):
+        print("# generating %s data in %s" % (args.scale, args.directory))
+        filenames = generate_data.generate(args.directory, args.scale,
+                                           args.seed)
+
+    results = {
+        "pysam_version": pysam.__version__,
+        "samtools_version": pysam.__samtools_version__,
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": args.scale,
+        "seed": args.seed,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "benchmarks": {},
+    }
+
+    for name, filetype, queries, func in BENCHMARKS:
+        if args.benchmarks and name not in args.benchmarks:
+            continue
+        result = run(name, filetype, filenames, args.scale,
+                     args.repeats, args.seed)
+        results["benchmarks"][name] = result
+        print("%-20s %10.4f s %12.0f records/s %8.1f MB peak" %
+              (name, result["seconds_best"],
+               result["records_per_second"] or 0,
+               result["peak_memory_bytes"] / 1e6))
+
+    output = args.output or "results_%s.json" % args.scale
+    with open(output, "w") as outf:
+        json.dump(results, outf, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as inf:
+            previous = json.load(inf)
+        if compare(results, previous, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -53,6 +53,16 @@ def test_iterator_file_uncompressed():
     f = open("windows_small.bed")
     l = len( list( pysam.tabix_file_iterator( f, parser = pysam.asBed() )))
 
+def test_iterator_batch_compressed():
+    f = open(fn_compressed, "rb")
+    l = sum(len(x) for x in
+            pysam.tabix_batch_iterator(f, parser=pysam.asBed()))
+
+def test_iterator_batch_uncompressed():
+    f = open("windows_small.bed")
+    l = sum(len(x) for x in
+            pysam.tabix_batch_iterator(f, parser=pysam.asBed()))
+
 tests = ( test_python_compressed, 
           test_python_uncompressed, 
           test_fetch_plain, 
@@ -62,7 +72,9 @@ tests = ( test_python_compressed,
           test_iterator_parsed_compressed,
           test_iterator_parsed_uncompressed,
           test_iterator_file_compressed,
-          test_iterator_file_uncompressed )
+          test_iterator_file_uncompressed,
+          test_iterator_batch_compressed,
+          test_iterator_batch_uncompressed )
 
 for repeat in range( repeats ):
     print ("# repeat=", repeat)
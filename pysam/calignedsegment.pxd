@@ -8,6 +8,12 @@ cdef extern from "htslib_util.h":
                               size_t nbytes_new,
                               uint8_t * pos)
 
+    # resize the variable length data of *b* to *size* bytes
+    uint8_t * pysam_bam_resize(bam1_t * b, size_t size)
+
+    # 64-bit hash of *len* bytes at *data*
+    uint64_t pysam_hash64(const void * data, size_t len, uint64_t seed)
+
     # now: static
     int aux_type2size(int)
 
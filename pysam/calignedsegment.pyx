@@ -57,15 +57,21 @@ import re
 import array
 import ctypes
 import struct
+import collections
 
 cimport cython
 from cpython cimport array as c_array
 from cpython.version cimport PY_MAJOR_VERSION
 from cpython cimport PyErr_SetString, PyBytes_FromStringAndSize
-from libc.string cimport strchr
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, \
+    PyBUF_SIMPLE, PyBUF_FORMAT, PyBUF_C_CONTIGUOUS
+from libc.string cimport strchr, memset
+from libc.math cimport NAN
+from libc.stdio cimport sprintf
 
+from pysam.cfaidx cimport FastaFile
 from pysam.cutils cimport force_bytes, force_str, \
-    charptr_to_str, charptr_to_bytes
+    charptr_to_str, charptr_to_str_w_len, charptr_to_bytes
 from pysam.cutils cimport qualities_to_qualitystring, qualitystring_to_array, \
     array_to_qualitystring
 
@@ -85,6 +91,26 @@ else:
 
 CIGAR_REGEX = re.compile("(\d+)([MIDNSHP=X])")
 
+# statistics computed from a cigar alignment, see
+# AlignedSegment.cigar_stats
+CigarStats = collections.namedtuple(
+    "CigarStats",
+    ("query_length",
+     "query_alignment_length",
+     "aligned_length",
+     "reference_length",
+     "soft_clip_start",
+     "soft_clip_end",
+     "hard_clip_start",
+     "hard_clip_end",
+     "insertions",
+     "inserted_bases",
+     "deletions",
+     "deleted_bases",
+     "skipped_bases"))
+
+DEF NCIGAR_STATS = 13
+
 #####################################################################
 # typecode guessing
 cdef inline char map_typecode_htslib_to_python(uint8_t s):
@@ -317,6 +343,202 @@ cdef inline packTags(tags):
     return "".join(fmts), args
 
 
+cdef inline void encodeSequence(uint8_t * p, char * s, Py_ssize_t l):
+    """encode *l* bases in *s* into 4-bit codes at *p*, two bases
+    per byte."""
+    cdef Py_ssize_t k
+    for k from 0 <= k < l // 2:
+        p[k] = seq_nt16_table[<unsigned char>s[2 * k]] << 4 | \
+            seq_nt16_table[<unsigned char>s[2 * k + 1]]
+    if l % 2:
+        p[l // 2] = seq_nt16_table[<unsigned char>s[l - 1]] << 4
+
+
+cdef inline int getQualitiesBuffer(object qual, Py_buffer * view) except -1:
+    """get a buffer of unsigned chars for the quality scores in *qual*.
+
+    Contiguous objects supporting the buffer protocol with an item
+    size of one, such as ``array('B')`` or bytes, are used without
+    copying. Other sequences and buffers are converted into an
+    ``array('B')``. The buffer needs to be released with
+    PyBuffer_Release.
+    """
+    try:
+        PyObject_GetBuffer(qual, view, PyBUF_SIMPLE)
+    except (TypeError, BufferError):
+        pass
+    else:
+        if view.itemsize == 1:
+            return 0
+        PyBuffer_Release(view)
+    PyObject_GetBuffer(c_array.array('B', qual), view, PyBUF_SIMPLE)
+    return 0
+
+
+cdef inline bint isUInt32Buffer(Py_buffer * view):
+    """return True if *view* contains native unsigned 32-bit
+    integers."""
+    cdef const char * fmt = view.format
+    if view.itemsize != 4 or fmt == NULL:
+        return False
+    if fmt[0] == '@' or fmt[0] == '=':
+        fmt += 1
+    return (fmt[0] == 'I' or fmt[0] == 'L') and fmt[1] == 0
+
+
+cdef inline int getCigarBuffer(object cigar, Py_buffer * view) except -1:
+    """get a buffer of uint32 values for the encoded cigar operations
+    in *cigar*.
+
+    Contiguous buffers of unsigned 32-bit integers, such as
+    ``array('I')``, are used without copying. Other sequences and
+    buffers are converted into an ``array('I')``, which fails for
+    values that are not unsigned integers. The buffer needs to be
+    released with PyBuffer_Release.
+    """
+    try:
+        PyObject_GetBuffer(cigar, view, PyBUF_FORMAT | PyBUF_C_CONTIGUOUS)
+    except (TypeError, BufferError):
+        pass
+    else:
+        if isUInt32Buffer(view):
+            return 0
+        PyBuffer_Release(view)
+    PyObject_GetBuffer(c_array.array('I', cigar), view, PyBUF_SIMPLE)
+    return 0
+
+
+cdef inline uint8_t * skipAuxValue(uint8_t * s):
+    """return pointer to the tag following the value at *s*.
+
+    *s* points to the type code of the value. Returns NULL if the
+    type is unknown.
+    """
+    cdef uint8_t auxtype = s[0]
+    cdef int32_t nvalues
+    s += 1
+    if auxtype == 'A' or auxtype == 'c' or auxtype == 'C':
+        return s + 1
+    elif auxtype == 's' or auxtype == 'S':
+        return s + 2
+    elif auxtype == 'i' or auxtype == 'I' or auxtype == 'f':
+        return s + 4
+    elif auxtype == 'd':
+        return s + 8
+    elif auxtype == 'Z' or auxtype == 'H':
+        return s + strlen(<char*>s) + 1
+    elif auxtype == 'B':
+        memcpy(&nvalues, s + 1, sizeof(int32_t))
+        return s + 5 + nvalues * aux_type2size(s[0])
+    return NULL
+
+
+cdef int findAuxTags(bam1_t * src,
+                     char * keys,
+                     int nkeys,
+                     uint8_t ** found):
+    """find several tags in a single pass over the optional fields.
+
+    *keys* contains *nkeys* tags of two characters each. A pointer
+    to the type code of each tag is stored in *found*, or NULL if
+    the tag is not present. The scan stops once all tags have been
+    found.
+
+    Returns the number of tags found or -1 if the optional
+    fields are corrupt.
+    """
+    cdef int k, nfound = 0
+    for k from 0 <= k < nkeys:
+        found[k] = NULL
+    if src.l_data == 0:
+        return 0
+
+    cdef uint8_t * s = pysam_bam_get_aux(src)
+    cdef uint8_t * end = src.data + src.l_data
+    while s + 3 <= end and nfound < nkeys:
+        for k from 0 <= k < nkeys:
+            if found[k] == NULL and \
+               keys[2 * k] == s[0] and keys[2 * k + 1] == s[1]:
+                found[k] = s + 2
+                nfound += 1
+        s = skipAuxValue(s + 2)
+        if s == NULL or s > end:
+            return -1
+    return nfound
+
+
+cdef object convertAuxValue(uint8_t * v):
+    """return the value of a tag as a python object.
+
+    *v* points to the type code of the value.
+    """
+    cdef uint8_t auxtype = v[0]
+    if auxtype == 'c' or auxtype == 'C' or auxtype == 's' or auxtype == 'S':
+        return <int>bam_aux2i(v)
+    elif auxtype == 'i' or auxtype == 'I':
+        return <int32_t>bam_aux2i(v)
+    elif auxtype == 'f' or auxtype == 'F':
+        return <float>bam_aux2f(v)
+    elif auxtype == 'd' or auxtype == 'D':
+        return <double>bam_aux2f(v)
+    elif auxtype == 'A':
+        return '%c' % <char>bam_aux2A(v)
+    elif auxtype == 'Z' or auxtype == 'H':
+        return charptr_to_str(<char*>bam_aux2Z(v))
+    elif auxtype == 'B':
+        bytesize, nvalues, values = convert_binary_tag(v + 1)
+        return values
+    raise ValueError("unknown auxiliary type '%s'" % chr(auxtype))
+
+
+cdef inline void computeCigarStats(bam1_t * src, int64_t * stats):
+    """compute the statistics in CigarStats in a single pass over
+    the cigar alignment of *src* and store them in *stats*."""
+    cdef uint32_t * cigar_p = pysam_bam_get_cigar(src)
+    cdef uint32_t n_cigar = pysam_get_n_cigar(src)
+    cdef uint32_t k, l
+    cdef int op
+    # clipping before any other operation is at the start
+    cdef bint at_start = True
+
+    memset(stats, 0, NCIGAR_STATS * sizeof(int64_t))
+    for k from 0 <= k < n_cigar:
+        op = cigar_p[k] & BAM_CIGAR_MASK
+        l = cigar_p[k] >> BAM_CIGAR_SHIFT
+        if op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF:
+            stats[0] += l
+            stats[1] += l
+            stats[2] += l
+            stats[3] += l
+            at_start = False
+        elif op == BAM_CINS:
+            stats[0] += l
+            stats[1] += l
+            stats[8] += 1
+            stats[9] += l
+            at_start = False
+        elif op == BAM_CDEL:
+            stats[3] += l
+            stats[10] += 1
+            stats[11] += l
+            at_start = False
+        elif op == BAM_CREF_SKIP:
+            stats[3] += l
+            stats[12] += l
+            at_start = False
+        elif op == BAM_CSOFT_CLIP:
+            stats[0] += l
+            if at_start:
+                stats[4] += l
+            else:
+                stats[5] += l
+        elif op == BAM_CHARD_CLIP:
+            if at_start:
+                stats[6] += l
+            else:
+                stats[7] += l
+
+
 cdef inline int32_t calculateQueryLength(bam1_t * src):
     """return query length computed from CIGAR alignment.
 
@@ -391,6 +613,14 @@ cdef inline int32_t getQueryEnd(bam1_t *src) except -1:
     return end_offset
 
 
+# table to decode the two bases in a byte of 4-bit codes at once
+cdef char nt16_pair_table[512]
+cdef int _code
+for _code from 0 <= _code < 256:
+    nt16_pair_table[2 * _code] = seq_nt16_str[_code >> 4]
+    nt16_pair_table[2 * _code + 1] = seq_nt16_str[_code & 0xf]
+
+
 cdef inline bytes getSequenceInRange(bam1_t *src,
                                      uint32_t start,
                                      uint32_t end):
@@ -408,12 +638,20 @@ cdef inline bytes getSequenceInRange(bam1_t *src,
     s   = <char*>seq
     p   = pysam_bam_get_seq(src)
 
-    for k from start <= k < end:
-        # equivalent to seq_nt16_str[bam1_seqi(s, i)] (see bam.c)
-        # note: do not use string literal as it will be a python string
-        s[k-start] = seq_nt16_str[p[k/2] >> 4 * (1 - k%2) & 0xf]
+    # equivalent to seq_nt16_str[bam1_seqi(s, i)] (see bam.c)
+    # note: do not use string literal as it will be a python string
+    k = start
+    if k < end and k % 2:
+        s[0] = seq_nt16_str[p[k / 2] & 0xf]
+        k += 1
+    # decode two bases per byte
+    while k + 1 < end:
+        memcpy(s + k - start, &nt16_pair_table[2 * p[k / 2]], 2)
+        k += 2
+    if k < end:
+        s[k - start] = seq_nt16_str[p[k / 2] >> 4]
 
-    return charptr_to_bytes(seq)
+    return seq
 
 
 cdef inline object getQualitiesInRange(bam1_t *src,
@@ -447,6 +685,8 @@ cdef makeAlignedSegment(bam1_t * src, AlignmentFile alignment_file):
     cdef AlignedSegment dest = AlignedSegment.__new__(AlignedSegment)
     dest._delegate = bam_dup1(src)
     dest._alignment_file = alignment_file
+    if alignment_file is not None and alignment_file.io_stats is not None:
+        alignment_file.io_stats.wrappers += 1
     return dest
 
 
@@ -624,6 +864,769 @@ cdef inline bytes build_alignment_sequence(bam1_t * src):
     return seq
 
 
+cdef getReferencePositionsArray(bam1_t * src, bint full_length):
+    """return reference positions of a bam1_t object as an
+    array of int32, with -1 for unaligned query positions.
+    """
+    cdef uint32_t * cigar_p = pysam_bam_get_cigar(src)
+    cdef uint32_t n_cigar = pysam_get_n_cigar(src)
+    cdef uint32_t k, i, l, n
+    cdef int32_t pos = src.core.pos
+    cdef int op
+
+    # count entries first so that the array is allocated once
+    n = 0
+    for k from 0 <= k < n_cigar:
+        op = cigar_p[k] & BAM_CIGAR_MASK
+        l = cigar_p[k] >> BAM_CIGAR_SHIFT
+        if op == BAM_CMATCH or \
+           (full_length and (op == BAM_CSOFT_CLIP or op == BAM_CINS)):
+            n += l
+
+    cdef c_array.array result = array.array('i', [])
+    c_array.resize(result, n)
+    cdef int32_t * p = <int32_t*>result.data.as_ints
+
+    n = 0
+    for k from 0 <= k < n_cigar:
+        op = cigar_p[k] & BAM_CIGAR_MASK
+        l = cigar_p[k] >> BAM_CIGAR_SHIFT
+
+        if op == BAM_CSOFT_CLIP or op == BAM_CINS:
+            if full_length:
+                for i from 0 <= i < l:
+                    p[n] = -1
+                    n += 1
+        elif op == BAM_CMATCH:
+            for i from 0 <= i < l:
+                p[n] = pos + i
+                n += 1
+            pos += l
+        elif op == BAM_CDEL or op == BAM_CREF_SKIP:
+            pos += l
+
+    return result
+
+
+cdef getAlignedPairsArrays(bam1_t * src,
+                           bint matches_only,
+                           bytes ref_seq):
+    """return aligned query and reference positions of a bam1_t
+    object as two arrays of int32, with -1 for gaps.
+
+    If *ref_seq* is given, a third array with the reference base
+    at each position is returned (0 for positions without a
+    reference base).
+    """
+    cdef uint32_t * cigar_p = pysam_bam_get_cigar(src)
+    cdef uint32_t n_cigar = pysam_get_n_cigar(src)
+    cdef uint32_t k, i, l, n, r_idx
+    cdef int32_t pos = src.core.pos
+    cdef int32_t qpos = 0
+    cdef int op
+    cdef bint with_seq = ref_seq is not None
+    cdef char * ref_p = NULL
+
+    # count entries first so that the arrays are allocated once
+    n = 0
+    for k from 0 <= k < n_cigar:
+        op = cigar_p[k] & BAM_CIGAR_MASK
+        l = cigar_p[k] >> BAM_CIGAR_SHIFT
+        if op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF:
+            n += l
+        elif not matches_only and \
+                (op == BAM_CINS or op == BAM_CSOFT_CLIP or
+                 op == BAM_CDEL or op == BAM_CREF_SKIP):
+            n += l
+        elif op == BAM_CPAD:
+            raise NotImplementedError(
+                "Padding (BAM_CPAD, 6) is currently not supported. "
+                "Please implement. Sorry about that.")
+
+    cdef c_array.array qpositions = array.array('i', [])
+    cdef c_array.array rpositions = array.array('i', [])
+    cdef c_array.array bases = array.array('B', [])
+    c_array.resize(qpositions, n)
+    c_array.resize(rpositions, n)
+    cdef int32_t * qp = <int32_t*>qpositions.data.as_ints
+    cdef int32_t * rp = <int32_t*>rpositions.data.as_ints
+    cdef uint8_t * bp = NULL
+    if with_seq:
+        c_array.resize(bases, n)
+        bp = <uint8_t*>bases.data.as_uchars
+        ref_p = ref_seq
+
+    n = 0
+    r_idx = 0
+    for k from 0 <= k < n_cigar:
+        op = cigar_p[k] & BAM_CIGAR_MASK
+        l = cigar_p[k] >> BAM_CIGAR_SHIFT
+
+        if op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF:
+            for i from 0 <= i < l:
+                qp[n] = qpos
+                rp[n] = pos + i
+                if with_seq:
+                    bp[n] = ref_p[r_idx]
+                    r_idx += 1
+                qpos += 1
+                n += 1
+            pos += l
+
+        elif op == BAM_CINS or op == BAM_CSOFT_CLIP:
+            if not matches_only:
+                for i from 0 <= i < l:
+                    qp[n] = qpos
+                    rp[n] = -1
+                    if with_seq:
+                        bp[n] = 0
+                    qpos += 1
+                    n += 1
+            else:
+                qpos += l
+
+        elif op == BAM_CDEL or op == BAM_CREF_SKIP:
+            if not matches_only:
+                for i from 0 <= i < l:
+                    qp[n] = -1
+                    rp[n] = pos + i
+                    if with_seq:
+                        bp[n] = ref_p[r_idx]
+                        r_idx += 1
+                    n += 1
+            elif with_seq:
+                r_idx += l
+            pos += l
+
+    if with_seq:
+        return qpositions, rpositions, bases
+    return qpositions, rpositions
+
+
+cdef inline Py_ssize_t segmentRecordSize(bam1_t * src):
+    """return number of bytes required to store *src* in
+    a packed record."""
+    return sizeof(int32_t) + sizeof(bam1_core_t) + src.l_data
+
+
+cdef inline Py_ssize_t writeSegmentRecord(bam1_t * src, uint8_t * dest):
+    """write *src* as a packed record to *dest*.
+
+    A record is the length of the variable length data as int32,
+    followed by the core structure and the variable length data.
+
+    Returns the number of bytes written.
+    """
+    cdef int32_t l_data = src.l_data
+    memcpy(dest, &l_data, sizeof(int32_t))
+    dest += sizeof(int32_t)
+    memcpy(dest, &src.core, sizeof(bam1_core_t))
+    dest += sizeof(bam1_core_t)
+    memcpy(dest, src.data, l_data)
+    return segmentRecordSize(src)
+
+
+def pack_segments(segments):
+    """pack alignments into a single contiguous bytes object.
+
+    The alignments are stored in their in-memory representation, so
+    packing and :func:`unpack_segments` amount to a copy of each
+    record. Use this to send many alignments to another process or to
+    place them in shared memory. The format is native to the machine
+    and not meant for storage.
+
+    Parameters
+    ----------
+
+    segments : iterable of :class:`AlignedSegment`
+
+    Returns
+    -------
+
+    bytes
+    """
+    cdef AlignedSegment segment
+    cdef list segment_list = list(segments)
+    cdef Py_ssize_t nbytes = 0
+    for segment in segment_list:
+        nbytes += segmentRecordSize(segment._delegate)
+
+    result = PyBytes_FromStringAndSize(NULL, nbytes)
+    cdef uint8_t * p = <uint8_t*><char*>result
+    for segment in segment_list:
+        p += writeSegmentRecord(segment._delegate, p)
+    return result
+
+
+def unpack_segments(buffer, int max_segments=-1):
+    """unpack alignments packed with :func:`pack_segments`.
+
+    *buffer* can be any object supporting the buffer protocol, such
+    as bytes, a memoryview or a :class:`mmap.mmap`. At most
+    *max_segments* alignments are returned if it is not negative.
+
+    The returned alignments are not associated with an
+    :class:`AlignmentFile`, so their reference names are not
+    available.
+
+    Raises ValueError if the buffer does not contain complete records.
+
+    Returns
+    -------
+
+    list of :class:`AlignedSegment`
+    """
+    cdef Py_buffer view
+    cdef list result = []
+    cdef AlignedSegment dest
+    cdef bam1_t * b
+    cdef bam1_core_t core
+    cdef int32_t l_data
+    cdef int64_t minimum
+    cdef Py_ssize_t offset = 0
+    cdef uint8_t * p
+
+    PyObject_GetBuffer(buffer, &view, PyBUF_SIMPLE)
+    try:
+        p = <uint8_t*>view.buf
+        while offset < view.len:
+            if max_segments >= 0 and len(result) >= max_segments:
+                break
+            if view.len - offset < <Py_ssize_t>(sizeof(int32_t) +
+                                                sizeof(bam1_core_t)):
+                raise ValueError("truncated record at offset %i" % offset)
+            # copy as records are not necessarily aligned
+            memcpy(&l_data, p + offset, sizeof(int32_t))
+            memcpy(&core, p + offset + sizeof(int32_t), sizeof(bam1_core_t))
+            minimum = core.l_qname + 4 * <int64_t>core.n_cigar + \
+                (core.l_qseq + 1) // 2 + core.l_qseq
+            if l_data < 0 or core.l_qseq < 0 or l_data < minimum:
+                raise ValueError("invalid record at offset %i" % offset)
+            if view.len - offset < <Py_ssize_t>(sizeof(int32_t) +
+                                                sizeof(bam1_core_t) +
+                                                l_data):
+                raise ValueError("truncated record at offset %i" % offset)
+
+            dest = AlignedSegment.__new__(AlignedSegment)
+            b = <bam1_t*>calloc(1, sizeof(bam1_t))
+            if b == NULL:
+                raise MemoryError("could not allocate memory for alignment")
+            dest._delegate = b
+            # allocate at least one byte, see AlignedSegment.__init__
+            b.m_data = l_data if l_data > 0 else 1
+            b.data = <uint8_t*>malloc(b.m_data)
+            if b.data == NULL:
+                raise MemoryError("could not allocate memory for alignment")
+            b.core = core
+            memcpy(b.data,
+                   p + offset + sizeof(int32_t) + sizeof(bam1_core_t),
+                   l_data)
+            b.l_data = l_data
+            result.append(dest)
+            offset += sizeof(int32_t) + sizeof(bam1_core_t) + l_data
+    finally:
+        PyBuffer_Release(&view)
+
+    return result
+
+
+def _rebuild_aligned_segment(data):
+    """unpickle an AlignedSegment, see AlignedSegment.__reduce__."""
+    return unpack_segments(data, 1)[0]
+
+
+def cigar_query_length(cigar):
+    """return the query length of an encoded cigar alignment.
+
+    *cigar* contains cigar operations encoded as in
+    :attr:`AlignedSegment.cigar_array`. Soft clipped bases are
+    included.
+    """
+    cdef Py_buffer view
+    cdef uint32_t * cigar_p
+    cdef Py_ssize_t k, n
+    cdef int64_t result = 0
+    cdef int op
+    getCigarBuffer(cigar, &view)
+    try:
+        cigar_p = <uint32_t*>view.buf
+        n = view.len // 4
+        for k from 0 <= k < n:
+            op = cigar_p[k] & BAM_CIGAR_MASK
+            # bit 1 is set if the operation consumes the query
+            if bam_cigar_type(op) & 1:
+                result += cigar_p[k] >> BAM_CIGAR_SHIFT
+    finally:
+        PyBuffer_Release(&view)
+    return result
+
+
+def cigar_reference_length(cigar):
+    """return the number of reference bases covered by an encoded
+    cigar alignment.
+
+    *cigar* contains cigar operations encoded as in
+    :attr:`AlignedSegment.cigar_array`.
+    """
+    cdef Py_buffer view
+    cdef uint32_t * cigar_p
+    cdef Py_ssize_t k, n
+    cdef int64_t result = 0
+    cdef int op
+    getCigarBuffer(cigar, &view)
+    try:
+        cigar_p = <uint32_t*>view.buf
+        n = view.len // 4
+        for k from 0 <= k < n:
+            op = cigar_p[k] & BAM_CIGAR_MASK
+            # bit 2 is set if the operation consumes the reference
+            if bam_cigar_type(op) & 2:
+                result += cigar_p[k] >> BAM_CIGAR_SHIFT
+    finally:
+        PyBuffer_Release(&view)
+    return result
+
+
+def cigar_stats_to_arrays(segments):
+    """return the cigar statistics of several alignments as arrays.
+
+    The statistics are those of :meth:`AlignedSegment.cigar_stats`.
+    Returns a :class:`CigarStats` named tuple with an ``array('l')``
+    per field, with one value per alignment.
+    """
+    cdef AlignedSegment segment
+    cdef int64_t stats[NCIGAR_STATS]
+    cdef list arrays = [array.array("l", []) for x in range(NCIGAR_STATS)]
+    cdef c_array.array a
+    cdef Py_ssize_t nrows = 0
+    cdef int k
+
+    for segment in segments:
+        computeCigarStats(segment._delegate, stats)
+        nrows += 1
+        for k in range(NCIGAR_STATS):
+            a = arrays[k]
+            c_array.resize_smart(a, nrows)
+            a.data.as_longs[nrows - 1] = <long>stats[k]
+
+    return CigarStats(*arrays)
+
+
+cdef inline setColumnValue(c_array.array a, char dtype, Py_ssize_t i,
+                           int64_t ivalue, double dvalue):
+    if dtype == b'i' or dtype == b's':
+        a.data.as_ints[i] = <int>ivalue
+    elif dtype == b'l':
+        a.data.as_longs[i] = <long>ivalue
+    elif dtype == b'f':
+        a.data.as_floats[i] = <float>dvalue
+    else:
+        a.data.as_doubles[i] = dvalue
+
+
+def tags_to_arrays(segments, keys, dtypes=None, long missing=-1):
+    """return the values of selected tags in several alignments as
+    typed arrays, one per tag.
+
+    The optional fields of each alignment are scanned once for all
+    *keys*, and values are stored without creating a python object
+    per value.
+
+    *dtypes* gives the type of each column, either an :mod:`array`
+    type code (``'i'``, ``'l'``, ``'f'`` or ``'d'``) or ``'s'`` for
+    strings. If *dtypes* or an entry in it is None, the type is
+    chosen from the first occurrence of the tag: ``'l'`` for integer,
+    ``'d'`` for floating point and ``'s'`` for character and string
+    tags.
+
+    Absent tags are stored as *missing* in integer columns, NaN in
+    floating point columns and -1 in string columns.
+
+    Parameters
+    ----------
+
+    segments : iterable of :class:`AlignedSegment`
+    keys : list of two-letter tags
+    dtypes : list of type codes, optional
+    missing : int, value for absent integer tags
+
+    Returns
+    -------
+
+    A list with an entry per tag: an :class:`array.array` for numeric
+    columns and a tuple ``(codes, values)`` for string columns, where
+    *codes* is an ``array('i')`` of indices into the list *values* of
+    distinct strings in order of appearance.
+
+    Raises
+    ------
+
+    ValueError
+        If a tag has a type that does not fit its column. Array
+        tags (type ``B``) are not supported.
+    """
+    cdef list bkeys = [force_bytes(x) for x in keys]
+    cdef int nkeys = len(bkeys)
+    for bkey in bkeys:
+        if len(bkey) != 2:
+            raise ValueError("invalid tag '%s'" % force_str(bkey))
+    if dtypes is None:
+        dtypes = [None] * nkeys
+    dtypes = list(dtypes)
+    if len(dtypes) != nkeys:
+        raise ValueError("keys and dtypes must be of the same length")
+
+    cdef list arrays = []
+    cdef list values = []
+    cdef int col
+    for col in range(nkeys):
+        if dtypes[col] is None:
+            arrays.append(None)
+        elif dtypes[col] == "s":
+            arrays.append(array.array("i", []))
+        elif dtypes[col] in ("i", "l", "f", "d"):
+            arrays.append(array.array(dtypes[col], []))
+        else:
+            raise ValueError("unknown dtype '%s'" % dtypes[col])
+        values.append([])
+
+    cdef char * keys_c = <char*>calloc(2 * nkeys + 1, sizeof(char))
+    cdef char * types_c = <char*>calloc(nkeys + 1, sizeof(char))
+    cdef uint8_t ** found = <uint8_t**>calloc(nkeys + 1, sizeof(uint8_t*))
+    cdef s2i_t ** tables_c = <s2i_t**>calloc(nkeys + 1, sizeof(s2i_t*))
+    if keys_c == NULL or types_c == NULL or found == NULL or \
+       tables_c == NULL:
+        free(keys_c)
+        free(types_c)
+        free(found)
+        free(tables_c)
+        raise MemoryError("out of memory in tags_to_arrays()")
+
+    cdef char * ckey
+    for col in range(nkeys):
+        ckey = bkeys[col]
+        keys_c[2 * col] = ckey[0]
+        keys_c[2 * col + 1] = ckey[1]
+        if dtypes[col] is not None:
+            types_c[col] = ord(dtypes[col][0])
+
+    cdef AlignedSegment segment
+    cdef c_array.array a
+    cdef s2i_t * table
+    cdef khint_t k
+    cdef int absent
+    cdef Py_ssize_t nrows = 0, i
+    cdef uint8_t * v
+    cdef uint8_t auxtype
+    cdef char * string_value
+    cdef char char_value[2]
+    cdef int64_t ivalue
+    cdef double dvalue
+    char_value[1] = 0
+
+    try:
+        for segment in segments:
+            if findAuxTags(segment._delegate, keys_c, nkeys, found) < 0:
+                raise ValueError(
+                    "corrupt optional fields in '%s'" % segment.query_name)
+            nrows += 1
+
+            for col in range(nkeys):
+                v = found[col]
+                if types_c[col] == 0:
+                    if v == NULL:
+                        continue
+                    # choose the column type from the first occurrence
+                    auxtype = v[0]
+                    if auxtype in b"cCsSiI":
+                        types_c[col] = b'l'
+                    elif auxtype in b"fd":
+                        types_c[col] = b'd'
+                    elif auxtype in b"AZH":
+                        types_c[col] = b's'
+                    else:
+                        raise ValueError(
+                            "tag '%s' of type '%s' can not be stored "
+                            "in a column" %
+                            (force_str(bkeys[col]), chr(auxtype)))
+                    dtypes[col] = chr(types_c[col])
+                    a = array.array(
+                        "i" if types_c[col] == b's' else dtypes[col], [])
+                    c_array.resize(a, nrows - 1)
+                    for i in range(nrows - 1):
+                        setColumnValue(
+                            a, types_c[col], i,
+                            -1 if types_c[col] == b's' else missing, NAN)
+                    arrays[col] = a
+
+                a = arrays[col]
+                c_array.resize_smart(a, nrows)
+
+                if v == NULL:
+                    setColumnValue(a, types_c[col], nrows - 1,
+                                   -1 if types_c[col] == b's' else missing,
+                                   NAN)
+                    continue
+
+                auxtype = v[0]
+                if types_c[col] == b's':
+                    if auxtype == b'A':
+                        char_value[0] = bam_aux2A(v)
+                        string_value = char_value
+                    elif auxtype == b'Z' or auxtype == b'H':
+                        string_value = bam_aux2Z(v)
+                    else:
+                        raise ValueError(
+                            "tag '%s' of type '%s' in '%s' is not a string" %
+                            (force_str(bkeys[col]), chr(auxtype),
+                             segment.query_name))
+                    table = tables_c[col]
+                    if table == NULL:
+                        table = tables_c[col] = kh_init_s2i()
+                    k = kh_get_s2i(table, string_value)
+                    if k == table.n_buckets:
+                        k = kh_put_s2i(table, string_value, &absent)
+                        table.keys[k] = strdup(string_value)
+                        table.vals[k] = len(values[col])
+                        values[col].append(charptr_to_str(string_value))
+                    a.data.as_ints[nrows - 1] = table.vals[k]
+                elif auxtype in b"cCsSiI":
+                    ivalue = bam_aux2i(v)
+                    setColumnValue(a, types_c[col], nrows - 1,
+                                   ivalue, <double>ivalue)
+                elif auxtype in b"fd" and \
+                        (types_c[col] == b'f' or types_c[col] == b'd'):
+                    dvalue = bam_aux2f(v)
+                    setColumnValue(a, types_c[col], nrows - 1, 0, dvalue)
+                else:
+                    raise ValueError(
+                        "tag '%s' of type '%s' in '%s' does not fit "
+                        "column of type '%s'" %
+                        (force_str(bkeys[col]), chr(auxtype),
+                         segment.query_name, dtypes[col]))
+    finally:
+        for col in range(nkeys):
+            table = tables_c[col]
+            if table == NULL:
+                continue
+            for k in range(table.n_buckets):
+                if kh_exist(table, k):
+                    free(<char*>table.keys[k])
+            kh_destroy_s2i(table)
+        free(tables_c)
+        free(keys_c)
+        free(types_c)
+        free(found)
+
+    # tags that were never seen
+    for col in range(nkeys):
+        if arrays[col] is None:
+            dtypes[col] = "l"
+            arrays[col] = array.array("l", [missing] * nrows)
+
+    return [(col_array, col_values) if d == "s" else col_array
+            for col_array, col_values, d in zip(arrays, values, dtypes)]
+
+
+cdef char * getAlignedReference(AlignedSegment segment,
+                                FastaFile fastafile) except NULL:
+    """return pointer to the reference bases from reference_start to
+    reference_end of *segment*, looked up in *fastafile*.
+
+    The pointer is valid until the next lookup in *fastafile*.
+    """
+    cdef bam1_t * src = segment._delegate
+    cdef AlignmentFile alignment_file = segment._alignment_file
+    cdef int32_t end
+    cdef int length
+    cdef char * ref
+
+    if alignment_file is None or alignment_file.header == NULL:
+        raise ValueError(
+            "alignment is not associated with an AlignmentFile, "
+            "the reference name is unknown")
+    if src.core.tid < 0 or \
+       src.core.tid >= alignment_file.header.n_targets or \
+       pysam_get_n_cigar(src) == 0:
+        raise ValueError("alignment is not placed on a reference")
+    if not fastafile.is_open():
+        raise ValueError("I/O operation on closed file")
+
+    end = bam_endpos(src)
+    ref = fastafile._fetch_window(
+        alignment_file.header.target_name[src.core.tid],
+        src.core.pos, end, &length)
+    if ref == NULL:
+        raise KeyError(
+            "sequence '%s' not present" %
+            charptr_to_str(alignment_file.header.target_name[src.core.tid]))
+    if length < end - src.core.pos:
+        raise ValueError("alignment extends beyond end of reference")
+    return ref
+
+
+cdef inline bint isMatch(char ref_base, uint8_t * seq, uint32_t qpos):
+    """return True if the reference base matches the query base at
+    *qpos*. As in samtools calmd, N does not match any base."""
+    cdef uint8_t c1 = seq_nt16_table[<unsigned char>ref_base]
+    cdef uint8_t c2 = pysam_bam_seqi(seq, qpos)
+    return c1 == c2 and c1 != 15 and c2 != 15
+
+
+cdef bytes buildReferenceSequenceFromFasta(AlignedSegment segment,
+                                           FastaFile fastafile):
+    """return the reference sequence of the aligned (M, = and X),
+    deleted (D) and skipped (N) positions of *segment*, looked up in
+    *fastafile*. Bases that do not match the query are lower case.
+    """
+    cdef bam1_t * src = segment._delegate
+    cdef char * ref = getAlignedReference(segment, fastafile)
+    cdef uint8_t * seq = pysam_bam_get_seq(src)
+    cdef uint32_t * cigar_p = pysam_bam_get_cigar(src)
+    cdef uint32_t k, i, l, qpos = 0, r_idx = 0
+    cdef int op
+    cdef char c
+
+    result = PyBytes_FromStringAndSize(NULL, bam_endpos(src) - src.core.pos)
+    cdef char * s = <char*>result
+
+    for k from 0 <= k < pysam_get_n_cigar(src):
+        op = cigar_p[k] & BAM_CIGAR_MASK
+        l = cigar_p[k] >> BAM_CIGAR_SHIFT
+        if op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF:
+            for i from 0 <= i < l:
+                c = ref[r_idx]
+                if c >= 'a' and c <= 'z':
+                    c -= 32
+                if src.core.l_qseq and not isMatch(c, seq, qpos):
+                    c += 32
+                s[r_idx] = c
+                r_idx += 1
+                qpos += 1
+        elif op == BAM_CDEL or op == BAM_CREF_SKIP:
+            for i from 0 <= i < l:
+                c = ref[r_idx]
+                if c >= 'a' and c <= 'z':
+                    c -= 32
+                s[r_idx] = c
+                r_idx += 1
+        elif op == BAM_CINS or op == BAM_CSOFT_CLIP:
+            qpos += l
+        elif op == BAM_CPAD:
+            raise NotImplementedError(
+                "Padding (BAM_CPAD, 6) is currently not supported. "
+                "Please implement. Sorry about that.")
+
+    return result
+
+
+cdef computeMD(AlignedSegment segment, FastaFile fastafile):
+    """return the MD tag and the edit distance (NM) of *segment*
+    against the reference in *fastafile*, computed as in
+    samtools calmd."""
+    cdef bam1_t * src = segment._delegate
+    cdef char * ref = getAlignedReference(segment, fastafile)
+    cdef uint8_t * seq = pysam_bam_get_seq(src)
+    cdef uint32_t * cigar_p = pysam_bam_get_cigar(src)
+    cdef uint32_t n_cigar = pysam_get_n_cigar(src)
+    cdef uint32_t k, i, l, qpos = 0, r_idx = 0
+    cdef int op, nm = 0, u = 0
+    cdef char c
+
+    if src.core.l_qseq == 0:
+        raise ValueError("alignment has no sequence")
+
+    # each reference base adds at most two characters (a base and a
+    # number), each operation at most a number and '^'
+    cdef Py_ssize_t max_len = 3 * (bam_endpos(src) - src.core.pos) + \
+        13 * (n_cigar + 1)
+    cdef char * md = <char*>malloc(max_len)
+    if md == NULL:
+        raise MemoryError("could not allocate MD tag")
+    cdef char * p = md
+
+    for k from 0 <= k < n_cigar:
+        op = cigar_p[k] & BAM_CIGAR_MASK
+        l = cigar_p[k] >> BAM_CIGAR_SHIFT
+        if op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF:
+            for i from 0 <= i < l:
+                c = ref[r_idx]
+                if isMatch(c, seq, qpos):
+                    u += 1
+                else:
+                    p += sprintf(p, "%d", u)
+                    if c >= 'a' and c <= 'z':
+                        c -= 32
+                    p[0] = c
+                    p += 1
+                    u = 0
+                    nm += 1
+                r_idx += 1
+                qpos += 1
+        elif op == BAM_CDEL:
+            p += sprintf(p, "%d", u)
+            p[0] = '^'
+            p += 1
+            for i from 0 <= i < l:
+                c = ref[r_idx]
+                if c >= 'a' and c <= 'z':
+                    c -= 32
+                p[0] = c
+                p += 1
+                r_idx += 1
+            u = 0
+            nm += l
+        elif op == BAM_CREF_SKIP:
+            r_idx += l
+        elif op == BAM_CINS:
+            qpos += l
+            nm += l
+        elif op == BAM_CSOFT_CLIP:
+            qpos += l
+        elif op == BAM_CPAD:
+            free(md)
+            raise NotImplementedError(
+                "Padding (BAM_CPAD, 6) is currently not supported. "
+                "Please implement. Sorry about that.")
+    p += sprintf(p, "%d", u)
+
+    try:
+        return charptr_to_str_w_len(md, p - md), nm
+    finally:
+        free(md)
+
+
+def fill_md(segments, FastaFile fastafile):
+    """set the MD and NM tags of alignments while iterating over them.
+
+    This is the equivalent of ``samtools calmd`` that can be applied
+    to a stream of alignments, for example before writing them to an
+    :class:`AlignmentFile`::
+
+        for read in pysam.fill_md(infile.fetch(until_eof=True), fasta):
+            outfile.write(read)
+
+    The tags are computed in C from the reference in *fastafile*.
+    Reference windows are cached, so alignments sorted by coordinate
+    read each part of the reference only once. Unmapped alignments
+    and alignments without a sequence are passed through unchanged.
+
+    Yields
+    ------
+
+    the alignments in *segments*
+    """
+    cdef AlignedSegment segment
+    for segment in segments:
+        if not (pysam_get_flag(segment._delegate) & BAM_FUNMAP) and \
+           segment._delegate.core.l_qseq > 0 and \
+           pysam_get_n_cigar(segment._delegate) > 0:
+            md, nm = computeMD(segment, fastafile)
+            segment.set_tag("NM", nm)
+            segment.set_tag("MD", md, "Z")
+        yield segment
+
+
 cdef class AlignedSegment:
     '''Class representing an aligned segment.
 
@@ -636,7 +1639,9 @@ cdef class AlignedSegment:
     not the most efficient way to build BAM entries, as the variable
     length data is concatenated and thus needs to be resized if
     a field is updated. Furthermore, the BAM entry might be
-    in an inconsistent state.
+    in an inconsistent state. To build many entries, use
+    :meth:`from_fields` or :meth:`set_fields`, which set all fields
+    at once.
 
     One issue to look out for is that the sequence should always
     be set *before* the quality scores. Setting the sequence will
@@ -695,6 +1700,202 @@ cdef class AlignedSegment:
     def __deepcopy__(self, memo):
         return makeAlignedSegment(self._delegate, self._alignment_file)
 
+    def set_fields(self,
+                   query_name=None,
+                   flag=0,
+                   reference_id=-1,
+                   reference_start=-1,
+                   mapping_quality=0,
+                   cigartuples=None,
+                   next_reference_id=-1,
+                   next_reference_start=-1,
+                   template_length=0,
+                   query_sequence=None,
+                   query_qualities=None,
+                   tags=None,
+                   cigarstring=None):
+        """set all fields of this alignment at once.
+
+        The size of the variable length data is computed in advance
+        and all fields are encoded into a single allocation, which is
+        re-used if it is large enough. To write many alignments, a
+        single AlignedSegment can thus be filled and written
+        repeatedly. Any previous content is replaced.
+
+        The arguments correspond to the properties of the same name.
+        The cigar can be given either as *cigartuples* or as
+        *cigarstring*. *query_sequence* may be a string or a
+        bytes-like object. *query_qualities* may be any object
+        supporting the buffer protocol with one byte per item, such
+        as an ``array('B')``, bytes or a memoryview, and is copied
+        without conversion. *tags* is a list of tuples as in
+        :meth:`set_tags`. Without *query_name*, the name is set to
+        ``*``, which denotes a missing name in SAM.
+
+        Raises ValueError if the number of quality scores does not
+        match the length of the sequence.
+        """
+        cdef bam1_t * src = self._delegate
+        cdef Py_buffer seq_view
+        cdef Py_buffer qual_view
+        cdef bint have_seq = False
+        cdef bint have_qual = False
+        cdef bytes bname = None
+        cdef bytes btags = None
+        cdef list cigar = None
+        cdef Py_ssize_t l_qname, n_cigar = 0, l_seq = 0, l_aux = 0
+        cdef Py_ssize_t l_data, k
+        cdef uint8_t * p
+        cdef uint32_t * cigar_p
+
+        if query_name is not None and len(query_name) > 0:
+            bname = force_bytes(query_name)
+        else:
+            bname = b"*"
+        # the qname is \0 terminated
+        l_qname = len(bname) + 1
+        if l_qname > 255:
+            raise ValueError("query name longer than 254 characters")
+
+        if cigarstring is not None:
+            if cigartuples is not None:
+                raise ValueError(
+                    "only one of cigartuples and cigarstring can be given")
+            cigar = [(CIGAR2CODE[ord(y)], int(x))
+                     for x, y in CIGAR_REGEX.findall(cigarstring)]
+        elif cigartuples is not None:
+            cigar = list(cigartuples)
+        if cigar is not None:
+            n_cigar = len(cigar)
+            if n_cigar > 0xffff:
+                raise ValueError("too many cigar operations: %i" % n_cigar)
+
+        if tags is not None and len(tags) > 0:
+            fmt, args = packTags(tags)
+            btags = struct.pack(fmt, *args)
+            l_aux = len(btags)
+
+        try:
+            if query_sequence is not None and len(query_sequence) > 0:
+                try:
+                    PyObject_GetBuffer(query_sequence, &seq_view,
+                                       PyBUF_SIMPLE)
+                except TypeError:
+                    query_sequence = force_bytes(query_sequence)
+                    PyObject_GetBuffer(query_sequence, &seq_view,
+                                       PyBUF_SIMPLE)
+                except BufferError:
+                    # copy buffers that are not contiguous
+                    query_sequence = bytes(query_sequence)
+                    PyObject_GetBuffer(query_sequence, &seq_view,
+                                       PyBUF_SIMPLE)
+                have_seq = True
+                l_seq = seq_view.len
+
+            if query_qualities is not None and len(query_qualities) > 0:
+                getQualitiesBuffer(query_qualities, &qual_view)
+                have_qual = True
+                if qual_view.len != l_seq:
+                    raise ValueError(
+                        "quality and sequence mismatch: %i != %i" %
+                        (qual_view.len, l_seq))
+
+            # as the sequence is stored in half-bytes, the total length
+            # (sequence plus quality scores) is (l+1)/2 + l
+            l_data = l_qname + 4 * n_cigar + (l_seq + 1) // 2 + l_seq + l_aux
+            p = pysam_bam_resize(src, l_data)
+            if p == NULL:
+                raise MemoryError(
+                    "could not allocate %i bytes for alignment" % l_data)
+
+            src.core.tid = reference_id
+            src.core.pos = reference_start
+            src.core.mtid = next_reference_id
+            src.core.mpos = next_reference_start
+            src.core.isize = template_length
+            src.core.l_qseq = l_seq
+            pysam_set_flag(src, flag)
+            pysam_set_qual(src, mapping_quality)
+            pysam_set_l_qname(src, l_qname)
+            pysam_set_n_cigar(src, n_cigar)
+
+            memcpy(p, <char*>bname, l_qname)
+
+            cigar_p = pysam_bam_get_cigar(src)
+            k = 0
+            if cigar is not None:
+                for op, l in cigar:
+                    cigar_p[k] = l << BAM_CIGAR_SHIFT | op
+                    k += 1
+
+            if l_seq > 0:
+                encodeSequence(pysam_bam_get_seq(src),
+                               <char*>seq_view.buf, l_seq)
+                p = pysam_bam_get_qual(src)
+                if have_qual:
+                    memcpy(p, qual_view.buf, l_seq)
+                else:
+                    memset(p, 0xff, l_seq)
+
+            if l_aux > 0:
+                memcpy(pysam_bam_get_aux(src), <char*>btags, l_aux)
+        finally:
+            if have_seq:
+                PyBuffer_Release(&seq_view)
+            if have_qual:
+                PyBuffer_Release(&qual_view)
+
+        if n_cigar:
+            pysam_set_bin(src,
+                          hts_reg2bin(src.core.pos, bam_endpos(src), 14, 5))
+        else:
+            pysam_set_bin(src,
+                          hts_reg2bin(src.core.pos, src.core.pos + 1, 14, 5))
+
+        # clear cached values
+        self.cache_query_qualities = None
+        self.cache_query_alignment_qualities = None
+        self.cache_query_sequence = None
+        self.cache_query_alignment_sequence = None
+
+    @staticmethod
+    def from_fields(*args, **kwargs):
+        """return a new AlignedSegment with all fields set at once.
+
+        Accepts the same arguments as :meth:`set_fields`.
+        """
+        cdef AlignedSegment dest = AlignedSegment()
+        dest.set_fields(*args, **kwargs)
+        return dest
+
+    def __reduce__(self):
+        # the association with an AlignmentFile is not preserved
+        return (_rebuild_aligned_segment, (self.to_bytes(),))
+
+    def to_bytes(self):
+        """return a binary representation of this alignment.
+
+        The representation consists of the core fields followed by
+        the variable length data, as stored in memory. It is meant
+        for exchange between processes on the same machine (see
+        :func:`pack_segments`) and is not a file format.
+        """
+        cdef bam1_t * src = self._delegate
+        cdef Py_ssize_t nbytes = segmentRecordSize(src)
+        result = PyBytes_FromStringAndSize(NULL, nbytes)
+        writeSegmentRecord(src, <uint8_t*><char*>result)
+        return result
+
+    @staticmethod
+    def from_bytes(data):
+        """return an AlignedSegment built from the output of
+        :meth:`to_bytes`.
+
+        The returned alignment is not associated with an
+        :class:`AlignmentFile`.
+        """
+        return unpack_segments(data, 1)[0]
+
     def compare(self, AlignedSegment other):
         '''return -1,0,1, if contents in this are binary
         <,=,> to *other*
@@ -742,18 +1943,76 @@ cdef class AlignedSegment:
     def __hash__(self):
         cdef bam1_t * src
         src = self._delegate
-        # shift and xor values in the core structure
-        # make sure tid and mtid are shifted by different amounts
-        # should variable length data be included?
-        cdef uint32_t hash_value = src.core.tid << 24 ^ \
-            src.core.pos << 16 ^ \
-            src.core.qual << 8 ^ \
-            src.core.flag ^ \
-            src.core.isize << 24 ^ \
-            src.core.mtid << 16 ^ \
-            src.core.mpos << 8
-
-        return hash_value
+        # hash the core structure and the variable length data,
+        # which are both used in comparisons, see compare()
+        cdef uint64_t hash_value = pysam_hash64(
+            &src.core, sizeof(bam1_core_t), 0)
+        hash_value = pysam_hash64(src.data, src.l_data, hash_value)
+        return <Py_hash_t>hash_value
+
+    def content_hash(self, fields=None, uint64_t seed=0):
+        """return a 64-bit hash of selected parts of this alignment.
+
+        Alignments that agree in the selected *fields* have the same
+        hash, which makes the hash useful as a key for duplicate
+        detection or for grouping reads. Valid fields are
+        ``query_name``, ``query_sequence``, ``query_qualities``,
+        ``cigar``, ``reference_id``, ``reference_start``,
+        ``reference_end``, ``is_reverse``, ``flag``,
+        ``next_reference_id`` and ``next_reference_start``. The default
+        is the name, the sequence, the position and the strand.
+
+        The hash is computed in C without creating python objects for
+        the fields, and is stable across processes for a given
+        *seed*.
+        """
+        cdef bam1_t * src = self._delegate
+        cdef uint64_t h = seed
+        cdef int32_t value
+        cdef uint8_t l_qname
+
+        if fields is None:
+            fields = ("query_name", "query_sequence", "reference_id",
+                      "reference_start", "is_reverse")
+
+        for field in fields:
+            if field == "query_name":
+                l_qname = pysam_get_l_qname(src)
+                # do not include the terminating \0
+                h = pysam_hash64(pysam_bam_get_qname(src),
+                                 l_qname - 1 if l_qname > 0 else 0, h)
+            elif field == "query_sequence":
+                value = src.core.l_qseq
+                h = pysam_hash64(&value, sizeof(int32_t), h)
+                h = pysam_hash64(pysam_bam_get_seq(src),
+                                 (src.core.l_qseq + 1) // 2, h)
+            elif field == "query_qualities":
+                h = pysam_hash64(pysam_bam_get_qual(src),
+                                 src.core.l_qseq, h)
+            elif field == "cigar":
+                h = pysam_hash64(pysam_bam_get_cigar(src),
+                                 4 * pysam_get_n_cigar(src), h)
+            elif field == "reference_id":
+                h = pysam_hash64(&src.core.tid, sizeof(int32_t), h)
+            elif field == "reference_start":
+                h = pysam_hash64(&src.core.pos, sizeof(int32_t), h)
+            elif field == "reference_end":
+                value = bam_endpos(src)
+                h = pysam_hash64(&value, sizeof(int32_t), h)
+            elif field == "is_reverse":
+                value = (pysam_get_flag(src) & BAM_FREVERSE) != 0
+                h = pysam_hash64(&value, sizeof(int32_t), h)
+            elif field == "flag":
+                value = pysam_get_flag(src)
+                h = pysam_hash64(&value, sizeof(int32_t), h)
+            elif field == "next_reference_id":
+                h = pysam_hash64(&src.core.mtid, sizeof(int32_t), h)
+            elif field == "next_reference_start":
+                h = pysam_hash64(&src.core.mpos, sizeof(int32_t), h)
+            else:
+                raise ValueError("unknown field '%s'" % field)
+
+        return h
 
     cpdef tostring(self, AlignmentFile_t htsfile):
         """returns a string representation of the aligned segment.
@@ -1049,6 +2308,33 @@ cdef class AlignedSegment:
             self.cache_query_qualities = None
             self.cache_query_alignment_qualities = None
 
+    property query_sequence_bytes:
+        """read sequence bases as bytes, including :term:`soft
+        clipped` bases (None if not present).
+
+        Unlike :attr:`query_sequence`, no conversion to a unicode
+        string takes place.
+        """
+        def __get__(self):
+            cdef bam1_t * src = self._delegate
+            return getSequenceInRange(src, 0, src.core.l_qseq)
+
+    property query_sequence_packed:
+        """the sequence as stored in the alignment, two 4-bit encoded
+        bases per byte (None if not present).
+
+        The first base of a byte is in the high nibble. Codes are
+        indices into ``"=ACMGRSVTWYHKDBN"``. The bytes are copied
+        without decoding, so later changes to the alignment are not
+        reflected.
+        """
+        def __get__(self):
+            cdef bam1_t * src = self._delegate
+            if src.core.l_qseq == 0:
+                return None
+            return PyBytes_FromStringAndSize(
+                <char*>pysam_bam_get_seq(src), (src.core.l_qseq + 1) // 2)
+
     property query_qualities:
         """read sequence base qualities, including :term:`soft
         clipped` bases (None if not present).
@@ -1105,15 +2391,18 @@ cdef class AlignedSegment:
                     "quality and sequence mismatch: %i != %i" %
                     (l, src.core.l_qseq))
 
-            # create a python array object filling it
-            # with the quality scores
-
-            # NB: should avoid this copying if qual is
-            # already of the correct type.
-            cdef c_array.array result = c_array.array('B', qual)
-
-            # copy data
-            memcpy(p, result.data.as_voidptr, l)
+            # copy data, converting only if qual is not a buffer
+            # of unsigned chars
+            cdef Py_buffer view
+            getQualitiesBuffer(qual, &view)
+            try:
+                if view.len != l:
+                    raise ValueError(
+                        "quality and sequence mismatch: %i != %i" %
+                        (view.len, src.core.l_qseq))
+                memcpy(p, view.buf, l)
+            finally:
+                PyBuffer_Release(&view)
 
             # save in cache
             self.cache_query_qualities = qual
@@ -1332,7 +2621,7 @@ cdef class AlignedSegment:
     #####################################################
     # Computed properties
 
-    def get_reference_positions(self, full_length=False):
+    def get_reference_positions(self, full_length=False, as_array=False):
         """a list of reference positions that this read aligns to.
 
         By default, this method only returns positions in the
@@ -1341,6 +2630,11 @@ cdef class AlignedSegment:
         unaligned positions within the read. The returned list will
         thus be of the same length as the read.
 
+        If *as_array* is set, the positions are returned as an
+        ``array('i')`` instead of a list, with -1 in place of None.
+        The array supports the buffer protocol, so it can be wrapped
+        by ``numpy.frombuffer`` without copying.
+
         """
         cdef uint32_t k, i, pos
         cdef int op
@@ -1349,6 +2643,9 @@ cdef class AlignedSegment:
         cdef bint _full = full_length
 
         src = self._delegate
+        if as_array:
+            return getReferencePositionsArray(src, _full)
+
         if pysam_get_n_cigar(src) == 0:
             return []
 
@@ -1373,6 +2670,56 @@ cdef class AlignedSegment:
 
         return result
 
+    def cigar_stats(self):
+        """return statistics of the cigar alignment.
+
+        The statistics are computed in a single pass over the cigar
+        alignment and returned as a :class:`CigarStats` named tuple
+        with the fields:
+
+        query_length
+           length of the query including soft clipped bases, as
+           :meth:`infer_query_length`.
+        query_alignment_length
+           length of the query without soft clipped bases.
+        aligned_length
+           number of aligned bases (M, = and X).
+        reference_length
+           number of reference bases covered, as
+           :attr:`reference_length`.
+        soft_clip_start, soft_clip_end, hard_clip_start, hard_clip_end
+           number of clipped bases at either end of the query.
+        insertions, deletions
+           number of insertions and deletions.
+        inserted_bases, deleted_bases
+           number of inserted and deleted bases.
+        skipped_bases
+           number of skipped reference bases (N).
+
+        All values are 0 if there is no cigar alignment. See
+        :func:`cigar_stats_to_arrays` for the statistics of many
+        alignments.
+        """
+        cdef int64_t stats[NCIGAR_STATS]
+        computeCigarStats(self._delegate, stats)
+        return CigarStats(*[stats[k] for k in range(NCIGAR_STATS)])
+
+    def compute_md(self, FastaFile fastafile):
+        """return the MD tag and the edit distance (NM) of this
+        alignment against the reference in *fastafile*.
+
+        The values are computed as in ``samtools calmd``, but the
+        tags are not set. See :func:`fill_md` for setting them on a
+        stream of alignments. The alignment needs to be associated
+        with an :class:`AlignmentFile` for the reference names.
+
+        Returns
+        -------
+
+        tuple of (MD string, NM)
+        """
+        return computeMD(self, fastafile)
+
     def infer_query_length(self, always=True):
         """inferred read length from CIGAR string.
 
@@ -1394,11 +2741,18 @@ cdef class AlignedSegment:
 
         return calculateQueryLength(src)
 
-    def get_reference_sequence(self):
+    def get_reference_sequence(self, FastaFile fastafile=None):
         """return the reference sequence.
 
-        This method requires the MD tag to be set.
+        This method requires the MD tag to be set, unless a
+        :class:`~pysam.FastaFile` with the reference is given as
+        *fastafile*. The alignment then needs to be associated with an
+        :class:`AlignmentFile` for the reference names.
         """
+        if fastafile is not None:
+            return force_str(
+                buildReferenceSequenceFromFasta(self, fastafile))
+
         cdef uint32_t k, i
         cdef int op
         cdef bam1_t * src = self._delegate
@@ -1434,7 +2788,8 @@ cdef class AlignedSegment:
         return "".join(result)
 
 
-    def get_aligned_pairs(self, matches_only=False, with_seq=False):
+    def get_aligned_pairs(self, matches_only=False, with_seq=False,
+                          as_array=False, FastaFile fastafile=None):
         """a list of aligned read (query) and reference positions.
 
         For inserts, deletions, skipping either query or reference
@@ -1451,12 +2806,23 @@ cdef class AlignedSegment:
         with_seq : bool
           If True, return a third element in the tuple containing the
           reference sequence. Substitutions are lower-case. This option
-          requires an MD tag to be present.
+          requires an MD tag to be present, unless *fastafile* is given.
+        as_array : bool
+          If True, return the query and reference positions as two
+          ``array('i')`` objects instead of a list of tuples, with -1
+          in place of None. With *with_seq*, a third ``array('B')``
+          contains the character code of the reference base at each
+          position, or 0 if there is none.
+        fastafile : :class:`~pysam.FastaFile`
+          If given, the reference sequence for *with_seq* is taken
+          from this file instead of the MD tag, see
+          :meth:`get_reference_sequence`.
 
         Returns
         -------
 
-        aligned_pairs : list of tuples
+        aligned_pairs : list of tuples, or tuple of arrays if
+          *as_array* is set.
 
         """
         cdef uint32_t k, i, pos, qpos, r_idx, l
@@ -1470,10 +2836,15 @@ cdef class AlignedSegment:
         # read sequence, cigar and MD tag are consistent.
 
         if _with_seq:
-            ref_seq = force_str(self.get_reference_sequence())
+            ref_seq = force_str(self.get_reference_sequence(fastafile))
             if ref_seq is None:
                 raise ValueError("MD tag not present")
 
+        if as_array:
+            return getAlignedPairsArrays(
+                src, _matches_only,
+                force_bytes(ref_seq) if _with_seq else None)
+
         r_idx = 0
 
         if pysam_get_n_cigar(src) == 0:
@@ -1521,6 +2892,8 @@ cdef class AlignedSegment:
                     else:
                         for i from pos <= i < pos + l:
                             result.append((None, i))
+                elif _with_seq:
+                    r_idx += l
                 pos += l
 
             elif op == BAM_CHARD_CLIP:
@@ -1700,6 +3073,10 @@ cdef class AlignedSegment:
                 p[k] = l << BAM_CIGAR_SHIFT | op
                 k += 1
 
+            # the aligned part of the query depends on the cigar
+            self.cache_query_alignment_sequence = None
+            self.cache_query_alignment_qualities = None
+
             ## setting the cigar string requires updating the bin
             pysam_set_bin(src,
                           hts_reg2bin(
@@ -1709,6 +3086,79 @@ cdef class AlignedSegment:
                               5))
 
 
+    property cigar_array:
+        """the :term:`cigar` alignment as an ``array('I')`` of
+        encoded operations (None if not present).
+
+        Each value encodes an operation and its length as in the
+        BAM format: the operation is ``x & 0xf`` and the length
+        ``x >> 4``. See :attr:`cigartuples` for the operation codes.
+        The array is a copy of the cigar in the alignment. Changes
+        need to be assigned back to take effect.
+
+        Any object supporting the buffer protocol with 4-byte
+        unsigned integers, such as ``array('I')`` or a numpy array of
+        type uint32, can be assigned and is copied directly. Other
+        sequences of integers are converted first. To unset the
+        cigar, assign None or an empty array.
+
+        See :func:`cigar_query_length` and
+        :func:`cigar_reference_length` for computing lengths from
+        encoded operations.
+        """
+        def __get__(self):
+            cdef bam1_t * src = self._delegate
+            cdef uint32_t n_cigar = pysam_get_n_cigar(src)
+            if n_cigar == 0:
+                return None
+            cdef c_array.array result = array.array('I', [])
+            c_array.resize(result, n_cigar)
+            memcpy(result.data.as_voidptr, pysam_bam_get_cigar(src),
+                   n_cigar * 4)
+            return result
+
+        def __set__(self, values):
+            cdef bam1_t * src = self._delegate
+            cdef Py_buffer view
+            cdef Py_ssize_t ncigar = 0
+            cdef bint have_view = False
+
+            try:
+                if values is not None:
+                    getCigarBuffer(values, &view)
+                    have_view = True
+                    ncigar = view.len // 4
+                    if ncigar > 0xffff:
+                        raise ValueError(
+                            "too many cigar operations: %i" % ncigar)
+
+                # create space for cigar data within src.data
+                pysam_bam_update(src,
+                                 pysam_get_n_cigar(src) * 4,
+                                 ncigar * 4,
+                                 <uint8_t*>pysam_bam_get_cigar(src))
+                # length is number of cigar operations, not bytes
+                pysam_set_n_cigar(src, ncigar)
+                if ncigar > 0:
+                    # re-acquire pointer to location in memory
+                    # as it might have moved
+                    memcpy(pysam_bam_get_cigar(src), view.buf, ncigar * 4)
+            finally:
+                if have_view:
+                    PyBuffer_Release(&view)
+
+            # the aligned part of the query depends on the cigar
+            self.cache_query_alignment_sequence = None
+            self.cache_query_alignment_qualities = None
+
+            ## setting the cigar string requires updating the bin
+            pysam_set_bin(src,
+                          hts_reg2bin(
+                              src.core.pos,
+                              bam_endpos(src),
+                              14,
+                              5))
+
     cpdef set_tag(self,
                   tag,
                   value,
@@ -1965,6 +3415,54 @@ cdef class AlignedSegment:
 
         return result
 
+    def get_tags_subset(self, keys, default=None):
+        """return the values of the tags in *keys* as a list.
+
+        The optional alignment section is scanned once for all
+        keys, and only the values of these tags are converted into
+        python objects. Absent tags are returned as *default*.
+
+        This is quicker than several calls to :meth:`get_tag`, which
+        scan the optional alignment section for each tag. See
+        :func:`tags_to_arrays` for getting tags of many alignments
+        as arrays.
+        """
+        cdef list bkeys = [force_bytes(x) for x in keys]
+        cdef int nkeys = len(bkeys)
+        cdef int col
+        cdef char * ckey
+        cdef list result = [default] * nkeys
+        if nkeys == 0:
+            return result
+
+        cdef char * keys_c = <char*>calloc(2 * nkeys, sizeof(char))
+        cdef uint8_t ** found = <uint8_t**>calloc(nkeys, sizeof(uint8_t*))
+        if keys_c == NULL or found == NULL:
+            free(keys_c)
+            free(found)
+            raise MemoryError("out of memory in get_tags_subset()")
+
+        try:
+            for col in range(nkeys):
+                if len(bkeys[col]) != 2:
+                    raise ValueError(
+                        "invalid tag '%s'" % force_str(bkeys[col]))
+                ckey = bkeys[col]
+                keys_c[2 * col] = ckey[0]
+                keys_c[2 * col + 1] = ckey[1]
+
+            if findAuxTags(self._delegate, keys_c, nkeys, found) < 0:
+                raise ValueError("corrupt optional alignment section")
+
+            for col in range(nkeys):
+                if found[col] != NULL:
+                    result[col] = convertAuxValue(found[col])
+        finally:
+            free(keys_c)
+            free(found)
+
+        return result
+
     def set_tags(self, tags):
         """sets the fields in the optional alignmest section with
         a list of (tag, value) tuples.
@@ -2356,4 +3854,12 @@ cdef class PileupRead:
 __all__ = [
     "AlignedSegment",
     "PileupColumn",
-    "PileupRead"]
+    "PileupRead",
+    "pack_segments",
+    "unpack_segments",
+    "tags_to_arrays",
+    "cigar_stats_to_arrays",
+    "cigar_query_length",
+    "cigar_reference_length",
+    "fill_md",
+    "CigarStats"]
@@ -7,6 +7,7 @@ from libc.stdio cimport FILE, printf
 from pysam.cfaidx cimport faidx_t, Fastafile
 from pysam.calignedsegment cimport AlignedSegment
 from pysam.chtslib cimport *
+from pysam.cutils cimport IOStats
 
 from cpython cimport array
 cimport cython
@@ -45,6 +46,9 @@ cdef class AlignmentFile:
 
     # pointer to index
     cdef hts_idx_t *index
+    # index built while writing
+    cdef hts_idx_t *write_idx
+    cdef object _filepath_index
     # header structure
     cdef bam_hdr_t * header
     # true if file is bam format
@@ -63,11 +67,19 @@ cdef class AlignmentFile:
     # beginning of read section
     cdef int64_t start_offset
 
+    # size of the block cache in bytes
+    cdef int cache_size
+
+    # I/O counters, None unless profiling
+    cdef IOStats io_stats
+
     cdef bam1_t * getCurrent(self)
     cdef int cnext(self)
 
     # write an aligned read
     cpdef int write(self, AlignedSegment read) except -1
+    cdef _push_index(self, bam1_t *b)
+    cdef _profile(self, profile)
 
 cdef class PileupColumn:
     cdef bam_pileup1_t ** plp
@@ -92,6 +104,7 @@ cdef class IteratorRow:
     cdef htsFile * htsfile
     cdef bam_hdr_t * header
     cdef int owns_samfile
+    cdef IOStats io_stats
 
 cdef class IteratorRowRegion(IteratorRow):
     cdef hts_itr_t * iter
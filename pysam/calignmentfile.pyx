@@ -63,6 +63,7 @@ from cpython.version cimport PY_MAJOR_VERSION
 
 from pysam.cutils cimport force_bytes, force_str, charptr_to_str
 from pysam.cutils cimport encode_filename, from_string_and_size
+from pysam.cutils cimport make_io_stats
 from pysam.calignedsegment cimport makeAlignedSegment, makePileupColumn
 from pysam.chtslib cimport hisremote
 
@@ -218,7 +219,7 @@ cdef class AlignmentFile:
     """AlignmentFile(filepath_or_object, mode=None, template=None,
     reference_names=None, reference_lengths=None, text=NULL,
     header=None, add_sq_text=False, check_header=True, check_sq=True,
-    filename=None)
+    filename=None, write_index=False, cache_size=0, profile=False)
 
     A :term:`SAM`/:term:`BAM` formatted file. 
 
@@ -315,12 +316,37 @@ cdef class AlignmentFile:
         Alternative to filepath_or_object. Filename of the file
         to be opened.
 
+    write_index : bool
+        when writing a :term:`BAM` file, build a BAI index on the fly
+        while records are written. Records need to be written sorted
+        by coordinate. The index is saved when the file is closed,
+        either next to the file or to `filepath_index`, if given.
+        This avoids re-reading the file to index it afterwards.
+
+    cache_size : int
+        when reading a :term:`BAM` file, keep up to `cache_size`
+        bytes of decompressed blocks in memory so that regions
+        fetched repeatedly, or close to each other, are not
+        decompressed again. The default of 0 disables the cache,
+        which has no effect unless it can hold more than one 64kb
+        block. This is htslib's block cache, which is unordered: when
+        it is full, an arbitrary block is evicted. See
+        :meth:`get_cache_statistics`.
+
+    profile : bool
+        count the bytes read and written, the time spent and the
+        records and Python objects created while using the file. See
+        :meth:`stats` and :class:`~pysam.IOProfiler`. Not available
+        if pysam has been built against an external htslib.
+
     """
 
     def __cinit__(self, *args, **kwargs):
 
         self.htsfile = NULL
+        self.write_idx = NULL
         self._filename = None
+        self._filepath_index = None
         self.is_bam = False
         self.is_stream = False
         self.is_cram = False
@@ -383,7 +409,10 @@ cdef class AlignmentFile:
               check_sq=True,
               filepath_index=None,
               referencenames=None,
-              referencelengths=None):
+              referencelengths=None,
+              write_index=False,
+              cache_size=0,
+              profile=False):
         '''open a sam, bam or cram formatted file.
 
         If _open is called on an existing file, the current file
@@ -505,6 +534,7 @@ cdef class AlignmentFile:
             else:
                 with nogil:
                     self.htsfile = hts_open(cfilename, cmode)
+            self._profile(profile)
 
             # htsfile.format does not get set until writing, so use
             # the format specifier explicitely given by the user.
@@ -541,6 +571,7 @@ cdef class AlignmentFile:
             else:
                 with nogil:
                     self.htsfile = hts_open(cfilename, cmode)
+            self._profile(profile)
 
             if self.htsfile == NULL:
                 raise ValueError(
@@ -579,6 +610,24 @@ cdef class AlignmentFile:
         if self.htsfile == NULL:
             raise IOError("could not open file `%s`" % filename )
 
+        if mode[0] == "w" and write_index:
+            if not self.is_bam:
+                raise ValueError(
+                    "building an index while writing requires BAM output")
+            if self.is_stream:
+                raise ValueError(
+                    "can not build an index while writing to a stream")
+            if filepath_index:
+                self._filepath_index = encode_filename(filepath_index)
+            # the index starts after the header, see bam_index() in sam.c
+            self.write_idx = hts_idx_init(
+                self.header.n_targets,
+                HTS_FMT_BAI,
+                bgzf_tell(self.htsfile.fp.bgzf),
+                14, 5)
+            if self.write_idx == NULL:
+                raise MemoryError("could not allocate index")
+
         # check for index and open if present
         cdef int format_index = -1
         if self.is_bam:
@@ -641,6 +690,19 @@ cdef class AlignmentFile:
             if not self.is_stream:
                 self.start_offset = self.tell()
 
+        if cache_size < 0:
+            raise ValueError("invalid cache size %i" % cache_size)
+        self.cache_size = 0
+        if mode[0] == "r" and self.is_bam and cache_size > 0:
+            self.cache_size = cache_size
+            bgzf_set_cache_size(self.htsfile.fp.bgzf, cache_size)
+
+    cdef _profile(self, profile):
+        '''start profiling the opened file if requested.'''
+        self.io_stats = make_io_stats(profile)
+        if self.io_stats is not None and self.htsfile != NULL:
+            self.io_stats.profile(pysam_hts_get_hfile(self.htsfile))
+
     def get_tid(self, reference):
         """
         return the numerical :term:`tid` corresponding to
@@ -1313,13 +1375,98 @@ cdef class AlignmentFile:
 
         return count_a, count_c, count_g, count_t
 
+    def get_cache_statistics(self):
+        '''return a dictionary describing the block cache.
+
+        *cache_size* is the size of the cache in bytes and *blocks* the
+        number of decompressed blocks it currently holds. *blocks* is
+        None if pysam has been built against an external htslib, as
+        its cache can not be inspected.
+
+        The cache is htslib's BGZF block cache. It is unordered: when
+        it is full, an arbitrary block is evicted rather than the
+        least recently used one. htslib does not count cache hits.
+
+        Iterators obtained with *multiple_iterators* use a cache of
+        their own and are not included.
+        '''
+        if not self.is_open():
+            raise ValueError("I/O operation on closed file")
+
+        if not PYSAM_HTSLIB_INTERNALS:
+            return {"cache_size": self.cache_size,
+                    "blocks": None}
+
+        cdef int blocks = 0
+        if self.is_bam:
+            blocks = pysam_bgzf_cache_nblocks(self.htsfile.fp.bgzf)
+
+        return {"cache_size": self.cache_size,
+                "blocks": blocks}
+
+    def stats(self):
+        '''return a dictionary with the I/O counters of a file opened
+        with *profile* set.
+
+        *bytes_read* and *bytes_written* count the bytes transferred
+        to and from the file, in *read_calls* and *write_calls*, and
+        *seeks* the number of seeks. *io_seconds* is the time spent
+        in these operations. *blocks* is the number of compressed
+        blocks read or written and *uncompressed_bytes* the number of
+        bytes they contained when reading. *records* counts records
+        read or written, *wrappers* the Python objects created for
+        them and *nogil_seconds* the time spent reading and decoding
+        records without holding the GIL. Reads consumed by
+        :meth:`pileup` are included in the bytes and blocks, but not
+        in *records*.
+
+        Counters include iterators obtained with
+        *multiple_iterators*. Statistics are available after the file
+        has been closed.
+
+        Raises
+        ------
+        ValueError
+            if the file has not been opened with profiling enabled.
+        '''
+        if self.io_stats is None:
+            raise ValueError("file has not been opened with profile=True")
+        return self.io_stats.to_dict()
+
     def close(self):
         '''
-        closes the :class:`pysam.AlignmentFile`.'''
-        if self.htsfile != NULL:
-            hts_close(self.htsfile)
-            hts_idx_destroy(self.index);
-            self.htsfile = NULL
+        closes the :class:`pysam.AlignmentFile`.
+
+        If an index has been built while writing, it is saved.'''
+        cdef int ret = 0
+        cdef char *cfilename
+        cdef char *cindexname = NULL
+
+        if self.htsfile == NULL:
+            return
+
+        if self.write_idx != NULL:
+            ret = bgzf_flush(self.htsfile.fp.bgzf)
+            if ret == 0:
+                hts_idx_finish(self.write_idx,
+                               bgzf_tell(self.htsfile.fp.bgzf))
+                cfilename = self._filename
+                if self._filepath_index is not None:
+                    cindexname = self._filepath_index
+                with nogil:
+                    ret = hts_idx_save_as(self.write_idx,
+                                          cfilename,
+                                          cindexname,
+                                          HTS_FMT_BAI)
+            hts_idx_destroy(self.write_idx)
+            self.write_idx = NULL
+
+        hts_close(self.htsfile)
+        hts_idx_destroy(self.index);
+        self.htsfile = NULL
+
+        if ret < 0:
+            raise IOError("could not save index for '%s'" % self._filename)
 
     def __dealloc__(self):
         # remember: dealloc cannot call other methods
@@ -1338,6 +1485,10 @@ cdef class AlignmentFile:
             hts_idx_destroy(self.index);
             self.htsfile = NULL
 
+        if self.write_idx != NULL:
+            hts_idx_destroy(self.write_idx)
+            self.write_idx = NULL
+
         bam_destroy1(self.b)
         if self.header != NULL:
             bam_hdr_destroy(self.header)
@@ -1361,11 +1512,16 @@ cdef class AlignmentFile:
             return 0
 
         cdef int ret
+        cdef double t = 0
 
+        if self.io_stats is not None:
+            t = self.io_stats.start()
         with nogil:
             ret = sam_write1(self.htsfile,
                              self.header,
                              read._delegate)
+        if self.io_stats is not None:
+            self.io_stats.stop(t, pysam_hts_get_bgzf(self.htsfile), ret >= 0)
 
         # kbj: Still need to raise an exception with except -1. Otherwise
         #      when ret == -1 we get a "SystemError: error return without
@@ -1373,8 +1529,27 @@ cdef class AlignmentFile:
         if ret < 0:
             raise ValueError('sam write failed')
 
+        if self.write_idx != NULL:
+            self._push_index(read._delegate)
+
         return ret
 
+    cdef _push_index(self, bam1_t *b):
+        '''add *b* to the index built while writing.'''
+        cdef int ret = hts_idx_push(self.write_idx,
+                                    b.core.tid,
+                                    b.core.pos,
+                                    bam_endpos(b),
+                                    bgzf_tell(self.htsfile.fp.bgzf),
+                                    not (b.core.flag & BAM_FUNMAP))
+        if ret < 0:
+            # an incomplete index must not be saved
+            hts_idx_destroy(self.write_idx)
+            self.write_idx = NULL
+            raise ValueError(
+                "records are not sorted by coordinate, "
+                "can not build index")
+
     # context manager interface
     def __enter__(self):
         return self
@@ -1613,10 +1788,15 @@ cdef class AlignmentFile:
         cversion of iterator. Used by :class:`pysam.AlignmentFile.IteratorColumn`.
         '''
         cdef int ret
+        cdef double t = 0
+        if self.io_stats is not None:
+            t = self.io_stats.start()
         with nogil:
             ret = sam_read1(self.htsfile,
                             self.header,
                             self.b)
+        if self.io_stats is not None:
+            self.io_stats.stop(t, pysam_hts_get_bgzf(self.htsfile), ret >= 0)
         return ret
 
     def __next__(self):
@@ -1686,10 +1866,17 @@ cdef class IteratorRow:
                 self.header = sam_hdr_read(self.htsfile)
             assert self.header != NULL
             self.owns_samfile = True
+            if samfile.cache_size > 0:
+                bgzf_set_cache_size(self.htsfile.fp.bgzf,
+                                    samfile.cache_size)
+            if samfile.io_stats is not None:
+                self.io_stats = samfile.io_stats.child()
+                self.io_stats.profile(pysam_hts_get_hfile(self.htsfile))
         else:
             self.htsfile = self.samfile.htsfile
             self.owns_samfile = False
             self.header = self.samfile.header
+            self.io_stats = samfile.io_stats
 
         self.retval = 0
 
@@ -1741,11 +1928,17 @@ cdef class IteratorRowRegion(IteratorRow):
 
     cdef int cnext(self):
         '''cversion of iterator. Used by IteratorColumn'''
+        cdef double t = 0
+        if self.io_stats is not None:
+            t = self.io_stats.start()
         with nogil:
             self.retval = hts_itr_next(hts_get_bgzfp(self.htsfile),
                                        self.iter,
                                        self.b,
                                        self.htsfile)
+        if self.io_stats is not None:
+            self.io_stats.stop(t, pysam_hts_get_bgzf(self.htsfile),
+                               self.retval >= 0)
 
     def __next__(self):
         self.cnext()
@@ -1793,10 +1986,15 @@ cdef class IteratorRowHead(IteratorRow):
     cdef int cnext(self):
         '''cversion of iterator. Used by IteratorColumn'''
         cdef int ret
+        cdef double t = 0
+        if self.io_stats is not None:
+            t = self.io_stats.start()
         with nogil:
             ret = sam_read1(self.htsfile,
                             self.samfile.header,
                             self.b)
+        if self.io_stats is not None:
+            self.io_stats.stop(t, pysam_hts_get_bgzf(self.htsfile), ret >= 0)
         return ret
 
     def __next__(self):
@@ -1841,10 +2039,15 @@ cdef class IteratorRowAll(IteratorRow):
     cdef int cnext(self):
         '''cversion of iterator. Used by IteratorColumn'''
         cdef int ret
+        cdef double t = 0
+        if self.io_stats is not None:
+            t = self.io_stats.start()
         with nogil:
             ret = sam_read1(self.htsfile,
                             self.samfile.header,
                             self.b)
+        if self.io_stats is not None:
+            self.io_stats.stop(t, pysam_hts_get_bgzf(self.htsfile), ret >= 0)
         return ret
 
     def __next__(self):
@@ -1890,6 +2093,7 @@ cdef class IteratorRowAllRefs(IteratorRow):
         # to the values in this iterator to reflect multiple_iterators
         self.rowiter.htsfile = self.htsfile
         self.rowiter.header = self.header
+        self.rowiter.io_stats = self.io_stats
 
         # make sure the iterator understand that IteratorRowAllRefs
         # has ownership
@@ -1958,10 +2162,15 @@ cdef class IteratorRowSelection(IteratorRow):
         self.current_pos += 1
 
         cdef int ret
+        cdef double t = 0
+        if self.io_stats is not None:
+            t = self.io_stats.start()
         with nogil:
             ret = sam_read1(self.htsfile,
                             self.samfile.header,
                             self.b)
+        if self.io_stats is not None:
+            self.io_stats.stop(t, pysam_hts_get_bgzf(self.htsfile), ret >= 0)
         return ret
 
     def __next__(self):
@@ -2504,8 +2713,283 @@ cdef class IndexedReads:
             hts_close(self.htsfile)
             bam_hdr_destroy(self.header)
 
+cdef inline int32_t getUnclippedFivePrime(bam1_t * b):
+    """return the 5' position of *b* on the reference, including
+    soft and hard clipped bases."""
+    cdef uint32_t * cigar_p = bam_get_cigar(b)
+    cdef int n_cigar = b.core.n_cigar
+    cdef int32_t clip = 0
+    cdef int k, op
+    if bam_is_rev(b):
+        for k in range(n_cigar - 1, -1, -1):
+            op = cigar_p[k] & BAM_CIGAR_MASK
+            if op != BAM_CSOFT_CLIP and op != BAM_CHARD_CLIP:
+                break
+            clip += cigar_p[k] >> BAM_CIGAR_SHIFT
+        return bam_endpos(b) - 1 + clip
+    for k in range(n_cigar):
+        op = cigar_p[k] & BAM_CIGAR_MASK
+        if op != BAM_CSOFT_CLIP and op != BAM_CHARD_CLIP:
+            break
+        clip += cigar_p[k] >> BAM_CIGAR_SHIFT
+    return b.core.pos - clip
+
+
+cdef inline int64_t getBaseQualityScore(bam1_t * b, int min_base_quality):
+    """return the sum of base qualities of at least
+    *min_base_quality* in *b*."""
+    cdef uint8_t * qual = bam_get_qual(b)
+    cdef int64_t score = 0
+    cdef int k
+    if b.core.l_qseq == 0 or qual[0] == 0xff:
+        return 0
+    for k in range(b.core.l_qseq):
+        if qual[k] >= min_base_quality:
+            score += qual[k]
+    return score
+
+
+cdef class DuplicateEntry:
+    """an alignment buffered by :func:`mark_duplicates`."""
+    cdef AlignedSegment read
+    cdef int64_t score
+    cdef int32_t five_prime
+    cdef bint reverse
+    # true if the alignment takes part in duplicate marking
+    cdef bint candidate
+    # true if the mate has been seen within the pairing distance
+    cdef bint paired
+    cdef bint duplicate
+    cdef object fragment_key
+    cdef object pair_key
+
+
+cdef class DuplicateMarker:
+    """state of :func:`mark_duplicates`."""
+    cdef AlignmentFile outfile
+    cdef bint remove_duplicates
+    cdef object buffer
+    # fragment key -> list of entries
+    cdef dict fragments
+    # pair key -> list of pairs of entries
+    cdef dict pairs
+    # query name -> first mate of pairs awaiting the second mate
+    cdef dict pending
+    cdef int64_t nreads, nexamined, npairs, nduplicates
+
+    def __init__(self, AlignmentFile outfile, bint remove_duplicates):
+        self.outfile = outfile
+        self.remove_duplicates = remove_duplicates
+        self.buffer = collections.deque()
+        self.fragments = {}
+        self.pairs = {}
+        self.pending = {}
+        self.nreads = self.nexamined = self.npairs = self.nduplicates = 0
+
+    cdef decideFragments(self, key):
+        cdef list group = self.fragments.pop(key, None)
+        cdef DuplicateEntry entry, best = None
+        if group is None:
+            return
+        # fragments at the position of a pair are duplicates,
+        # paired reads are marked by their pair
+        if any([(<DuplicateEntry>x).paired for x in group]):
+            for entry in group:
+                if not entry.paired:
+                    entry.duplicate = True
+            return
+        for entry in group:
+            if best is None or entry.score > best.score:
+                best = entry
+        for entry in group:
+            if entry is not best:
+                entry.duplicate = True
+
+    cdef decidePairs(self, key):
+        cdef list group = self.pairs.pop(key, None)
+        cdef DuplicateEntry first, second
+        cdef int64_t score, best_score = -1
+        cdef Py_ssize_t k, best = 0
+        if group is None:
+            return
+        for k in range(len(group)):
+            first, second = group[k]
+            score = first.score + second.score
+            if score > best_score:
+                best, best_score = k, score
+        for k in range(len(group)):
+            if k != best:
+                first, second = group[k]
+                first.duplicate = second.duplicate = True
+
+    cdef emit(self):
+        cdef DuplicateEntry entry = self.buffer.popleft()
+        cdef bam1_t * b = entry.read._delegate
+        if entry.candidate:
+            self.decideFragments(entry.fragment_key)
+            if entry.paired:
+                self.decidePairs(entry.pair_key)
+            else:
+                qname = entry.read.query_name
+                if qname in self.pending and \
+                   self.pending[qname] is entry:
+                    del self.pending[qname]
+            if entry.duplicate:
+                b.core.flag |= BAM_FDUP
+                self.nduplicates += 1
+            else:
+                b.core.flag &= ~BAM_FDUP
+        if not (entry.duplicate and self.remove_duplicates):
+            self.outfile.write(entry.read)
+
+    cdef flush(self, int32_t pos):
+        """emit buffered alignments starting before *pos*, or all
+        if *pos* is negative."""
+        while self.buffer:
+            if pos >= 0 and \
+               (<DuplicateEntry>self.buffer[0]).read._delegate.core.pos >= pos:
+                break
+            self.emit()
+        if pos < 0:
+            self.pending.clear()
+
+    cdef add(self, AlignedSegment read, libraries,
+             int max_distance, int min_base_quality):
+        cdef bam1_t * b = read._delegate
+        cdef DuplicateEntry entry = DuplicateEntry.__new__(DuplicateEntry)
+        cdef DuplicateEntry mate
+        cdef uint8_t * rg
+        entry.read = read
+        self.buffer.append(entry)
+        self.nreads += 1
+
+        if b.core.flag & (BAM_FUNMAP | BAM_FSECONDARY |
+                          BAM_FSUPPLEMENTARY | BAM_FQCFAIL):
+            return
+
+        self.nexamined += 1
+        entry.candidate = True
+        entry.score = getBaseQualityScore(b, min_base_quality)
+        entry.five_prime = getUnclippedFivePrime(b)
+        entry.reverse = bam_is_rev(b)
+
+        library = None
+        if libraries:
+            rg = bam_aux_get(b, b"RG")
+            if rg != NULL:
+                library = libraries.get(charptr_to_str(bam_aux2Z(rg)))
+
+        entry.fragment_key = (library, b.core.tid,
+                              entry.five_prime, entry.reverse)
+        group = self.fragments.get(entry.fragment_key)
+        if group is None:
+            self.fragments[entry.fragment_key] = [entry]
+        else:
+            group.append(entry)
+
+        # pairs are only formed with mates within max_distance
+        if not (b.core.flag & BAM_FPAIRED) or \
+           (b.core.flag & BAM_FMUNMAP) or \
+           b.core.mtid != b.core.tid or \
+           abs(b.core.mpos - b.core.pos) > max_distance:
+            return
+
+        qname = read.query_name
+        mate = self.pending.pop(qname, None)
+        if mate is None:
+            self.pending[qname] = entry
+            return
+
+        mate.paired = entry.paired = True
+        self.npairs += 1
+        ends = sorted(((mate.five_prime, mate.reverse),
+                       (entry.five_prime, entry.reverse)))
+        mate.pair_key = entry.pair_key = (library, b.core.tid,
+                                          ends[0], ends[1])
+        group = self.pairs.get(entry.pair_key)
+        if group is None:
+            self.pairs[entry.pair_key] = [(mate, entry)]
+        else:
+            group.append((mate, entry))
+
+
+def mark_duplicates(segments,
+                    AlignmentFile outfile,
+                    int max_distance=1000,
+                    remove_duplicates=False,
+                    int min_base_quality=15):
+    """mark duplicate reads while copying alignments to *outfile*.
+
+    *segments* are alignments sorted by coordinate, for example from
+    ``AlignmentFile.fetch(until_eof=True)``. Each alignment is written
+    to *outfile* in input order, with the duplicate flag (0x400) set
+    or cleared in place. If *remove_duplicates* is set, duplicates
+    are not written.
+
+    As in Picard MarkDuplicates, reads are grouped by library,
+    reference, unclipped 5' position and strand. Within a group, the
+    read with the highest sum of base qualities of at least
+    *min_base_quality* is kept and the others are marked. Read pairs
+    are grouped by the positions and strands of both mates and are
+    marked together. Reads without a mapped mate in the group of a
+    pair are duplicates. The library is looked up through the ``RG``
+    tag in the read groups of the header of *outfile*.
+
+    Reads are kept in memory only as long as a duplicate decision
+    can involve them, which is bounded by *max_distance*. It is the
+    largest distance between the start positions of mates that are
+    handled as pairs. Mates further apart or on different references
+    are handled as single reads. *max_distance* also needs to exceed
+    the read length including clipped bases.
+
+    Unmapped, secondary, supplementary and QC-failed alignments are
+    not considered and are written unchanged.
+
+    Returns
+    -------
+
+    dict with the number of alignments read (*reads*), considered
+    for duplicate marking (*examined*), pairs formed (*pairs*) and
+    duplicates (*duplicates*).
+    """
+    if max_distance <= 0:
+        raise ValueError("max_distance needs to be positive")
+
+    libraries = {}
+    for read_group in (<object>outfile).header.get("RG", []):
+        if "ID" in read_group:
+            libraries[read_group["ID"]] = read_group.get(
+                "LB", read_group["ID"])
+
+    cdef DuplicateMarker marker = DuplicateMarker(outfile,
+                                                  remove_duplicates)
+    cdef AlignedSegment read
+    cdef int32_t tid = -2
+    cdef int64_t last_pos
+
+    for read in segments:
+        if read._delegate.core.tid != tid:
+            marker.flush(-1)
+            tid = read._delegate.core.tid
+        elif tid >= 0:
+            # a group spans at most 2 * max_distance and a mate is
+            # at most max_distance away, so alignments starting
+            # earlier can no longer gain group members
+            last_pos = read._delegate.core.pos - 3 * <int64_t>max_distance
+            if last_pos > 0:
+                marker.flush(last_pos)
+        marker.add(read, libraries, max_distance, min_base_quality)
+    marker.flush(-1)
+
+    return {"reads": marker.nreads,
+            "examined": marker.nexamined,
+            "pairs": marker.npairs,
+            "duplicates": marker.nduplicates}
+
+
 __all__ = [
     "AlignmentFile",
     "IteratorRow",
     "IteratorColumn",
-    "IndexedReads"]
+    "IndexedReads",
+    "mark_duplicates"]
@@ -42,6 +42,7 @@ from libc.stdlib cimport malloc, calloc, realloc, free
 from libc.string cimport memcpy, memcmp, strncpy, strlen, strdup
 
 from pysam.chtslib cimport *
+from pysam.cutils cimport IOStats
 
 
 cdef class VariantHeader(object):
@@ -140,6 +141,9 @@ cdef class TabixIterator(BaseIterator):
 cdef class VariantFile(object):
     cdef htsFile *htsfile                  # pointer to htsFile structure
     cdef int64_t  start_offset             # BGZF offset of first record
+    cdef hts_idx_t *write_idx              # index built while writing
+    cdef int      cache_size               # size of the block cache in bytes
+    cdef IOStats  io_stats                 # I/O counters, None unless profiling
 
     cdef readonly object     filename       # filename as supplied by user
     cdef readonly object     mode           # file opening mode
@@ -157,3 +161,4 @@ cdef class VariantFile(object):
     cdef readonly bint       is_reading    # true if file has begun reading records
 
     cpdef int write(self, VariantRecord record) except -1
+    cdef _profile(self, profile)
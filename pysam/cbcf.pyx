@@ -189,7 +189,7 @@ from __future__ import division, print_function
 import os
 import sys
 
-from libc.string cimport strcmp, strpbrk
+from libc.string cimport strcmp, strpbrk, memmove
 from libc.stdint cimport INT8_MAX, INT16_MAX, INT32_MAX
 
 cimport cython
@@ -211,7 +211,8 @@ from warnings         import warn
 __all__ = ['VariantFile',
            'VariantHeader',
            'VariantHeaderRecord',
-           'VariantRecord']
+           'VariantRecord',
+           'bcf_concat']
 
 ########################################################################
 ########################################################################
@@ -235,6 +236,7 @@ cdef tuple COMPRESSION = ('NONE', 'GZIP', 'BGZF', 'CUSTOM')
 
 from pysam.cutils cimport force_bytes, force_str, charptr_to_str, charptr_to_str_w_len
 from pysam.cutils cimport encode_filename, from_string_and_size
+from pysam.cutils cimport make_io_stats
 
 
 ########################################################################
@@ -1807,7 +1809,7 @@ cdef class VariantHeader(object):
                 'missing {:d} requested samples'.format(
                     len(missing_samples)))
 
-        keep_samples = force_bytes(b','.join(keep_samples))
+        keep_samples = force_bytes(','.join(force_str(s) for s in keep_samples))
         cdef char *keep = <char *>keep_samples if keep_samples else NULL
         cdef ret = bcf_hdr_set_samples(self.ptr, keep, 0)
 
@@ -3024,6 +3026,177 @@ cdef TabixIndex makeTabixIndex(tbx_t *idx):
     return index
 
 
+########################################################################
+########################################################################
+## Sample subset reading
+########################################################################
+
+
+cdef inline bint _hdr_subsets_samples(const bcf_hdr_t *hdr) nogil:
+    """true if samples have been removed by bcf_hdr_set_samples()"""
+    return hdr.keep_samples != NULL or (hdr.nsamples_ori and not bcf_hdr_nsamples(hdr))
+
+
+cdef inline bint _hdr_keeps_sample(const bcf_hdr_t *hdr, int i) nogil:
+    return hdr.keep_samples != NULL and i < hdr.nsamples_ori and \
+           (hdr.keep_samples[i >> 3] & (1 << (i & 7))) != 0
+
+
+cdef int _bgzf_skip(BGZF *fp, size_t length) nogil:
+    """advance fp by length uncompressed bytes without copying them"""
+    cdef size_t n, available
+
+    while length > 0:
+        if fp.block_offset >= fp.block_length:
+            if bgzf_read_block(fp) != 0 or fp.block_length <= fp.block_offset:
+                return -1
+        available = fp.block_length - fp.block_offset
+        n = length if length < available else available
+        fp.block_offset += n
+        fp.uncompressed_address += n
+        length -= n
+
+    # leave fp in the same state as bgzf_read() would
+    if fp.block_offset == fp.block_length:
+        fp.block_address = htell(fp.fp)
+        fp.block_offset = fp.block_length = 0
+
+    return 0
+
+
+cdef int _bgzf_copy_typed_int(BGZF *fp, kstring_t *s, int32_t *value) nogil:
+    """append a BCF typed integer read from fp to s and decode it into value"""
+    cdef uint8_t *p
+    cdef int t, size
+
+    if ks_resize(s, s.l + 5) < 0 or bgzf_read(fp, s.s + s.l, 1) != 1:
+        return -1
+
+    p = <uint8_t *>s.s + s.l
+    t = p[0] & 0xf
+    if t == BCF_BT_INT8:
+        size = 1
+    elif t == BCF_BT_INT16:
+        size = 2
+    elif t == BCF_BT_INT32:
+        size = 4
+    else:
+        return -1
+
+    if bgzf_read(fp, p + 1, size) != size:
+        return -1
+
+    if size == 1:
+        value[0] = (<int8_t *>(p + 1))[0]
+    elif size == 2:
+        value[0] = (<int16_t *>(p + 1))[0]
+    else:
+        value[0] = (<int32_t *>(p + 1))[0]
+
+    s.l += 1 + size
+    return 0
+
+
+cdef int _bcf_read_subset(BGZF *fp, const bcf_hdr_t *hdr, bcf1_t *v) nogil:
+    """read a BCF record, keeping only the FORMAT data of the samples
+    selected by bcf_hdr_set_samples().
+
+    BCF stores per-sample data FORMAT-major, so the values of unselected
+    samples are skipped field by field instead of being read in full and
+    compacted afterwards by bcf_subset_format().  Returns 0 on success,
+    -1 at end of file and -2 on error, as bcf_read().
+    """
+    cdef uint32_t x[8]
+    cdef uint32_t i, j, k, nsamples_ori
+    cdef int32_t key, n
+    cdef size_t size, length, consumed
+    cdef uint8_t *p
+    cdef bint keep
+    cdef ssize_t ret
+
+    ret = bgzf_read(fp, x, 32)
+    if ret != 32:
+        return -1 if ret == 0 else -2
+
+    bcf_clear1(v)
+    x[0] -= 24  # exclude the six 32-bit integers read above
+    if ks_resize(&v.shared, x[0]) < 0:
+        return -2
+
+    v.rid  = <int32_t>x[2]
+    v.pos  = <int32_t>x[3]
+    v.rlen = <int32_t>x[4]
+    memcpy(&v.qual, &x[5], 4)
+    v.n_allele = x[6] >> 16
+    v.n_info = x[6] & 0xffff
+    v.n_fmt = x[7] >> 24
+    nsamples_ori = x[7] & 0xffffff
+    v.shared.l = x[0]
+
+    if bgzf_read(fp, v.shared.s, v.shared.l) != <ssize_t>v.shared.l:
+        return -2
+
+    if not bcf_hdr_nsamples(hdr) or not nsamples_ori or not x[1]:
+        v.n_fmt = v.n_sample = 0
+        return 0 if _bgzf_skip(fp, x[1]) == 0 else -2
+
+    consumed = 0
+    for i in range(v.n_fmt):
+        length = v.indiv.l
+
+        # FORMAT key and value type, followed by nsamples_ori value vectors
+        if _bgzf_copy_typed_int(fp, &v.indiv, &key) < 0:
+            return -2
+        if ks_resize(&v.indiv, v.indiv.l + 1) < 0 or bgzf_read(fp, v.indiv.s + v.indiv.l, 1) != 1:
+            return -2
+        p = <uint8_t *>v.indiv.s + v.indiv.l
+        v.indiv.l += 1
+        n = p[0] >> 4
+        size = 1 << bcf_type_shift[p[0] & 0xf]
+        if n == 15 and _bgzf_copy_typed_int(fp, &v.indiv, &n) < 0:
+            return -2
+        if n < 0:
+            return -2
+        size *= n
+
+        consumed += v.indiv.l - length + nsamples_ori * size
+        if consumed > x[1]:
+            return -2
+        if ks_resize(&v.indiv, v.indiv.l + bcf_hdr_nsamples(hdr) * size) < 0:
+            return -2
+
+        # copy or skip runs of selected and unselected samples
+        j = 0
+        while j < nsamples_ori:
+            keep = _hdr_keeps_sample(hdr, j)
+            k = j + 1
+            while k < nsamples_ori and _hdr_keeps_sample(hdr, k) == keep:
+                k += 1
+            length = (k - j) * size
+            if keep:
+                if bgzf_read(fp, v.indiv.s + v.indiv.l, length) != <ssize_t>length:
+                    return -2
+                v.indiv.l += length
+            elif _bgzf_skip(fp, length) < 0:
+                return -2
+            j = k
+
+    if consumed != x[1]:
+        return -2
+
+    v.n_sample = bcf_hdr_nsamples(hdr)
+    return 0
+
+
+cdef int _bcf_readrec_subset(BGZF *fp, void *data, void *r, int *tid, int *beg, int *end) nogil:
+    """hts_readrec_func for BCF iterators, with the header passed as data"""
+    cdef bcf1_t *v = <bcf1_t *>r
+    cdef int ret = _bcf_read_subset(fp, <const bcf_hdr_t *>data, v)
+    if ret >= 0:
+        tid[0], beg[0], end[0] = v.rid, v.pos, v.pos + v.rlen
+    return ret
+
+
 ########################################################################
 ########################################################################
 ## Iterators
@@ -3089,6 +3262,10 @@ cdef class BCFIterator(BaseIterator):
 
         # Do not fail on self.iter == NULL, since it signifies a null query.
 
+        # skip unselected samples while reading rather than subsetting afterwards
+        if self.iter and _hdr_subsets_samples(bcf.header.ptr):
+            self.iter.readrec = _bcf_readrec_subset
+
         self.bcf = bcf
         self.index = index
 
@@ -3111,9 +3288,19 @@ cdef class BCFIterator(BaseIterator):
             record.max_unpack = BCF_UN_SHR
 
         cdef int ret
+        cdef double t = 0
+        cdef IOStats stats = self.bcf.io_stats
+
+        if stats is not None:
+            t = stats.start()
 
+        # the header is only used by _bcf_readrec_subset
         with nogil:
-            ret = bcf_itr_next(self.bcf.htsfile, self.iter, record)
+            ret = hts_itr_next(hts_get_bgzfp(self.bcf.htsfile), self.iter, record,
+                               <void *>self.bcf.header.ptr)
+
+        if stats is not None:
+            stats.stop(t, hts_get_bgzfp(self.bcf.htsfile), ret >= 0)
 
         if ret < 0:
             _stop_BCFIterator(self, record)
@@ -3122,12 +3309,8 @@ cdef class BCFIterator(BaseIterator):
             else:
                 raise ValueError('error reading BCF file')
 
-        ret = bcf_subset_format(self.bcf.header.ptr, record)
-
-        if ret < 0:
-            _stop_BCFIterator(self, record)
-            raise ValueError('error in bcf_subset_format')
-
+        if stats is not None:
+            stats.wrappers += 1
         return makeVariantRecord(self.bcf.header, record)
 
 
@@ -3192,10 +3375,18 @@ cdef class TabixIterator(BaseIterator):
             raise StopIteration
 
         cdef int ret
+        cdef double t = 0
+        cdef IOStats stats = self.bcf.io_stats
+
+        if stats is not None:
+            t = stats.start()
 
         with nogil:
             ret = tbx_itr_next(self.bcf.htsfile, self.index.ptr, self.iter, &self.line_buffer)
 
+        if stats is not None:
+            stats.stop(t, hts_get_bgzfp(self.bcf.htsfile), ret >= 0)
+
         if ret < 0:
             tbx_itr_destroy(self.iter)
             self.iter = NULL
@@ -3217,6 +3408,8 @@ cdef class TabixIterator(BaseIterator):
             bcf_destroy1(record)
             raise ValueError('error in vcf_parse')
 
+        if stats is not None:
+            stats.wrappers += 1
         return makeVariantRecord(self.bcf.header, record)
 
 
@@ -3227,7 +3420,8 @@ cdef class TabixIterator(BaseIterator):
 
 
 cdef class VariantFile(object):
-    """*(filename, mode=None, index_filename=None, header=None, drop_samples=False)*
+    """*(filename, mode=None, index_filename=None, header=None, drop_samples=False,
+    write_index=False, cache_size=0, profile=False)*
 
     A :term:`VCF`/:term:`BCF` formatted file. The file is automatically
     opened.
@@ -3254,9 +3448,26 @@ cdef class VariantFile(object):
 
     For writing, a :class:`VariantHeader` object must be provided, typically
     obtained from another :term:`VCF` file/:term:`BCF` file.
+
+    If *write_index* is set when writing a :term:`BCF` file, a CSI index
+    is built while records are written and saved on :meth:`close`, to
+    *index_filename* if given.  Records need to be written sorted by
+    position.
+
+    When reading a compressed file, *cache_size* bytes of decompressed
+    blocks can be kept in memory, so that regions fetched repeatedly or
+    close to each other are not decompressed again.  The cache is
+    disabled by default and has no effect unless it can hold more than
+    one 64kb block.  See :meth:`get_cache_statistics`.
+
+    If *profile* is set, the bytes read and written, the time spent and
+    the records and Python objects created are counted, see
+    :meth:`stats` and :class:`~pysam.IOProfiler`. Profiling is not
+    available if pysam has been built against an external htslib.
     """
     def __cinit__(self, *args, **kwargs):
         self.htsfile = NULL
+        self.write_idx = NULL
 
     def __init__(self, *args, **kwargs):
         self.header         = None
@@ -3269,6 +3480,7 @@ cdef class VariantFile(object):
         self.is_reading     = False
         self.drop_samples   = False
         self.start_offset   = -1
+        self.cache_size     = 0
 
         self.open(*args, **kwargs)
 
@@ -3276,6 +3488,9 @@ cdef class VariantFile(object):
         if self.htsfile:
             hts_close(self.htsfile)
             self.htsfile = NULL
+        if self.write_idx:
+            hts_idx_destroy(self.write_idx)
+            self.write_idx = NULL
 
     def __enter__(self):
         return self
@@ -3332,12 +3547,36 @@ cdef class VariantFile(object):
                 free(desc)
 
     def close(self):
-        """closes the :class:`pysam.VariantFile`."""
+        """closes the :class:`pysam.VariantFile`.
+
+        If an index has been built while writing, it is saved."""
+        cdef int ret = 0
+        cdef BGZF *bgzfp
+        cdef char *cfilename
+        cdef char *cindex_filename = NULL
+
+        if self.htsfile and self.write_idx:
+            bgzfp = hts_get_bgzfp(self.htsfile)
+            ret = bgzf_flush(bgzfp)
+            if ret == 0:
+                hts_idx_finish(self.write_idx, bgzf_tell(bgzfp))
+                cfilename = self.filename
+                if self.index_filename is not None:
+                    cindex_filename = self.index_filename
+                with nogil:
+                    ret = hts_idx_save_as(self.write_idx, cfilename, cindex_filename, HTS_FMT_CSI)
+
+        if self.write_idx:
+            hts_idx_destroy(self.write_idx)
+            self.write_idx = NULL
         if self.htsfile:
             hts_close(self.htsfile)
             self.htsfile = NULL
         self.header = self.index = None
 
+        if ret < 0:
+            raise IOError('could not save index for `{}`'.format(self.filename))
+
     property is_open:
         def __get__(self):
             """return True if VariantFile is open and in a valid state."""
@@ -3362,8 +3601,18 @@ cdef class VariantFile(object):
         if self.drop_samples:
             record.max_unpack = BCF_UN_SHR
 
+        cdef double t = 0
+        if self.io_stats is not None:
+            t = self.io_stats.start()
+
         with nogil:
-            ret = bcf_read1(self.htsfile, self.header.ptr, record)
+            if self.htsfile.format.format == bcf and _hdr_subsets_samples(self.header.ptr):
+                ret = _bcf_read_subset(hts_get_bgzfp(self.htsfile), self.header.ptr, record)
+            else:
+                ret = bcf_read1(self.htsfile, self.header.ptr, record)
+
+        if self.io_stats is not None:
+            self.io_stats.stop(t, hts_get_bgzfp(self.htsfile), ret >= 0)
 
         if ret < 0:
             bcf_destroy1(record)
@@ -3374,6 +3623,8 @@ cdef class VariantFile(object):
             else:
                 raise ValueError('Variant read failed')
 
+        if self.io_stats is not None:
+            self.io_stats.wrappers += 1
         return makeVariantRecord(self.header, record)
 
     def copy(self):
@@ -3393,6 +3644,10 @@ cdef class VariantFile(object):
         if not vars.htsfile:
             raise ValueError('Cannot re-open htsfile')
 
+        if self.io_stats is not None:
+            vars.io_stats = self.io_stats.child()
+            vars.io_stats.profile(pysam_hts_get_hfile(vars.htsfile))
+
         # minimize overhead by re-using header and index.  This approach is
         # currently risky, but see above for how this can be mitigated.
         vars.header         = self.header
@@ -3406,6 +3661,10 @@ cdef class VariantFile(object):
         vars.is_remote      = self.is_remote
         vars.is_reading     = self.is_reading
         vars.start_offset   = self.start_offset
+        vars.cache_size     = self.cache_size
+
+        if self.cache_size > 0:
+            bgzf_set_cache_size(hts_get_bgzfp(vars.htsfile), self.cache_size)
 
         if self.htsfile.is_bin:
             vars.seek(self.tell())
@@ -3419,7 +3678,10 @@ cdef class VariantFile(object):
     def open(self, filename, mode='rb',
              index_filename=None,
              VariantHeader header=None,
-             drop_samples=False):
+             drop_samples=False,
+             write_index=False,
+             cache_size=0,
+             profile=False):
         """open a vcf/bcf file.
 
         If open is called on an existing VariantFile, the current file will be
@@ -3432,6 +3694,8 @@ cdef class VariantFile(object):
         cdef char *cfilename
         cdef char *cindex_filename = NULL
         cdef char *cmode
+        cdef int i, n_lvls
+        cdef int64_t max_len, s
 
         # close a previously opened file
         if self.is_open:
@@ -3452,15 +3716,22 @@ cdef class VariantFile(object):
             self.index_filename = None
         self.drop_samples = bool(drop_samples)
         self.header = None
+        self.cache_size = 0
+
+        if cache_size < 0:
+            raise ValueError('invalid cache size {}'.format(cache_size))
 
         self.is_remote = hisremote(filename)
         self.is_stream = filename == b'-'
 
         if mode.startswith(b'w'):
             # open file for writing
-            if index_filename is not None:
+            if index_filename is not None and not write_index:
                 raise ValueError('Cannot specify an index filename when writing a VCF/BCF file')
 
+            if write_index and (b'b' not in mode or self.is_stream):
+                raise ValueError('an index can only be built while writing a BCF file')
+
             # header structure (used for writing)
             if header:
                 self.header = header.copy()
@@ -3477,9 +3748,32 @@ cdef class VariantFile(object):
             if not self.htsfile:
                 raise ValueError("could not open file `{}` (mode='{}')".format((filename, mode)))
 
+            self._profile(profile)
+
             with nogil:
                 bcf_hdr_write(self.htsfile, self.header.ptr)
 
+            if write_index:
+                # choose the number of CSI levels to span the longest
+                # contig, as done in bcf_index() in vcf.c
+                hdr = self.header.ptr
+                max_len = 0
+                for i in range(hdr.n[BCF_DT_CTG]):
+                    max_len = max(max_len, hdr.id[BCF_DT_CTG][i].val.info[0])
+                if not max_len:
+                    max_len = (1 << 31) - 1
+                max_len += 256
+                n_lvls, s = 0, 1 << 14
+                while max_len > s:
+                    n_lvls += 1
+                    s <<= 3
+
+                self.write_idx = hts_idx_init(hdr.n[BCF_DT_CTG], HTS_FMT_CSI,
+                                              bgzf_tell(hts_get_bgzfp(self.htsfile)),
+                                              14, n_lvls)
+                if not self.write_idx:
+                    raise MemoryError('could not allocate index')
+
         elif mode.startswith(b'r'):
             # open file for reading
             if filename != b'-' and not self.is_remote and not os.path.exists(filename):
@@ -3492,6 +3786,8 @@ cdef class VariantFile(object):
             if not self.htsfile:
                 raise ValueError("could not open file `{}` (mode='{}') - is it VCF/BCF format?".format(filename, mode))
 
+            self._profile(profile)
+
             if self.htsfile.format.format not in (bcf, vcf):
                 raise ValueError("invalid file `{}` (mode='{}') - is it VCF/BCF format?".format(filename, mode))
 
@@ -3499,6 +3795,9 @@ cdef class VariantFile(object):
                 bgzfp = hts_get_bgzfp(self.htsfile)
                 if bgzfp and bgzf_check_EOF(bgzfp) == 0:
                     warn('[%s] Warning: no BGZF EOF marker; file may be truncated'.format(filename))
+                if bgzfp != NULL and cache_size > 0:
+                    self.cache_size = cache_size
+                    bgzf_set_cache_size(bgzfp, cache_size)
 
             with nogil:
                 hdr = bcf_hdr_read(self.htsfile)
@@ -3528,6 +3827,54 @@ cdef class VariantFile(object):
         else:
             raise ValueError("unknown mode {}".format(mode))
 
+    def get_cache_statistics(self):
+        """return a dictionary describing the block cache.
+
+        *cache_size* is the size of the cache in bytes and *blocks* the
+        number of decompressed blocks it currently holds.  *blocks* is
+        None if pysam has been built against an external htslib, as its
+        cache can not be inspected.
+
+        The cache is htslib's BGZF block cache.  It is unordered: when
+        it is full, an arbitrary block is evicted rather than the least
+        recently used one.  htslib does not count cache hits.
+
+        Iterators obtained with *reopen* use a cache of their own and
+        are not included.
+        """
+        if not self.is_open:
+            raise ValueError('I/O operation on closed file')
+
+        if not PYSAM_HTSLIB_INTERNALS:
+            return {'cache_size': self.cache_size,
+                    'blocks': None}
+
+        cdef int blocks = 0
+        if self.htsfile.format.compression == bgzf:
+            blocks = pysam_bgzf_cache_nblocks(hts_get_bgzfp(self.htsfile))
+
+        return {'cache_size': self.cache_size,
+                'blocks': blocks}
+
+    def stats(self):
+        """return a dictionary with the I/O counters of a file opened with
+        *profile* set.
+
+        See :meth:`pysam.AlignmentFile.stats` for a description of the
+        counters.  Counters include the copies of the file opened by
+        :meth:`fetch`.  Statistics are available after the file has been
+        closed.
+        """
+        if self.io_stats is None:
+            raise ValueError('file has not been opened with profile=True')
+        return self.io_stats.to_dict()
+
+    cdef _profile(self, profile):
+        """start profiling the opened file if requested."""
+        self.io_stats = make_io_stats(profile)
+        if self.io_stats is not None:
+            self.io_stats.profile(pysam_hts_get_hfile(self.htsfile))
+
     def reset(self):
         """reset file position to beginning of file just after the header."""
         return self.seek(self.start_offset, 0)
@@ -3621,19 +3968,39 @@ cdef class VariantFile(object):
         #    raise ValueError('Writing records from a different VariantFile is not yet supported')
 
         cdef int ret
+        cdef double t = 0
+
+        if self.io_stats is not None:
+            t = self.io_stats.start()
 
         with nogil:
             ret = bcf_write1(self.htsfile, self.header.ptr, record.ptr)
 
+        if self.io_stats is not None:
+            self.io_stats.stop(t, pysam_hts_get_bgzf(self.htsfile), ret >= 0)
+
         if ret < 0:
             raise ValueError('write failed')
 
+        if self.write_idx:
+            if hts_idx_push(self.write_idx, record.ptr.rid, record.ptr.pos,
+                            record.ptr.pos + record.ptr.rlen,
+                            bgzf_tell(hts_get_bgzfp(self.htsfile)), 1) < 0:
+                # an incomplete index must not be saved
+                hts_idx_destroy(self.write_idx)
+                self.write_idx = NULL
+                raise ValueError('records are not sorted by position, cannot build index')
+
         return ret
 
     def subset_samples(self, include_samples):
         """
         Read only a subset of samples to reduce processing time and memory.
         Must be called prior to retrieving records.
+
+        The FORMAT data of the remaining samples is skipped while records
+        are parsed, so that the cost of reading a record depends on the
+        number of selected samples rather than on the size of the file.
         """
         if not self.is_open:
             raise ValueError('I/O operation on closed file')
@@ -3650,3 +4017,337 @@ cdef class VariantFile(object):
         # potentially unnecessary optimization that also sets max_unpack
         if not include_samples:
             self.drop_samples = True
+
+
+########################################################################
+########################################################################
+## Utilities
+########################################################################
+
+# empty BGZF block marking the end of a file
+cdef bytes BGZF_EOF = (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00'
+                       b'\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00'
+                       b'\x00\x00\x00\x00')
+
+
+cdef int _detect_variant_format(filename) except -1:
+    """return the htslib format code (bcf or vcf) of *filename*."""
+    cdef char *cfilename = filename
+    cdef htsFile *fp
+    cdef htsExactFormat fmt
+
+    with nogil:
+        fp = hts_open(cfilename, 'r')
+    if fp == NULL:
+        raise IOError("could not open file `{}`".format(filename))
+
+    fmt = fp.format.format
+    hts_close(fp)
+
+    if fmt not in (bcf, vcf):
+        raise ValueError("invalid file `{}` - is it VCF/BCF format?".format(filename))
+    return fmt
+
+
+cdef bytes _bgzf_read_variant_header(BGZF *fp, int fmt):
+    """read the header of a BGZF compressed VCF or BCF file.
+
+    Returns the header exactly as it is stored in the uncompressed
+    stream. *fp* is left positioned at the first record.
+    """
+    cdef char magic[5]
+    cdef uint32_t hlen
+    cdef char *htxt
+    cdef kstring_t line
+    cdef list lines
+
+    if fmt == bcf:
+        if bgzf_read(fp, magic, 5) != 5 or memcmp(magic, b'BCF\2', 4) != 0:
+            raise ValueError('invalid BCF header')
+        if bgzf_read(fp, &hlen, 4) != 4:
+            raise ValueError('invalid BCF header')
+        htxt = <char *>malloc(hlen)
+        if htxt == NULL:
+            raise MemoryError('could not allocate {} bytes'.format(hlen))
+        try:
+            if bgzf_read(fp, htxt, hlen) != hlen:
+                raise ValueError('truncated BCF header')
+            return magic[:5] + (<char *>&hlen)[:4] + htxt[:hlen]
+        finally:
+            free(htxt)
+
+    line.l = line.m = 0
+    line.s = NULL
+    lines = []
+    try:
+        while bgzf_getline(fp, b'\n', &line) >= 0:
+            if line.l == 0:
+                continue
+            if line.s[0] != b'#':
+                raise ValueError('no sample line in VCF header')
+            lines.append(line.s[:line.l])
+            if line.l < 2 or line.s[1] != b'#':
+                break
+        else:
+            raise ValueError('truncated VCF header')
+    finally:
+        free(line.s)
+
+    lines.append(b'')
+    return b'\n'.join(lines)
+
+
+cdef _remove_output(output):
+    """remove the partially written *output* of a failed
+    concatenation."""
+    try:
+        os.unlink(output)
+    except OSError:
+        pass
+
+
+cdef _naive_concat(list filenames, output, int fmt):
+    """copy the BGZF blocks of *filenames* to *output* without
+    recompressing them."""
+    cdef BGZF *src
+    cdef BGZF *dst
+    cdef char *cfilename
+    cdef char *buf
+    cdef ssize_t nread, nheld, nbuffer = 65536
+    cdef int eof_len = len(BGZF_EOF)
+    cdef bytes first_header = None, header
+    cdef char *ceof = BGZF_EOF
+
+    cfilename = output
+    with nogil:
+        dst = bgzf_open(cfilename, 'w')
+    if dst == NULL:
+        raise IOError("could not open file `{}` for writing".format(force_str(output)))
+
+    buf = <char *>malloc(nbuffer + eof_len)
+    if buf == NULL:
+        bgzf_close(dst)
+        _remove_output(output)
+        raise MemoryError('could not allocate {} bytes'.format(nbuffer))
+
+    try:
+        for filename in filenames:
+            cfilename = filename
+            with nogil:
+                src = bgzf_open(cfilename, 'r')
+            if src == NULL:
+                raise IOError("could not open file `{}`".format(force_str(filename)))
+
+            try:
+                if not src.is_compressed or src.is_gzip:
+                    raise ValueError('file `{}` is not BGZF compressed'.format(force_str(filename)))
+
+                header = _bgzf_read_variant_header(src, fmt)
+
+                if first_header is None:
+                    first_header = header
+                    if bgzf_write(dst, <char *>header, len(header)) < 0:
+                        raise IOError('writing failed')
+                elif header != first_header:
+                    raise ValueError('header of `{}` differs from header of `{}`, '
+                                     'naive concatenation requires identical '
+                                     'headers'.format(force_str(filename),
+                                                      force_str(filenames[0])))
+
+                # records sharing the last header block need to be
+                # recompressed, all later blocks are copied verbatim
+                if src.block_offset < src.block_length:
+                    if bgzf_write(dst, <char *>src.uncompressed_block + src.block_offset,
+                                  src.block_length - src.block_offset) < 0:
+                        raise IOError('writing failed')
+
+                if bgzf_flush(dst) < 0:
+                    raise IOError('writing failed')
+
+                # hold back the trailing bytes of the stream so that the
+                # EOF marker of each file can be dropped
+                nheld = 0
+                while 1:
+                    with nogil:
+                        nread = bgzf_raw_read(src, buf + nheld, nbuffer)
+                    if nread < 0:
+                        raise IOError('error reading file `{}`'.format(force_str(filename)))
+                    if nread == 0:
+                        break
+                    nheld += nread
+                    if nheld > eof_len:
+                        with nogil:
+                            nread = bgzf_raw_write(dst, buf, nheld - eof_len)
+                        if nread < 0:
+                            raise IOError('writing failed')
+                        memmove(buf, buf + nheld - eof_len, eof_len)
+                        nheld = eof_len
+
+                if nheld and (nheld != eof_len or memcmp(buf, ceof, eof_len) != 0):
+                    if bgzf_raw_write(dst, buf, nheld) < 0:
+                        raise IOError('writing failed')
+            finally:
+                bgzf_close(src)
+    except:
+        # close without masking the original error
+        bgzf_close(dst)
+        _remove_output(output)
+        raise
+    finally:
+        free(buf)
+
+    # writes the final EOF marker
+    if bgzf_close(dst) < 0:
+        _remove_output(output)
+        raise IOError('error closing file `{}`'.format(force_str(output)))
+
+
+cdef _record_concat(list filenames, output, int fmt):
+    """concatenate *filenames* into *output* by re-encoding every
+    record against a merged header."""
+    cdef int i, j, ret, n = len(filenames)
+    cdef htsFile **files = <htsFile **>calloc(n, sizeof(htsFile *))
+    cdef bcf_hdr_t **headers = <bcf_hdr_t **>calloc(n, sizeof(bcf_hdr_t *))
+    cdef htsFile *dst = NULL
+    cdef bcf_hdr_t *out_hdr = NULL
+    cdef bcf1_t *record = NULL
+    cdef char *cfilename
+    cdef char *cmode
+
+    if files == NULL or headers == NULL:
+        free(files)
+        free(headers)
+        raise MemoryError('could not allocate file handles')
+
+    try:
+        for i in range(n):
+            cfilename = filenames[i]
+            with nogil:
+                files[i] = hts_open(cfilename, 'r')
+            if files[i] == NULL:
+                raise IOError("could not open file `{}`".format(force_str(filenames[i])))
+            with nogil:
+                headers[i] = bcf_hdr_read(files[i])
+            if headers[i] == NULL:
+                raise ValueError("file `{}` does not have valid header".format(force_str(filenames[i])))
+
+            if i == 0:
+                out_hdr = bcf_hdr_dup(headers[i])
+                continue
+
+            if bcf_hdr_nsamples(headers[i]) != bcf_hdr_nsamples(out_hdr):
+                raise ValueError('samples of `{}` differ from samples of `{}`'.format(
+                    force_str(filenames[i]), force_str(filenames[0])))
+            for j in range(bcf_hdr_nsamples(out_hdr)):
+                if strcmp(headers[i].samples[j], out_hdr.samples[j]) != 0:
+                    raise ValueError('samples of `{}` differ from samples of `{}`'.format(
+                        force_str(filenames[i]), force_str(filenames[0])))
+            out_hdr = bcf_hdr_merge(out_hdr, headers[i])
+
+        bcf_hdr_sync(out_hdr)
+
+        cfilename = output
+        cmode = b'wb' if fmt == bcf else b'wz'
+        with nogil:
+            dst = hts_open(cfilename, cmode)
+        if dst == NULL:
+            raise IOError("could not open file `{}` for writing".format(force_str(output)))
+        if bcf_hdr_write(dst, out_hdr) < 0:
+            raise IOError('writing failed')
+
+        record = bcf_init1()
+        for i in range(n):
+            while 1:
+                with nogil:
+                    ret = bcf_read1(files[i], headers[i], record)
+                if ret == -1:
+                    break
+                elif ret < 0:
+                    raise IOError('error reading file `{}`'.format(force_str(filenames[i])))
+                if i > 0 and bcf_translate(out_hdr, headers[i], record) < 0:
+                    raise ValueError('could not translate record of `{}`'.format(
+                        force_str(filenames[i])))
+                with nogil:
+                    ret = bcf_write1(dst, out_hdr, record)
+                if ret < 0:
+                    raise IOError('writing failed')
+    except:
+        if dst != NULL:
+            # close without masking the original error
+            hts_close(dst)
+            _remove_output(output)
+        raise
+    finally:
+        if record != NULL:
+            bcf_destroy1(record)
+        for i in range(n):
+            if headers[i] != NULL:
+                bcf_hdr_destroy(headers[i])
+            if files[i] != NULL:
+                hts_close(files[i])
+        free(headers)
+        free(files)
+        if out_hdr != NULL:
+            bcf_hdr_destroy(out_hdr)
+
+    if hts_close(dst) < 0:
+        _remove_output(output)
+        raise IOError('error closing file `{}`'.format(force_str(output)))
+
+
+def bcf_concat(inputs, output, naive=True, index=True):
+    """concatenate the :term:`VCF`/:term:`BCF` files *inputs* into
+    *output*.
+
+    All inputs need to be of the same format, which will also be the
+    format of *output*: :term:`BCF` or bgzip-compressed :term:`VCF`. The
+    files are appended in the order given, thus to obtain a sorted
+    output the inputs need to be sorted and non-overlapping, for
+    example the per-chunk output of parallel workers.
+
+    If *naive* is set, the compressed BGZF blocks of each input are
+    copied byte for byte to *output*, dropping the EOF markers in
+    between.  Only the block containing the end of the header is
+    recompressed.  This requires the headers of all inputs to be
+    identical.
+
+    Otherwise, each record is decoded and re-encoded against a merged
+    header.  The inputs need to contain the same samples.
+
+    If *index* is set, *output* will be indexed: a CSI index is built
+    for :term:`BCF` and a tabix index for :term:`VCF` files.
+
+    returns the filename of the output.
+    """
+    cdef char *cfilename
+    cdef int fmt, ret
+
+    filenames = [encode_filename(x) for x in inputs]
+    if not filenames:
+        raise ValueError('no input files given')
+
+    formats = set(_detect_variant_format(x) for x in filenames)
+    if len(formats) != 1:
+        raise ValueError('can not concatenate VCF and BCF files')
+    fmt = formats.pop()
+
+    fn = encode_filename(output)
+    if fn in filenames:
+        raise ValueError('output `{}` is also an input file'.format(output))
+
+    if naive:
+        _naive_concat(filenames, fn, fmt)
+    else:
+        _record_concat(filenames, fn, fmt)
+
+    if index:
+        cfilename = fn
+        with nogil:
+            if fmt == bcf:
+                ret = bcf_index_build(cfilename, 14)
+            else:
+                ret = tbx_index_build(cfilename, 0, &tbx_conf_vcf)
+        if ret < 0:
+            raise IOError('building of index for `{}` failed'.format(output))
+
+    return output
@@ -7,6 +7,7 @@ cimport cython
 
 from cpython cimport array
 from pysam.chtslib cimport faidx_t, gzFile, kstring_t
+from pysam.cutils cimport IOStats
 
 # These functions are put here and not in chtslib.pxd in order
 # to avoid warnings for unused functions.
@@ -41,9 +42,22 @@ cdef class FastaFile:
     cdef bint is_remote
     cdef object _filename, _references, _lengths, reference2length
     cdef faidx_t* fastafile
+    # I/O counters, None unless profiling
+    cdef IOStats io_stats
     cdef char* _fetch(self, char* reference,
                       int start, int end, int* length)
 
+    # window of sequence kept for lookups of nearby regions,
+    # see _fetch_window
+    cdef char * window
+    cdef char * window_reference
+    cdef int window_start
+    cdef int window_length
+    cdef bint window_at_end
+    cdef readonly int window_size
+    cdef char* _fetch_window(self, char* reference,
+                             int start, int end, int* length)
+
 
 cdef class FastqProxy:
     cdef kseq_t * _delegate
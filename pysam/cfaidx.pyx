@@ -56,15 +56,17 @@ from cpython cimport PyErr_SetString, \
     PyBytes_FromStringAndSize
 
 from cpython.version cimport PY_MAJOR_VERSION
+from libc.string cimport strcmp
 
 from pysam.chtslib cimport \
     faidx_nseq, fai_load, fai_destroy, fai_fetch, \
     faidx_seq_len, \
-    faidx_fetch_seq, gzopen, gzclose, hisremote
+    faidx_fetch_seq, gzopen, gzclose, hisremote, pysam_fai_get_bgzf
 
 from pysam.cutils cimport force_bytes, force_str, charptr_to_str
 from pysam.cutils cimport encode_filename, from_string_and_size
 from pysam.cutils cimport qualitystring_to_array, parse_region
+from pysam.cutils cimport make_io_stats
 
 cdef class FastqProxy
 cdef makeFastqProxy(kseq_t * src):
@@ -93,6 +95,17 @@ cdef class FastaFile:
         Optional, filename of the index. By default this is
         the filename + ".fai".
 
+    profile : bool
+        Count the bytes read, the time spent and the sequences
+        fetched. See :meth:`stats` and :class:`~pysam.IOProfiler`.
+        Not available if pysam has been built against an external
+        htslib.
+
+    window_size : int
+        Minimum number of bases kept in memory for looking up the
+        reference of aligned reads, see
+        :meth:`pysam.AlignedSegment.get_reference_sequence`.
+
     Raises
     ------
 
@@ -106,6 +119,8 @@ cdef class FastaFile:
 
     def __cinit__(self, *args, **kwargs):
         self.fastafile = NULL
+        self.window = NULL
+        self.window_reference = NULL
         self._filename = None
         self._references = None
         self._lengths = None
@@ -122,7 +137,8 @@ cdef class FastaFile:
 
         return faidx_nseq(self.fastafile)
 
-    def _open(self, filename, filepath_index=None):
+    def _open(self, filename, filepath_index=None, profile=False,
+              window_size=65536):
         '''open an indexed fasta file.
 
         This method expects an indexed fasta file.
@@ -132,6 +148,8 @@ cdef class FastaFile:
         if self.fastafile != NULL:
             self.close()
 
+        self.window_size = window_size
+
         self._filename = encode_filename(filename)
         cdef char *cfilename = self._filename
         self.is_remote = hisremote(cfilename)
@@ -148,6 +166,10 @@ cdef class FastaFile:
         if self.fastafile == NULL:
             raise IOError("could not open file `%s`" % filename)
 
+        self.io_stats = make_io_stats(profile)
+        if self.io_stats is not None:
+            self.io_stats.profile(pysam_fai_get_bgzf(self.fastafile).fp)
+
         if self.is_remote:
             filepath_index = os.path.basename(
                 re.sub("[^:]+:[/]*", "", filename)) + ".fai"
@@ -169,10 +191,27 @@ cdef class FastaFile:
         if self.fastafile != NULL:
             fai_destroy(self.fastafile)
             self.fastafile = NULL
+        free(self.window)
+        free(self.window_reference)
+        self.window = NULL
+        self.window_reference = NULL
 
     def __dealloc__(self):
         self.close()
 
+    def stats(self):
+        """return a dictionary with the I/O counters of a file opened
+        with *profile* set.
+
+        See :meth:`pysam.AlignmentFile.stats` for a description of the
+        counters. *records* counts the sequences fetched and
+        *wrappers* those returned as Python strings. Statistics are
+        available after the file has been closed.
+        """
+        if self.io_stats is None:
+            raise ValueError("file has not been opened with profile=True")
+        return self.io_stats.to_dict()
+
     # context manager interface
     def __enter__(self):
         return self
@@ -271,6 +310,10 @@ cdef class FastaFile:
         if rstart >= length:
             return ""
 
+        cdef double t = 0
+        if self.io_stats is not None:
+            t = self.io_stats.start()
+
         # fai_fetch adds a '\0' at the end
         with nogil:
             seq = faidx_fetch_seq(self.fastafile,
@@ -279,10 +322,16 @@ cdef class FastaFile:
                                   rend-1,
                                   &length)
 
+        if self.io_stats is not None:
+            self.io_stats.stop(t, pysam_fai_get_bgzf(self.fastafile),
+                               seq != NULL)
+
         if seq == NULL:
             raise ValueError(
                 "failure when retrieving sequence on '%s'" % reference)
 
+        if self.io_stats is not None:
+            self.io_stats.wrappers += 1
         try:
             return charptr_to_str(seq)
         finally:
@@ -290,13 +339,63 @@ cdef class FastaFile:
 
     cdef char * _fetch(self, char * reference, int start, int end, int * length):
         '''fetch sequence for reference, start and end'''
+        cdef char *seq
+        cdef double t = 0
+        if self.io_stats is not None:
+            t = self.io_stats.start()
 
         with nogil:
-            return faidx_fetch_seq(self.fastafile,
-                                   reference,
-                                   start,
-                                   end-1,
-                                   length)
+            seq = faidx_fetch_seq(self.fastafile,
+                                  reference,
+                                  start,
+                                  end-1,
+                                  length)
+
+        if self.io_stats is not None:
+            self.io_stats.stop(t, pysam_fai_get_bgzf(self.fastafile),
+                               seq != NULL)
+        return seq
+
+    cdef char * _fetch_window(self, char * reference, int start, int end,
+                              int * length):
+        '''return pointer to the sequence for reference, starting at
+        start.
+
+        The sequence is served from a window of at least *window_size*
+        bases that is kept across calls, so that lookups of nearby
+        regions, for example of the reads in a sorted alignment file,
+        read the file only once per window. The pointer is valid until
+        the next call.
+
+        *length* is set to the number of bases available up to end,
+        which is less than end - start at the end of the reference.
+        Returns NULL if the sequence could not be retrieved.
+        '''
+        cdef int window_end = self.window_start + self.window_length
+        if self.window != NULL and \
+           strcmp(self.window_reference, reference) == 0 and \
+           start >= self.window_start and start <= window_end and \
+           (end <= window_end or self.window_at_end):
+            length[0] = min(end, window_end) - start
+            return self.window + (start - self.window_start)
+
+        free(self.window)
+        free(self.window_reference)
+        self.window = NULL
+        self.window_reference = strdup(reference)
+        window_end = max(end, start + self.window_size)
+        self.window = self._fetch(reference, start, window_end,
+                                  &self.window_length)
+        if self.window == NULL or self.window_length < 0:
+            free(self.window)
+            self.window = NULL
+            return NULL
+        self.window_start = start
+        # fewer bases than requested are returned at the end
+        # of the reference
+        self.window_at_end = self.window_length < window_end - start
+        length[0] = min(end - start, self.window_length)
+        return self.window
 
     def get_reference_length(self, reference):
         '''return the length of reference.'''
@@ -28,6 +28,9 @@ cdef extern from "htslib/kstring.h" nogil:
         size_t l, m
         char *s
 
+    int ks_resize(kstring_t *s, size_t size)
+    int kputsn(const char *p, int l, kstring_t *s)
+
 
 cdef extern from "htslib_util.h" nogil:
     int hts_set_verbosity(int verbosity)
@@ -48,7 +51,7 @@ cdef extern from "htslib_util.h" nogil:
     ctypedef struct s2i_t:
         khint_t n_buckets, size, n_occupied, upper_bound
         khint32_t *flags
-        const char *keys
+        const char **keys
         int64_t *vals
 
     # Generic khash methods
@@ -62,6 +65,12 @@ cdef extern from "htslib_util.h" nogil:
     const char *kh_key_vdict "kh_key" (vdict_t *d, khint_t i)
     bcf_idinfo_t kh_val_vdict "kh_val" (vdict_t *d, khint_t i)
 
+    # Specialized khash methods for s2i
+    s2i_t *kh_init_s2i()
+    void kh_destroy_s2i(s2i_t *d)
+    khint_t kh_get_s2i(s2i_t *d, const char *key)
+    khint_t kh_put_s2i(s2i_t *d, const char *key, int *ret)
+
 
 cdef extern from "htslib/hfile.h" nogil:
     ctypedef struct hFILE
@@ -159,6 +168,8 @@ cdef extern from "htslib/bgzf.h" nogil:
         int           is_compressed
         int           is_gzip
         int           cache_size
+        int           block_length
+        int           block_offset
         int64_t       block_address
         int64_t       uncompressed_address
         void         *uncompressed_block
@@ -574,11 +585,11 @@ cdef extern from "htslib/hts.h" nogil:
     ctypedef struct hts_itr_t:
         uint32_t read_rest
         uint32_t finished
-        int tid, bed, end, n_off, i
+        int tid, beg, end, n_off, i
         int curr_tid, curr_beg, curr_end
         uint64_t curr_off
         hts_pair64_t *off
-        hts_readrec_func *readfunc
+        hts_readrec_func *readrec
         hts_bins_t bins
 
     hts_idx_t *hts_idx_init(int n, int fmt, uint64_t offset0, int min_shift, int n_lvls)
@@ -698,6 +709,31 @@ cdef extern from "htslib/hts.h" nogil:
     inline void *ed_swap_8p(void *x)
 
 
+cdef extern from "htslib_util.h" nogil:
+    # set if structures private to htslib can be accessed
+    int PYSAM_HTSLIB_INTERNALS
+
+    # Block cache of BGZF files, see bgzf_set_cache_size
+    int pysam_bgzf_cache_nblocks(BGZF *fp)
+
+    # Profiling of file I/O, see IOStats in cutils.pyx
+    ctypedef struct pysam_io_stats_t:
+        int64_t bytes_read
+        int64_t bytes_written
+        int64_t read_calls
+        int64_t write_calls
+        int64_t seeks
+        int64_t blocks
+        int64_t uncompressed_bytes
+        double io_seconds
+
+    int pysam_hfile_profile(hFILE *fp, pysam_io_stats_t *stats)
+    void pysam_bgzf_profile_update(BGZF *fp)
+    hFILE *pysam_hts_get_hfile(htsFile *fp)
+    BGZF *pysam_hts_get_bgzf(htsFile *fp)
+    double pysam_clock()
+
+
 cdef extern from "htslib/sam.h" nogil:
     #**********************
     #*** SAM/BAM header ***
@@ -1099,6 +1135,11 @@ cdef extern from "htslib/faidx.h" nogil:
     int faidx_seq_len(faidx_t *fai, const char *seq)
 
 
+cdef extern from "htslib_util.h" nogil:
+    # BGZF stream of an indexed fasta file
+    BGZF *pysam_fai_get_bgzf(faidx_t *fai)
+
+
 # tabix support
 cdef extern from "htslib/tbx.h" nogil:
 
@@ -1129,6 +1170,7 @@ cdef extern from "htslib/tbx.h" nogil:
     hts_itr_t * tbx_itr_queryi(tbx_t * t, int tid, int bed, int end)
     hts_itr_t * tbx_itr_querys(tbx_t * t, char * s)
     int tbx_itr_next(htsFile * fp, tbx_t * t, hts_itr_t * iter, void * data)
+    int tbx_readrec(BGZF *fp, void *tbxv, void *sv, int *tid, int *beg, int *end)
 
     int tbx_name2id(tbx_t *tbx, char *ss)
 
@@ -0,0 +1,8 @@
+HTSLIB = "builtin"
+ENABLE_PLUGINS = 0
+HAVE_COMMONCRYPTO = 0
+HAVE_GMTIME_R = 1
+HAVE_HMAC = 1
+HAVE_IRODS = 0
+HAVE_LIBCURL = 1
+HAVE_MMAP = 1
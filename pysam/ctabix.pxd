@@ -14,7 +14,9 @@ cdef extern from "unistd.h" nogil:
     int close(int fd)
 
 from pysam.chtslib cimport hts_idx_t, hts_itr_t, htsFile, \
-    gzFile, tbx_t, kstring_t
+    gzFile, tbx_t, kstring_t, BGZF, tbx_conf_t
+from pysam.cutils cimport IOStats
+from pysam.ctabixproxies cimport StringCache
 
 # These functions are put here and not in chtslib.pxd in order
 # to avoid warnings for unused functions.
@@ -46,6 +48,55 @@ cdef extern from "pysam_stream.h" nogil:
                     int * dret)
 
 
+# Building a tabix index while compressing
+cdef extern from "tabix_util.h" nogil:
+
+    ctypedef struct tabix_indexer_t:
+        tbx_t *tbx
+        int fmt
+        int64_t lineno
+
+    tabix_indexer_t *tabix_indexer_init(const tbx_conf_t *conf, int min_shift)
+    int tabix_indexer_write(tabix_indexer_t *w, BGZF *fp,
+                            char *buffer, size_t length)
+    int tabix_indexer_finish(tabix_indexer_t *w, BGZF *fp)
+    void tabix_indexer_destroy(tabix_indexer_t *w)
+
+    int tabix_index_window_sizes(const hts_idx_t *idx, int tid,
+                                 int64_t **sizes, int *min_shift)
+
+    # Reading on a separate thread
+    ctypedef struct tabix_reader_t:
+        pass
+
+    ctypedef struct tabix_chunk_t:
+        char *data
+        size_t *offsets
+        int n
+
+    tabix_reader_t *tabix_reader_open(int fd, size_t chunk_size, int nchunks)
+    int tabix_reader_next(tabix_reader_t *r, tabix_chunk_t **chunk)
+    void tabix_reader_close(tabix_reader_t *r)
+
+    # Overlap queries on intervals in memory
+    ctypedef struct tabix_intervals_t:
+        int64_t *starts
+        int64_t *ends
+        int64_t *maxends
+        long *ids
+        long n
+        int height
+
+    void tabix_intervals_index(tabix_intervals_t *iv)
+    long tabix_intervals_overlap(const tabix_intervals_t *iv,
+                                 int64_t beg, int64_t end,
+                                 long **found, size_t *m_found)
+    long tabix_intervals_query(const tabix_intervals_t *iv,
+                               const long *positions, long npos,
+                               long **qidx, size_t *m_qidx,
+                               long **hits, size_t *m_hits)
+
+
 cdef class tabix_file_iterator:
     cdef gzFile fh
     cdef kstream_t * kstream
@@ -58,6 +109,19 @@ cdef class tabix_file_iterator:
 
     cdef __cnext__(self)
 
+cdef class tabix_batch_iterator:
+    cdef tabix_reader_t * reader
+    cdef Parser parser
+    cdef int batch_size
+    # current chunk and index of its next line
+    cdef tabix_chunk_t * chunk
+    cdef int index
+    cdef bint eof
+    cdef infile
+
+    cdef int fetch_chunk(self) except -1
+    cdef next_raw(self)
+
 cdef class TabixFile:
 
     # pointer to tabixfile
@@ -75,6 +139,14 @@ cdef class TabixFile:
 
     cdef encoding    
 
+    # size of the block cache in bytes
+    cdef int cache_size
+
+    # I/O counters, None unless profiling
+    cdef IOStats io_stats
+
+    cdef int _contig_end(self, int tid, int start) except -1
+
 cdef class Parser:
     cdef encoding
 
@@ -84,7 +156,8 @@ cdef class asTuple(Parser):
     cdef parse(self, char * buffer, int len)
 
 cdef class asGTF(Parser):
-    pass
+    cdef tuple attributes
+    cdef StringCache strings
 
 cdef class asBed(Parser):
     pass
@@ -97,10 +170,47 @@ cdef class TabixIterator:
     cdef TabixFile tabixfile
     cdef kstring_t buffer
     cdef encoding
+    # skip rows starting before this position
+    cdef int min_start
     cdef int __cnext__(self)
 
 cdef class TabixIteratorParsed(TabixIterator):
     cdef Parser parser
+    # if false, the row of the previous iteration is re-used
+    cdef bint persist
+    cdef object row
+
+# In-memory index of intervals
+cdef class IntervalArray:
+    cdef tabix_intervals_t intervals
+    cdef list pending
+    # positions of the intervals found by overlap()
+    cdef long * found
+    cdef size_t m_found
+
+    cdef build(self)
+    cdef long overlap(self, int64_t beg, int64_t end) except -1
+
+cdef class IntervalIndex:
+    cdef dict by_contig
+    cdef long n
+
+cdef class TabixMultiIterator:
+    cdef TabixFile tabixfile
+    cdef Parser parser
+    cdef kstring_t buffer
+    cdef encoding
+    # per contig: (tid, IntervalArray of queries, merged chunks)
+    cdef list plan
+    cdef int plan_idx
+    cdef int chunk_idx
+    cdef int tid
+    cdef IntervalArray queries
+    cdef uint64_t chunk_end
+    cdef int beg, end
+    cdef list hits
+    cdef object row
+    cdef int __cnext__(self) except -2
 
 cdef class GZIterator:
     cdef object _filename
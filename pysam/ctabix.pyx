@@ -15,6 +15,8 @@
 #
 # class tabix_generic_iterator  Streamed iterator of bgzf formatted files
 #
+# class IntervalIndex  In-memory index for overlap queries against rows
+#
 # Additionally this module defines several additional classes that are part
 # of the internal API. These are:
 #
@@ -54,9 +56,14 @@
 ###############################################################################
 import os
 import sys
+import array
+import multiprocessing
 
 from libc.stdio cimport printf, fprintf, stderr
-from libc.string cimport strerror
+from libc.stdlib cimport strtol, strtod
+from libc.math cimport NAN
+from libc.limits cimport INT_MAX
+from libc.string cimport strerror, strcmp, memcpy
 from libc.errno cimport errno
 from posix.unistd cimport dup
 
@@ -65,6 +72,7 @@ from cpython cimport PyErr_SetString, PyBytes_Check, \
     PyObject_AsFileDescriptor
 
 from cpython.version cimport PY_MAJOR_VERSION
+from cpython cimport array as c_array
 
 cimport pysam.ctabixproxies as ctabixproxies
 
@@ -72,10 +80,16 @@ from pysam.chtslib cimport htsFile, hts_open, hts_close, HTS_IDX_START,\
     BGZF, bgzf_open, bgzf_close, bgzf_write, gzFile, \
     tbx_index_build, tbx_index_load, tbx_itr_queryi, tbx_itr_querys, \
     tbx_conf_t, tbx_seqnames, tbx_itr_next, tbx_itr_destroy, \
-    tbx_destroy, gzopen, gzclose, gzerror, gzdopen, hisremote
+    tbx_destroy, gzopen, gzclose, gzerror, gzdopen, hisremote, \
+    tbx_name2id, tbx_readrec, bgzf_seek, bgzf_tell, hts_get_bgzfp, SEEK_SET, \
+    bgzf_set_cache_size, pysam_bgzf_cache_nblocks, \
+    PYSAM_HTSLIB_INTERNALS, \
+    bgzf_mt, hts_idx_save_as, s2i_t, khint_t, kh_init_s2i, kh_destroy_s2i, \
+    kh_get_s2i, kh_put_s2i, kh_exist, pysam_hts_get_hfile
 
 from pysam.cutils cimport force_bytes, force_str, charptr_to_str
 from pysam.cutils cimport encode_filename, from_string_and_size
+from pysam.cutils cimport make_io_stats
 
 cdef class Parser:
 
@@ -149,10 +163,29 @@ cdef class asGTF(Parser):
     |transcript_id       |the transcript identifier     |
     +--------------------+------------------------------+
 
+    The attributes field is parsed once per entry when the first
+    attribute is accessed. If *attributes* is given, for example
+    ``("gene_id", "transcript_id")``, parsing stops as soon as these
+    attributes have been found. Other attributes are still accessible,
+    but require parsing the whole field.
+
     ''' 
+    def __init__(self, encoding="ascii", attributes=None):
+        Parser.__init__(self, encoding)
+        if attributes is None:
+            self.attributes = None
+        else:
+            self.attributes = tuple([force_bytes(x, encoding)
+                                     for x in attributes])
+
     cdef parse(self, char * buffer, int len):
         cdef ctabixproxies.GTFProxy r
+        # entries share the decoded attribute keys and values
+        if self.strings is None or self.strings.encoding != self.encoding:
+            self.strings = ctabixproxies.StringCache(self.encoding)
         r = ctabixproxies.GTFProxy(self.encoding)
+        r._attribute_keys = self.attributes
+        r.strings = self.strings
         r.copy(buffer, len)
         return r
 
@@ -279,6 +312,23 @@ cdef class TabixFile:
 
         The encoding passed to the parser
 
+    cache_size : int
+
+        Size in bytes of htslib's cache of decompressed blocks. Regions
+        fetched repeatedly, or lying close to each other, are then
+        served from memory. The default of 0 disables the cache. Note
+        that blocks are up to 64kb in size, and that the cache has no
+        effect unless it can hold more than one block. The cache is
+        unordered: when it is full, an arbitrary block is evicted. See
+        :meth:`get_cache_statistics`.
+
+    profile : bool
+
+        Count the bytes read, the time spent and the rows and Python
+        objects created. See :meth:`stats` and
+        :class:`~pysam.IOProfiler`. Not available if pysam has been
+        built against an external htslib.
+
     Raises
     ------
     
@@ -294,18 +344,21 @@ cdef class TabixFile:
                   parser=None,
                   index=None,
                   encoding="ascii",
+                  cache_size=0,
                   *args,
                   **kwargs ):
 
         self.tabixfile = NULL
         self.parser = parser
-        self._open(filename, mode, index, *args, **kwargs)
+        self._open(filename, mode, index, cache_size, *args, **kwargs)
         self.encoding = encoding
 
     def _open( self, 
                filename,
                mode='r',
                index=None,
+               cache_size=0,
+               profile=False,
               ):
         '''open a :term:`tabix file` for reading.
         '''
@@ -337,6 +390,10 @@ cdef class TabixFile:
 
         if self.tabixfile == NULL:
             raise IOError("could not open file `%s`" % filename)
+
+        self.io_stats = make_io_stats(profile)
+        if self.io_stats is not None:
+            self.io_stats.profile(pysam_hts_get_hfile(self.tabixfile))
         
         cfilename = self._filename_index
         with nogil:
@@ -345,6 +402,12 @@ cdef class TabixFile:
         if self.index == NULL:
             raise IOError("could not open index for `%s`" % filename)
 
+        if cache_size < 0:
+            raise ValueError("invalid cache size %i" % cache_size)
+        self.cache_size = cache_size
+        if cache_size > 0:
+            bgzf_set_cache_size(hts_get_bgzfp(self.tabixfile), cache_size)
+
     def _dup(self):
         '''return a copy of this tabix file.
         
@@ -354,7 +417,9 @@ cdef class TabixFile:
                          mode="r", 
                          parser=self.parser,
                          index=self._filename_index,
-                         encoding=self.encoding)
+                         encoding=self.encoding,
+                         cache_size=self.cache_size,
+                         profile=self.io_stats)
 
     def is_open(self):
         '''return true if samfile has been opened.'''
@@ -367,7 +432,8 @@ cdef class TabixFile:
               end=None, 
               region=None,
               parser=None,
-              multiple_iterators=False):
+              multiple_iterators=False,
+              persist=True):
         '''fetch one or more rows in a :term:`region` using 0-based
         indexing. The region is specified by :term:`reference`,
         *start* and *end*. Alternatively, a samtools :term:`region`
@@ -387,6 +453,12 @@ cdef class TabixFile:
         effectively re-opening the file. Re-opening a file creates
         some overhead, so beware.
 
+        If *persist* is False, parsed rows are not copied into a new
+        object during iteration. Instead, the row returned previously
+        is updated in place, which permits faster iteration, but a row
+        will not persist when the iteration continues. Use
+        ``copy.copy(row)`` to keep a row.
+
         '''
         if not self.is_open():
             raise ValueError("I/O operation on closed file")
@@ -465,13 +537,515 @@ cdef class TabixFile:
             a = TabixIterator(encoding=fileobj.encoding)
         else:
             parser.set_encoding(fileobj.encoding)
-            a = TabixIteratorParsed(parser)
+            a = TabixIteratorParsed(parser, persist=persist)
 
         a.tabixfile = fileobj
         a.iterator = itr
 
         return a
 
+    def fetch_many(self,
+                   contigs,
+                   starts,
+                   ends,
+                   parser=None,
+                   multiple_iterators=False):
+        '''fetch the rows overlapping many regions in a single pass
+        through the file.
+
+        The regions are given by the sequences *contigs*, *starts* and
+        *ends* using 0-based, half-open coordinates. Returns an iterator
+        over *(query_index, row)* tuples, where *query_index* is the
+        position of an overlapping region in the input sequences. A row
+        overlapping several regions is read once and reported once per
+        region.
+
+        The queries are grouped by contig and sorted, and the file
+        chunks listed for them in the index are merged, so that each
+        compressed block is read at most once per contig. Rows are
+        returned in file order rather than in query order.
+
+        *parser* and *multiple_iterators* are as in :meth:`fetch`.
+        '''
+        if not self.is_open():
+            raise ValueError("I/O operation on closed file")
+
+        contigs, starts, ends = list(contigs), list(starts), list(ends)
+        if not len(contigs) == len(starts) == len(ends):
+            raise ValueError(
+                "contigs, starts and ends must be of the same length")
+
+        cdef TabixFile fileobj
+        if multiple_iterators:
+            fileobj = self._dup()
+        else:
+            fileobj = self
+
+        # group queries by contig
+        cdef dict by_tid = {}
+        cdef dict tids = {}
+        cdef IntervalArray queries
+        cdef int tid
+        for x, (contig, start, end) in enumerate(zip(contigs, starts, ends)):
+            if start < 0 or end < start:
+                raise ValueError(
+                    "invalid region %s:%i-%i" % (contig, start, end))
+            if start == end:
+                continue
+            if contig not in tids:
+                s = force_bytes(contig, encoding=fileobj.encoding)
+                tids[contig] = tbx_name2id(fileobj.index, s)
+            tid = tids[contig]
+            if tid < 0:
+                continue
+            queries = by_tid.get(tid, None)
+            if queries is None:
+                queries = IntervalArray()
+                by_tid[tid] = queries
+            queries.pending.append((start, end, x))
+
+        # collect the index chunks of all queries on a contig.
+        # Chunks ending in the block where the next one starts are
+        # merged, as reading on is cheaper than seeking back.
+        cdef hts_itr_t * itr
+        cdef int k
+        cdef long i
+        cdef list plan = []
+        for tid in sorted(by_tid):
+            queries = by_tid[tid]
+            queries.build()
+            chunks = []
+            for i in range(queries.intervals.n):
+                with nogil:
+                    itr = tbx_itr_queryi(fileobj.index, tid,
+                                         queries.intervals.starts[i],
+                                         queries.intervals.ends[i])
+                if itr == NULL:
+                    raise ValueError(
+                        "could not create iterator for tid %i" % tid)
+                for k in range(itr.n_off):
+                    chunks.append((itr.off[k].u, itr.off[k].v))
+                tbx_itr_destroy(itr)
+
+            chunks.sort()
+            merged = []
+            for u, v in chunks:
+                if merged and u >> 16 <= merged[-1][1] >> 16:
+                    if v > merged[-1][1]:
+                        merged[-1] = (merged[-1][0], v)
+                else:
+                    merged.append((u, v))
+            plan.append((tid, queries, merged))
+
+        # use default parser if no parser is specified
+        if parser is None:
+            parser = fileobj.parser
+        if parser is not None:
+            parser.set_encoding(fileobj.encoding)
+
+        cdef TabixMultiIterator a = TabixMultiIterator(parser, fileobj.encoding)
+        a.tabixfile = fileobj
+        a.plan = plan
+        return a
+
+    def map(self,
+            func,
+            regions=None,
+            int workers=1,
+            parser=None,
+            shards=None):
+        '''apply *func* to the rows in *regions* using several
+        processes.
+
+        The regions are split into shards of similar compressed size,
+        estimated from the bins of the index. If pysam has been built
+        against an external htslib, whose index can not be inspected,
+        the shards are of similar length instead. Each shard is passed
+        to *func* as ``func(contig, start, end, rows)``, where *rows*
+        iterates over the rows starting within the shard, parsed by
+        *parser* as in :meth:`fetch`. Rows overlapping the start of a
+        region are passed with its first shard. *rows* can not be used
+        after *func* has returned. Returns a list of the results for
+        all shards in the order of *regions*.
+
+        *regions* is a list of contig names or of *(contig, start,
+        end)* tuples in 0-based, half-open coordinates, where *end*
+        may be None. By default, all contigs are processed. Unknown
+        contigs are skipped.
+
+        If *workers* is larger than 1, the shards are processed by as
+        many worker processes, each opening its own copy of the file.
+        The workers are forked, so that *func* and *parser* need not
+        be picklable, but the results of *func* are sent back to this
+        process and need to be. By default there are four *shards* per
+        worker, so that workers finishing early take on remaining
+        shards.
+        '''
+        if not self.is_open():
+            raise ValueError("I/O operation on closed file")
+        if workers < 1:
+            raise ValueError("workers must be positive")
+        if shards is None:
+            shards = 4 * workers
+        elif shards < 1:
+            raise ValueError("shards must be positive")
+
+        if regions is None:
+            regions = [force_str(c, self.encoding) for c in self.contigs]
+
+        # list the windows in each region with their size in
+        # compressed bytes
+        cdef int64_t * window_sizes
+        cdef int tid, nwindows, min_shift, x
+        cdef long total = 0
+        cdef list queries = []
+        for region in regions:
+            if isinstance(region, (tuple, list)):
+                contig, start, end = region
+            else:
+                contig, start, end = region, 0, None
+            if start < 0 or (end is not None and end <= start):
+                raise ValueError("invalid region %s:%s-%s" %
+                                 (contig, start, end))
+            s = force_bytes(contig, encoding=self.encoding)
+            tid = tbx_name2id(self.index, s)
+            if tid < 0:
+                continue
+            if PYSAM_HTSLIB_INTERNALS:
+                nwindows = tabix_index_window_sizes(
+                    self.index.idx, tid, &window_sizes, &min_shift)
+                if nwindows < 0:
+                    raise MemoryError("could not allocate window sizes")
+            else:
+                # the bins can not be inspected, cut the region into
+                # shards of equal length instead
+                min_shift = 14
+                nwindows = ((self._contig_end(tid, start) - 1)
+                            >> min_shift) + 1
+            first = start >> min_shift
+            if end is None:
+                last = nwindows
+            else:
+                last = min(nwindows, ((end - 1) >> min_shift) + 1)
+            if PYSAM_HTSLIB_INTERNALS:
+                sizes = [window_sizes[x] for x in range(first, last)]
+                free(window_sizes)
+            else:
+                sizes = [1] * (last - first)
+            total += sum(sizes)
+            queries.append((contig, tid, start, end, min_shift,
+                            first, sizes))
+
+        # cut regions into shards at window boundaries
+        cdef list plan = []
+        target = max(1, total // shards)
+        for contig, tid, start, end, min_shift, first, sizes in queries:
+            shard_start = start
+            size = 0
+            for x, window_size in enumerate(sizes[:-1]):
+                size += window_size
+                if size >= target:
+                    shard_end = (first + x + 1) << min_shift
+                    plan.append((contig, tid, shard_start, shard_end,
+                                 shard_start == start))
+                    shard_start = shard_end
+                    size = 0
+            plan.append((contig, tid, shard_start, end,
+                         shard_start == start))
+
+        if workers == 1 or len(plan) == 1:
+            return [self._map_shard(func, parser, shard) for shard in plan]
+
+        try:
+            context = multiprocessing.get_context("fork")
+        except AttributeError:
+            # Python 2 always forks
+            context = multiprocessing
+        pool = context.Pool(min(workers, len(plan)),
+                            _map_init,
+                            (self, func, parser, plan))
+        try:
+            results = pool.map(_map_run, range(len(plan)), 1)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        cdef IOStats stats
+        if self.io_stats is not None:
+            # counters of the copies opened by the workers
+            stats = self.io_stats.child()
+            for result, counts in results:
+                stats.add(counts)
+        return [result for result, counts in results]
+
+    cdef int _contig_end(self, int tid, int start) except -1:
+        '''return a position after which the index lists no records
+        on *tid*.
+
+        The position is found by bisection with queries of the index
+        and is accurate to the size of its smallest bins.
+        '''
+        cdef hts_itr_t * itr
+        cdef int lo = start, hi = INT_MAX, mid
+        while lo < hi:
+            mid = lo + (hi - lo) // 2
+            with nogil:
+                itr = tbx_itr_queryi(self.index, tid, mid, INT_MAX)
+            if itr == NULL:
+                raise MemoryError("could not create iterator")
+            if itr.n_off > 0:
+                lo = mid + 1
+            else:
+                hi = mid
+            tbx_itr_destroy(itr)
+        return lo
+
+    def _map_shard(self, func, parser, shard):
+        '''apply *func* to the rows of a shard planned by :meth:`map`.'''
+        cdef hts_itr_t * itr
+        cdef TabixIterator a
+        cdef int tid, start, end
+
+        contig, tid, start, shard_end, is_first = shard
+        if shard_end is None:
+            end = INT_MAX
+        else:
+            end = shard_end
+        with nogil:
+            itr = tbx_itr_queryi(self.index, tid, start, end)
+        if itr == NULL:
+            raise ValueError(
+                "could not create iterator for region %s:%i-%i" %
+                (contig, start, end))
+
+        if parser is None:
+            parser = self.parser
+        if parser is None:
+            a = TabixIterator(encoding=self.encoding)
+        else:
+            parser.set_encoding(self.encoding)
+            a = TabixIteratorParsed(parser)
+        a.tabixfile = self
+        a.iterator = itr
+        # rows overlapping from the previous shard of a region
+        # have been passed with it
+        if not is_first:
+            a.min_start = start
+
+        return func(contig, start, shard_end, a)
+
+    def to_arrays(self,
+                  reference=None,
+                  start=None,
+                  end=None,
+                  region=None,
+                  columns=None,
+                  dtypes=None):
+        '''return the rows in a :term:`region` as typed arrays, one per
+        column.
+
+        The region is given as in :meth:`fetch`. *columns* is a list of
+        0-based column numbers, and defaults to the contig, start and
+        end columns of the index. Values are taken as they appear in
+        the file, without conversion of coordinates.
+
+        *dtypes* gives the type of each column, either an
+        :mod:`array` type code (``'i'``, ``'l'``, ``'f'`` or ``'d'``)
+        or ``'s'`` for strings. By default, the start and end columns
+        of the index are read as ``'l'`` and all other columns as
+        strings. Missing values (``.`` or empty) in floating point
+        columns become NaN.
+
+        Rows are split in C, so no Python objects are created per
+        row. Returns a list with an entry per column: an
+        :class:`array.array` for numeric columns and a tuple
+        ``(codes, values)`` for string columns, where *codes* is an
+        ``array('i')`` of indices into the list *values* of distinct
+        strings in order of appearance.
+
+        Raises ValueError if a row has too few columns or a value
+        can not be converted.
+        '''
+        if not self.is_open():
+            raise ValueError("I/O operation on closed file")
+
+        cdef tbx_conf_t conf = self.index.conf
+        if columns is None:
+            columns = [conf.sc - 1, conf.bc - 1]
+            if conf.ec > 0:
+                columns.append(conf.ec - 1)
+        columns = list(columns)
+        if dtypes is None:
+            dtypes = ["l" if x in (conf.bc - 1, conf.ec - 1) else "s"
+                      for x in columns]
+        dtypes = list(dtypes)
+        if len(dtypes) != len(columns):
+            raise ValueError(
+                "columns and dtypes must be of the same length")
+
+        cdef int ncolumns = len(columns)
+        cdef list arrays = []
+        cdef list values = []
+        cdef list tables = []
+        for x in range(ncolumns):
+            if columns[x] < 0:
+                raise ValueError("invalid column %i" % columns[x])
+            if dtypes[x] == "s":
+                arrays.append(array.array("i", []))
+            elif dtypes[x] in ("i", "l", "f", "d"):
+                arrays.append(array.array(dtypes[x], []))
+            else:
+                raise ValueError("unknown dtype '%s'" % dtypes[x])
+            values.append([])
+            tables.append(None)
+
+        it = self.fetch(reference, start, end, region)
+        if not isinstance(it, TabixIterator):
+            return [(x, v) if d == "s" else x
+                    for x, v, d in zip(arrays, values, dtypes)]
+
+        cdef TabixIterator itr = it
+        cdef ctabixproxies.TupleProxy proxy = ctabixproxies.TupleProxy(
+            self.encoding)
+        cdef c_array.array a
+        cdef s2i_t * table
+        cdef s2i_t ** tables_c = <s2i_t**>calloc(ncolumns, sizeof(s2i_t*))
+        cdef int * columns_c = <int*>calloc(ncolumns, sizeof(int))
+        cdef char * types_c = <char*>calloc(ncolumns, sizeof(char))
+        if tables_c == NULL or columns_c == NULL or types_c == NULL:
+            free(tables_c)
+            free(columns_c)
+            free(types_c)
+            raise MemoryError("out of memory in to_arrays()")
+
+        cdef int retval, col, absent
+        cdef long nrows = 0
+        cdef char * field
+        cdef char * field_end
+        cdef khint_t k
+        cdef long lvalue
+        cdef double dvalue
+
+        for x in range(ncolumns):
+            columns_c[x] = columns[x]
+            types_c[x] = ord(dtypes[x][0])
+            if types_c[x] == b's':
+                tables_c[x] = kh_init_s2i()
+
+        try:
+            while 1:
+                retval = itr.__cnext__()
+                if retval == -5:
+                    raise IOError("iteration on closed file")
+                elif retval < 0:
+                    break
+
+                # split the row in place into fields
+                proxy.present(itr.buffer.s, itr.buffer.l)
+                nrows += 1
+
+                for col in range(ncolumns):
+                    if columns_c[col] >= proxy.nfields:
+                        raise ValueError(
+                            "row %i has fewer than %i columns" %
+                            (nrows, columns_c[col] + 1))
+                    field = proxy.fields[columns_c[col]]
+                    a = arrays[col]
+                    c_array.resize_smart(a, nrows)
+
+                    if types_c[col] == b's':
+                        table = tables_c[col]
+                        k = kh_get_s2i(table, field)
+                        if k == table.n_buckets:
+                            k = kh_put_s2i(table, field, &absent)
+                            table.keys[k] = strdup(field)
+                            table.vals[k] = len(values[col])
+                            values[col].append(force_str(field,
+                                                         self.encoding))
+                        a.data.as_ints[nrows - 1] = table.vals[k]
+                    elif types_c[col] == b'i' or types_c[col] == b'l':
+                        lvalue = strtol(field, &field_end, 10)
+                        if field_end == field or field_end[0] != 0:
+                            raise ValueError(
+                                "could not convert '%s' in row %i to int" %
+                                (force_str(field, self.encoding), nrows))
+                        if types_c[col] == b'i':
+                            a.data.as_ints[nrows - 1] = lvalue
+                        else:
+                            a.data.as_longs[nrows - 1] = lvalue
+                    else:
+                        if field[0] == 0 or strcmp(field, ".") == 0:
+                            dvalue = NAN
+                        else:
+                            dvalue = strtod(field, &field_end)
+                            if field_end[0] != 0:
+                                raise ValueError(
+                                    "could not convert '%s' in row %i "
+                                    "to float" %
+                                    (force_str(field, self.encoding),
+                                     nrows))
+                        if types_c[col] == b'f':
+                            a.data.as_floats[nrows - 1] = dvalue
+                        else:
+                            a.data.as_doubles[nrows - 1] = dvalue
+        finally:
+            for col in range(ncolumns):
+                table = tables_c[col]
+                if table == NULL:
+                    continue
+                for k in range(table.n_buckets):
+                    if kh_exist(table, k):
+                        free(<char*>table.keys[k])
+                kh_destroy_s2i(table)
+            free(tables_c)
+            free(columns_c)
+            free(types_c)
+
+        return [(a, v) if d == "s" else a
+                for a, v, d in zip(arrays, values, dtypes)]
+
+    def get_cache_statistics(self):
+        '''return a dictionary describing the block cache.
+
+        *cache_size* is the size of the cache in bytes and *blocks* the
+        number of decompressed blocks it currently holds. *blocks* is
+        None if pysam has been built against an external htslib, as
+        its cache can not be inspected.
+
+        The cache is htslib's BGZF block cache. It is unordered: when
+        it is full, an arbitrary block is evicted rather than the
+        least recently used one. htslib does not count cache hits.
+
+        Iterators obtained with *multiple_iterators* use a cache of
+        their own and are not included.
+        '''
+        if not self.is_open():
+            raise ValueError("I/O operation on closed file")
+
+        if not PYSAM_HTSLIB_INTERNALS:
+            return {"cache_size": self.cache_size,
+                    "blocks": None}
+
+        return {
+            "cache_size": self.cache_size,
+            "blocks": pysam_bgzf_cache_nblocks(
+                hts_get_bgzfp(self.tabixfile))}
+
+    def stats(self):
+        '''return a dictionary with the I/O counters of a file opened
+        with *profile* set.
+
+        See :meth:`pysam.AlignmentFile.stats` for a description of the
+        counters. *records* counts the rows read, including those
+        read by :meth:`to_arrays` and :meth:`map`, and *wrappers* the
+        rows returned as Python objects. Counters include copies of
+        the file opened by *multiple_iterators* and :meth:`map`.
+        Statistics are available after the file has been closed.
+        '''
+        if self.io_stats is None:
+            raise ValueError("file has not been opened with profile=True")
+        return self.io_stats.to_dict()
+
     # context manager interface
     def __enter__(self):
         return self
@@ -561,6 +1135,39 @@ cdef class TabixFile:
             tbx_destroy(self.index)
 
 
+# state of a worker process of TabixFile.map
+_map_state = None
+
+
+def _map_init(TabixFile tabixfile, func, parser, list plan):
+    '''open a copy of *tabixfile* in a worker process of
+    :meth:`TabixFile.map`.'''
+    global _map_state
+    try:
+        _map_state = (tabixfile._dup(), func, parser, plan)
+    except Exception as e:
+        # raising here would make the pool restart the process
+        _map_state = e
+
+
+def _map_run(int x):
+    '''process shard *x* in a worker process of :meth:`TabixFile.map`.
+
+    Returns the result of the shard and the I/O counters accumulated
+    while processing it.
+    '''
+    cdef TabixFile fileobj
+    if isinstance(_map_state, Exception):
+        raise _map_state
+    fileobj, func, parser, plan = _map_state
+    if fileobj.io_stats is None:
+        return fileobj._map_shard(func, parser, plan[x]), None
+    before = fileobj.io_stats.to_dict()
+    result = fileobj._map_shard(func, parser, plan[x])
+    after = fileobj.io_stats.to_dict()
+    return result, dict((key, after[key] - before[key]) for key in after)
+
+
 cdef class TabixIterator:
     """iterates over rows in *tabixfile* in region
     given by *tid*, *start* and *end*.
@@ -586,18 +1193,28 @@ cdef class TabixIterator:
             return -5
 
         cdef int retval
+        cdef double t = 0
+        cdef IOStats stats = self.tabixfile.io_stats
 
         while 1:
+            if stats is not None:
+                t = stats.start()
             with nogil:
                 retval = tbx_itr_next(
                     self.tabixfile.tabixfile,
                     self.tabixfile.index,
                     self.iterator,
                     &self.buffer)
+            if stats is not None:
+                stats.stop(t, hts_get_bgzfp(self.tabixfile.tabixfile),
+                           retval >= 0)
 
             if retval < 0:
                 break
 
+            if self.iterator.curr_beg < self.min_start:
+                continue
+
             if self.buffer.s[0] != '#':
                 break
 
@@ -615,6 +1232,8 @@ cdef class TabixIterator:
         elif retval < 0:
             raise StopIteration
 
+        if self.tabixfile.io_stats is not None:
+            self.tabixfile.io_stats.wrappers += 1
         return charptr_to_str(self.buffer.s, self.encoding)
 
     def next(self):
@@ -645,14 +1264,18 @@ cdef class TabixIteratorParsed(TabixIterator):
 
     The *parser* determines the encoding.
 
-    Returns parsed data.
+    Returns parsed data. If *persist* is False, the same row object
+    is updated and returned in each iteration.
     """
 
     def __init__(self, 
-                 Parser parser):
+                 Parser parser,
+                 persist=True):
         
         TabixIterator.__init__(self)
         self.parser = parser
+        self.persist = persist
+        self.row = None
 
     def __next__(self): 
         """python version of next().
@@ -666,8 +1289,146 @@ cdef class TabixIteratorParsed(TabixIterator):
         elif retval < 0:
             raise StopIteration
 
-        return self.parser.parse(self.buffer.s,
-                                 self.buffer.l)
+        if not self.persist and \
+           isinstance(self.row, ctabixproxies.TupleProxy):
+            (<ctabixproxies.TupleProxy>self.row).copy(self.buffer.s,
+                                                      self.buffer.l)
+            return self.row
+
+        row = self.parser.parse(self.buffer.s,
+                                self.buffer.l)
+        if self.tabixfile.io_stats is not None:
+            self.tabixfile.io_stats.wrappers += 1
+        if not self.persist:
+            self.row = row
+        return row
+
+
+cdef class TabixMultiIterator:
+    """iterates over rows overlapping a set of regions, see
+    :meth:`TabixFile.fetch_many`.
+
+    Returns *(query_index, row)* tuples. The row is parsed with
+    *parser* if given, otherwise it is returned as a string.
+    """
+
+    def __cinit__(self, *args, **kwargs):
+        self.buffer.s = NULL
+        self.buffer.l = 0
+        self.buffer.m = 0
+        self.plan = []
+        self.plan_idx = -1
+        self.chunk_idx = 0
+        self.chunk_end = 0
+        self.hits = []
+
+    def __init__(self, Parser parser=None, encoding="ascii"):
+        self.parser = parser
+        self.encoding = encoding
+
+    def __iter__(self):
+        return self
+
+    cdef int __cnext__(self) except -2:
+        '''read the next row on the current contig that falls
+        into a merged chunk.
+
+        Returns -1 if there are no more rows and -5 if the file has
+        been closed. Raises IOError if reading fails.
+        '''
+        if self.tabixfile.tabixfile == NULL:
+            return -5
+
+        cdef BGZF * fp = hts_get_bgzfp(self.tabixfile.tabixfile)
+        cdef char meta_char = self.tabixfile.index.conf.meta_char
+        cdef int retval, tid, beg, end
+        cdef uint64_t start
+        cdef double t = 0
+        cdef IOStats stats = self.tabixfile.io_stats
+
+        while 1:
+            if self.chunk_end == 0:
+                # move on to the next chunk, or the next contig
+                if self.plan_idx >= 0 and \
+                   self.chunk_idx < len(self.plan[self.plan_idx][2]):
+                    start, self.chunk_end = \
+                        self.plan[self.plan_idx][2][self.chunk_idx]
+                    self.chunk_idx += 1
+                    with nogil:
+                        retval = bgzf_seek(fp, start, SEEK_SET)
+                    if retval < 0:
+                        raise IOError("could not seek in tabix file")
+                    continue
+                self.plan_idx += 1
+                if self.plan_idx >= len(self.plan):
+                    return -1
+                self.tid, self.queries, _ = self.plan[self.plan_idx]
+                self.chunk_idx = 0
+                continue
+
+            if <uint64_t>bgzf_tell(fp) >= self.chunk_end:
+                self.chunk_end = 0
+                continue
+
+            if stats is not None:
+                t = stats.start()
+            with nogil:
+                retval = tbx_readrec(fp, self.tabixfile.index,
+                                     &self.buffer, &tid, &beg, &end)
+            if stats is not None:
+                stats.stop(t, fp, retval >= 0)
+            if retval == -1:
+                self.chunk_end = 0
+                continue
+            elif retval < 0:
+                raise IOError("error while reading tabix file")
+
+            if tid != self.tid or self.buffer.s[0] == meta_char:
+                continue
+
+            self.beg, self.end = beg, end
+            return 0
+
+    def __next__(self):
+        """python version of next().
+
+        pyrex uses this non-standard name instead of next()
+        """
+        cdef IntervalArray queries
+        cdef long x, n
+        cdef int retval
+
+        while not self.hits:
+            retval = self.__cnext__()
+            if retval == -5:
+                raise IOError("iteration on closed file")
+            elif retval < 0:
+                raise StopIteration
+
+            # find the queries overlapping [beg, end), collecting
+            # them in reverse order to be popped below
+            queries = self.queries
+            n = queries.overlap(self.beg, self.end)
+            for x in range(n - 1, -1, -1):
+                self.hits.append(queries.intervals.ids[queries.found[x]])
+
+            if self.hits:
+                if self.parser is None:
+                    self.row = charptr_to_str(self.buffer.s, self.encoding)
+                else:
+                    self.row = self.parser.parse(self.buffer.s,
+                                                 self.buffer.l)
+                if self.tabixfile.io_stats is not None:
+                    self.tabixfile.io_stats.wrappers += 1
+
+        return self.hits.pop(), self.row
+
+    def next(self):
+        return self.__next__()
+
+    def __dealloc__(self):
+        if self.buffer.s != NULL:
+            free(self.buffer.s)
 
 
 cdef class GZIterator:
@@ -760,13 +1521,90 @@ cdef class GZIteratorParsed(GZIterator):
                                  self.buffer.l)
 
 
+# columns (1-based):
+#   preset-code, contig, start, end, metachar for
+#     comments, lines to ignore at beginning
+# 0 is a missing column
+TABIX_PRESETS = {
+    'gff' : (0, 1, 4, 5, ord('#'), 0),
+    'bed' : (0x10000, 1, 2, 3, ord('#'), 0),
+    'psltbl' : (0x10000, 15, 17, 18, ord('#'), 0),
+    'sam' : (1, 3, 4, 0, ord('@'), 0),
+    'vcf' : (2, 1, 2, 0, ord('#'), 0),
+    'pileup': (3, 1, 2, 0, ord('#'), 0),
+    }
+
+
+cdef tbx_conf_t get_tabix_conf(seq_col,
+                               start_col,
+                               end_col,
+                               preset,
+                               meta_char,
+                               zerobased) except *:
+    '''return the tabix configuration for a *preset* or for the
+    columns given, see :func:`tabix_index`.'''
+
+    if preset is None and \
+       (seq_col is None or start_col is None or end_col is None):
+        raise ValueError(
+            "neither preset nor seq_col,start_col and end_col given")
+
+    if preset:
+        try:
+            conf_data = TABIX_PRESETS[preset]
+        except KeyError:
+            raise KeyError(
+                "unknown preset '%s', valid presets are '%s'" %
+                (preset, ",".join(TABIX_PRESETS.keys())))
+    else:
+        if end_col == None:
+            end_col = -1
+        preset = 0
+
+        # note that tabix internally works with 0-based coordinates
+        # and open/closed intervals.  When using a preset, conversion
+        # is automatically taken care of.  Otherwise, the coordinates
+        # are assumed to be 1-based closed intervals and -1 is
+        # subtracted from the start coordinate. To avoid doing this,
+        # set the TI_FLAG_UCSC=0x10000 flag:
+        if zerobased:
+            preset = preset | 0x10000
+
+        conf_data = (preset, seq_col+1, start_col+1, end_col+1, ord(meta_char), 0)
+                
+    cdef tbx_conf_t conf
+    conf.preset, conf.sc, conf.bc, conf.ec, conf.meta_char, conf.line_skip = conf_data
+    return conf
+
+
 def tabix_compress(filename_in, 
                    filename_out,
-                   force=False):
+                   force=False,
+                   int threads=1,
+                   index=False,
+                   seq_col=None,
+                   start_col=None,
+                   end_col=None,
+                   preset=None,
+                   meta_char="#",
+                   zerobased=False,
+                   int min_shift=-1):
     '''compress *filename_in* writing the output to *filename_out*.
     
     Raise an IOError if *filename_out* already exists, unless *force*
     is set.
+
+    With *threads* larger than 1, blocks are compressed in parallel
+    using that many threads.
+
+    If *index* is set, *filename_out* is indexed with tabix as well.
+    The coordinates are taken from *preset* or the columns given, see
+    :func:`tabix_index` for these and the remaining arguments. The
+    index is built while the data is written, which is not possible
+    with several threads, as the offsets of blocks are only known once
+    they have been compressed. Raises ValueError if both *index* and
+    *threads* are set. If pysam has been built against an external
+    htslib, the compressed file is read once more to index it.
     '''
 
     if not force and os.path.exists(filename_out):
@@ -774,10 +1612,28 @@ def tabix_compress(filename_in,
             "Filename '%s' already exists, use *force* to "
             "overwrite" % filename_out)
 
+    if threads < 1:
+        raise ValueError("invalid number of threads %i" % threads)
+    if threads > 1 and index:
+        raise ValueError(
+            "can not index while compressing with several threads, "
+            "use tabix_index on the compressed file instead")
+
+    cdef tbx_conf_t conf
+    if index:
+        conf = get_tabix_conf(seq_col, start_col, end_col,
+                              preset, meta_char, zerobased)
+        filename_index = filename_out + (".csi" if min_shift > 0 else ".tbi")
+        if not force and os.path.exists(filename_index):
+            raise IOError(
+                "Filename '%s' already exists, use *force* to "
+                "overwrite" % filename_index)
+
     cdef int WINDOW_SIZE
     cdef int c, r
     cdef void * buffer
     cdef BGZF * fp
+    cdef tabix_indexer_t * indexer = NULL
     cdef int fd_src
     cdef bint is_empty = True
     cdef int O_RDONLY
@@ -785,13 +1641,21 @@ def tabix_compress(filename_in,
 
     WINDOW_SIZE = 64 * 1024
 
-    fn = encode_filename(filename_out)
-    cdef char *cfn = fn
+    fn_out = encode_filename(filename_out)
+    cdef char *cfn = fn_out
     with nogil:
         fp = bgzf_open(cfn, "w")
     if fp == NULL:
         raise IOError("could not open '%s' for writing" % filename_out)
 
+    if threads > 1:
+        bgzf_mt(fp, threads, 256)
+    elif index and PYSAM_HTSLIB_INTERNALS:
+        indexer = tabix_indexer_init(&conf, min_shift)
+        if indexer == NULL:
+            bgzf_close(fp)
+            raise MemoryError("could not allocate index")
+
     fn = encode_filename(filename_in)
     fd_src = open(fn, O_RDONLY)
     if fd_src == 0:
@@ -799,22 +1663,54 @@ def tabix_compress(filename_in,
 
     buffer = malloc(WINDOW_SIZE)
     c = 1
+    r = 0
     
     while c > 0:
         with nogil:
             c = read(fd_src, buffer, WINDOW_SIZE)
             if c > 0:
                 is_empty = False
-            r = bgzf_write(fp, buffer, c)
+                if indexer != NULL:
+                    r = tabix_indexer_write(indexer, fp, <char*>buffer, c)
+                else:
+                    r = bgzf_write(fp, buffer, c)
         if r < 0:
-            free(buffer)
-            raise OSError("writing failed")
-        
+            break
+
+    if r == 0 and indexer != NULL:
+        with nogil:
+            r = tabix_indexer_finish(indexer, fp)
+
     free(buffer)
+    if r < 0:
+        bgzf_close(fp)
+        close(fd_src)
+        if r == -2:
+            lineno = indexer.lineno
+            tabix_indexer_destroy(indexer)
+            raise ValueError(
+                "could not parse line %i of %s for indexing" %
+                (lineno, filename_in))
+        tabix_indexer_destroy(indexer)
+        raise OSError("writing failed")
+
     r = bgzf_close(fp)
     if r < 0:
+        tabix_indexer_destroy(indexer)
         raise OSError("error %i when writing to file %s" % (r, filename_out))
 
+    if indexer != NULL:
+        with nogil:
+            r = hts_idx_save_as(indexer.tbx.idx, cfn, NULL, indexer.fmt)
+        tabix_indexer_destroy(indexer)
+        if r < 0:
+            raise OSError("could not save index for %s" % filename_out)
+    elif index:
+        with nogil:
+            r = tbx_index_build(cfn, min_shift, &conf)
+        if r < 0:
+            raise OSError("could not build index for %s" % filename_out)
+
     r = close(fd_src)
     # an empty file will return with -1, thus ignore this.
     if r < 0:
@@ -831,6 +1727,7 @@ def tabix_index( filename,
                  meta_char = "#",
                  zerobased = False,
                  int min_shift = -1,
+                 int threads = 1,
                 ):
     '''index tab-separated *filename* using tabix.
 
@@ -855,8 +1752,11 @@ def tabix_index( filename,
     *line_skip* lines will be skipped.
     
     If *filename* does not end in ".gz", it will be automatically
-    compressed. The original file will be removed and only the 
-    compressed file will be retained. 
+    compressed (see :func:`tabix_compress`). The original file will be
+    removed and only the compressed file will be retained. With a
+    single thread, the file is indexed while it is compressed. With
+    *threads* larger than 1, it is compressed using that many threads
+    and the compressed file is read once more to index it.
 
     If *filename* ends in *gz*, the file is assumed to be already
     compressed with bgzf.
@@ -872,13 +1772,22 @@ def tabix_index( filename,
     if not os.path.exists(filename):
         raise IOError("No such file '%s'" % filename)
 
-    if preset is None and \
-       (seq_col is None or start_col is None or end_col is None):
-        raise ValueError(
-            "neither preset nor seq_col,start_col and end_col given")
+    cdef tbx_conf_t conf = get_tabix_conf(seq_col, start_col, end_col,
+                                          preset, meta_char, zerobased)
 
-    if not filename.endswith(".gz"): 
-        tabix_compress(filename, filename + ".gz", force=force)
+    if not filename.endswith(".gz") and threads == 1:
+        tabix_compress(filename, filename + ".gz", force=force,
+                       index=True,
+                       seq_col=seq_col, start_col=start_col,
+                       end_col=end_col, preset=preset,
+                       meta_char=meta_char, zerobased=zerobased,
+                       min_shift=min_shift)
+        os.unlink( filename )
+        return filename + ".gz"
+
+    if not filename.endswith(".gz"):
+        tabix_compress(filename, filename + ".gz", force=force,
+                       threads=threads)
         os.unlink( filename )
         filename += ".gz"
 
@@ -886,46 +1795,6 @@ def tabix_index( filename,
         raise IOError(
             "Filename '%s.tbi' already exists, use *force* to overwrite")
 
-    # columns (1-based):
-    #   preset-code, contig, start, end, metachar for
-    #     comments, lines to ignore at beginning
-    # 0 is a missing column
-    preset2conf = {
-        'gff' : (0, 1, 4, 5, ord('#'), 0),
-        'bed' : (0x10000, 1, 2, 3, ord('#'), 0),
-        'psltbl' : (0x10000, 15, 17, 18, ord('#'), 0),
-        'sam' : (1, 3, 4, 0, ord('@'), 0),
-        'vcf' : (2, 1, 2, 0, ord('#'), 0),
-        'pileup': (3, 1, 2, 0, ord('#'), 0),
-        }
-
-    if preset:
-        try:
-            conf_data = preset2conf[preset]
-        except KeyError:
-            raise KeyError(
-                "unknown preset '%s', valid presets are '%s'" %
-                (preset, ",".join(preset2conf.keys())))
-    else:
-        if end_col == None:
-            end_col = -1
-        preset = 0
-
-        # note that tabix internally works with 0-based coordinates
-        # and open/closed intervals.  When using a preset, conversion
-        # is automatically taken care of.  Otherwise, the coordinates
-        # are assumed to be 1-based closed intervals and -1 is
-        # subtracted from the start coordinate. To avoid doing this,
-        # set the TI_FLAG_UCSC=0x10000 flag:
-        if zerobased:
-            preset = preset | 0x10000
-
-        conf_data = (preset, seq_col+1, start_col+1, end_col+1, ord(meta_char), 0)
-                
-    cdef tbx_conf_t conf
-    conf.preset, conf.sc, conf.bc, conf.ec, conf.meta_char, conf.line_skip = conf_data
-
-
     fn = encode_filename(filename)
     cdef char *cfn = fn
     with nogil:
@@ -1090,7 +1959,150 @@ cdef class tabix_file_iterator:
 
     def next(self):
         return self.__cnext__()
-    
+
+
+cdef class tabix_batch_iterator:
+    '''iterate over a compressed or uncompressed ``infile`` in
+    batches of parsed rows.
+
+    Each iteration returns a list of up to *batch_size* rows in file
+    order. Comments and empty lines are skipped.
+
+    The file is read and decompressed on a separate thread in chunks
+    of *chunk_size* bytes, buffering up to *nchunks* chunks. The
+    thread also splits the chunks into lines, without holding the
+    GIL. Parsing creates Python objects, so it takes place on the
+    calling thread while the next chunks are being read.
+
+    If *parser* is None, the rows are not parsed. Instead, each
+    iteration returns a tuple ``(data, offsets)``, where *data* is a
+    bytes object with up to *batch_size* lines and *offsets* an
+    ``array('l')`` with one more entry than there are lines. Line i
+    is ``data[offsets[i]:offsets[i + 1] - 1]``. No Python objects
+    are created per line.
+    '''
+
+    def __cinit__(self,
+                  infile,
+                  Parser parser,
+                  int batch_size=1024,
+                  int chunk_size=1048576,
+                  int nchunks=4):
+
+        self.reader = NULL
+        self.chunk = NULL
+
+        if infile.closed:
+            raise ValueError("I/O operation on closed file.")
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+        if chunk_size < 1 or nchunks < 1:
+            raise ValueError("chunk_size and nchunks must be positive")
+
+        cdef int fd = PyObject_AsFileDescriptor(infile)
+        if fd == -1:
+            raise ValueError("I/O operation on closed file.")
+        fd = dup(fd)
+        if fd == -1:
+            raise IOError('%s' % strerror(errno))
+
+        # takes ownership of fd
+        self.reader = tabix_reader_open(fd, chunk_size, nchunks)
+        if self.reader == NULL:
+            raise IOError("could not start reading from %s" % infile)
+
+        self.infile = infile
+        self.parser = parser
+        self.batch_size = batch_size
+        self.index = 0
+        self.eof = False
+
+    def __dealloc__(self):
+        tabix_reader_close(self.reader)
+
+    cdef int fetch_chunk(self) except -1:
+        '''make sure that the current chunk has lines left.
+
+        Returns 0 at the end of the file and 1 otherwise.
+        '''
+        cdef tabix_chunk_t * chunk
+        cdef int retval
+
+        while self.chunk == NULL or self.index >= self.chunk.n:
+            if self.eof:
+                return 0
+            with nogil:
+                retval = tabix_reader_next(self.reader, &chunk)
+            if retval < 0:
+                raise IOError("error while reading %s" % self.infile)
+            elif retval == 0:
+                self.eof = True
+                self.chunk = NULL
+                return 0
+            self.chunk = chunk
+            self.index = 0
+        return 1
+
+    cdef next_raw(self):
+        '''return the next batch of unparsed lines.'''
+        cdef c_array.array offsets = array.array("l", [0])
+        cdef size_t * chunk_offsets
+        cdef size_t shift, total = 0
+        cdef int first, last, k
+        cdef int n = 0
+        pieces = []
+
+        while n < self.batch_size and self.fetch_chunk():
+            chunk_offsets = self.chunk.offsets
+            first = self.index
+            last = min(self.chunk.n, first + self.batch_size - n)
+            shift = chunk_offsets[first]
+            pieces.append(PyBytes_FromStringAndSize(
+                self.chunk.data + shift, chunk_offsets[last] - shift))
+            c_array.resize_smart(offsets, n + 1 + last - first)
+            for k in range(first, last):
+                n += 1
+                offsets.data.as_longs[n] = \
+                    total + chunk_offsets[k + 1] - shift
+            total += chunk_offsets[last] - shift
+            self.index = last
+
+        if n == 0:
+            raise StopIteration
+        if len(pieces) == 1:
+            return pieces[0], offsets
+        return b"".join(pieces), offsets
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.parser is None:
+            return self.next_raw()
+
+        cdef size_t * offsets
+        cdef int k
+        cdef int n = 0
+
+        batch = []
+        while n < self.batch_size and self.fetch_chunk():
+            offsets = self.chunk.offsets
+            while n < self.batch_size and self.index < self.chunk.n:
+                k = self.index
+                # parser creates a copy
+                batch.append(self.parser.parse(
+                    self.chunk.data + offsets[k],
+                    offsets[k + 1] - offsets[k] - 1))
+                self.index += 1
+                n += 1
+
+        if n == 0:
+            raise StopIteration
+        return batch
+
+    def next(self):
+        return self.__next__()
+
 
 class tabix_generic_iterator:
     '''iterate over ``infile``.
@@ -1155,7 +2167,7 @@ class tabix_generic_iterator:
     def next(self):
         return self.__next__()
 
-def tabix_iterator(infile, parser):
+def tabix_iterator(infile, parser, batch_size=None):
     """return an iterator over all entries in a file.
     
     Results are returned parsed as specified by the *parser*. If
@@ -1164,7 +2176,17 @@ def tabix_iterator(infile, parser):
     parsed data (see for example :class:`~pysam.asTuple` and
     :class:`~pysam.asGTF`).
 
+    If *batch_size* is given, lists of up to *batch_size* entries are
+    returned, which are read, decompressed and split into lines on a
+    separate thread (see :class:`~pysam.tabix_batch_iterator`). If
+    *parser* is None, each batch is returned as a buffer of lines
+    and their offsets. This requires *infile* to have a file
+    descriptor.
+
     """
+    if batch_size is not None:
+        return tabix_batch_iterator(infile, parser, batch_size=batch_size)
+
     if PY_MAJOR_VERSION >= 3:
         return tabix_generic_iterator(infile, parser)
     else:
@@ -1183,6 +2205,209 @@ def tabix_iterator(infile, parser):
 #        else:
 #            return tabix_generic_iterator( infile, parser )
     
+cdef class IntervalArray:
+    '''intervals on a single contig, sorted by start.
+
+    The arrays form an implicit interval tree, see
+    tabix_intervals_t, so that overlaps are found without scanning
+    past long intervals.
+    '''
+
+    def __cinit__(self):
+        self.intervals.starts = self.intervals.ends = NULL
+        self.intervals.maxends = NULL
+        self.intervals.ids = NULL
+        self.intervals.n = 0
+        self.intervals.height = 0
+        self.found = NULL
+        self.m_found = 0
+        self.pending = []
+
+    def __dealloc__(self):
+        free(self.intervals.starts)
+        free(self.intervals.ends)
+        free(self.intervals.maxends)
+        free(self.intervals.ids)
+        free(self.found)
+
+    cdef build(self):
+        '''add pending intervals, sort and index.
+
+        The arrays are replaced only once all have been allocated,
+        so that they remain valid if allocation fails.
+        '''
+        cdef long x, n
+
+        if not self.pending:
+            return
+
+        intervals = [(self.intervals.starts[x],
+                      self.intervals.ends[x],
+                      self.intervals.ids[x])
+                     for x in range(self.intervals.n)]
+        intervals.extend(self.pending)
+        intervals.sort()
+
+        n = len(intervals)
+        cdef int64_t * starts = <int64_t *>malloc(n * sizeof(int64_t))
+        cdef int64_t * ends = <int64_t *>malloc(n * sizeof(int64_t))
+        cdef int64_t * maxends = <int64_t *>malloc(n * sizeof(int64_t))
+        cdef long * ids = <long *>malloc(n * sizeof(long))
+        if starts == NULL or ends == NULL or \
+           maxends == NULL or ids == NULL:
+            free(starts)
+            free(ends)
+            free(maxends)
+            free(ids)
+            raise MemoryError("out of memory in IntervalArray.build()")
+
+        try:
+            for x, (start, end, idx) in enumerate(intervals):
+                starts[x] = start
+                ends[x] = end
+                ids[x] = idx
+        except:
+            free(starts)
+            free(ends)
+            free(maxends)
+            free(ids)
+            raise
+
+        free(self.intervals.starts)
+        free(self.intervals.ends)
+        free(self.intervals.maxends)
+        free(self.intervals.ids)
+        self.intervals.starts = starts
+        self.intervals.ends = ends
+        self.intervals.maxends = maxends
+        self.intervals.ids = ids
+        self.intervals.n = n
+        tabix_intervals_index(&self.intervals)
+        self.pending = []
+
+    cdef long overlap(self, int64_t beg, int64_t end) except -1:
+        '''find the intervals overlapping [beg, end).
+
+        Their positions in the arrays are stored in *found* by
+        increasing start. Returns their number.
+        '''
+        cdef long n
+        with nogil:
+            n = tabix_intervals_overlap(&self.intervals, beg, end,
+                                        &self.found, &self.m_found)
+        if n < 0:
+            raise MemoryError("out of memory in IntervalArray.overlap()")
+        return n
+
+
+cdef class IntervalIndex:
+    '''*(intervals=None)*
+
+    in-memory index of intervals for fast overlap queries.
+
+    *intervals* is an iterable of rows, for example as returned by
+    :meth:`TabixFile.fetch` with an :class:`asBed` or :class:`asGTF`
+    parser. Each row either has *contig*, *start* and *end* (or
+    *stop*) attributes, or is a sequence of *(contig, start, end)*.
+    Coordinates are 0-based, half-open.
+
+    Intervals are numbered in the order in which they are added, and
+    queries return these numbers. Keep the rows in a list to map hits
+    back to annotations::
+
+        rows = list(tabixfile.fetch(parser=pysam.asBed()))
+        index = pysam.IntervalIndex(rows)
+        qidx, hits = index.query("chr1", [r.start for r in variants])
+    '''
+
+    def __cinit__(self, *args, **kwargs):
+        self.by_contig = {}
+        self.n = 0
+
+    def __init__(self, intervals=None):
+        if intervals is not None:
+            self.extend(intervals)
+
+    def __len__(self):
+        return self.n
+
+    property contigs:
+        '''contigs with at least one interval.'''
+        def __get__(self):
+            return list(self.by_contig.keys())
+
+    def add(self, contig, start, end):
+        '''add an interval and return its number.'''
+        if end < start:
+            raise ValueError(
+                "interval end (%i) before start (%i)" % (end, start))
+
+        cdef IntervalArray intervals = self.by_contig.get(contig, None)
+        if intervals is None:
+            intervals = IntervalArray()
+            self.by_contig[contig] = intervals
+        intervals.pending.append((start, end, self.n))
+        self.n += 1
+        return self.n - 1
+
+    def extend(self, intervals):
+        '''add intervals from an iterable of rows.'''
+        for row in intervals:
+            try:
+                contig, start = row.contig, row.start
+                try:
+                    end = row.end
+                except AttributeError:
+                    end = row.stop
+            except AttributeError:
+                contig, start, end = row[0], row[1], row[2]
+            self.add(contig, int(start), int(end))
+
+    def query(self, contig, positions):
+        '''find the intervals overlapping each of *positions* on
+        *contig*.
+
+        Returns a tuple of two arrays of equal length. The first holds
+        the index of a position in *positions*, the second the number of
+        an interval that contains it. Hits for a position are sorted by
+        interval start.
+        '''
+        cdef c_array.array qidx = array.array('l', [])
+        cdef c_array.array hits = array.array('l', [])
+        cdef IntervalArray intervals = self.by_contig.get(contig, None)
+
+        if intervals is None:
+            return qidx, hits
+
+        intervals.build()
+
+        cdef c_array.array cpositions = array.array('l', positions)
+        cdef long npositions = len(cpositions)
+        cdef long * cqidx = NULL
+        cdef long * chits = NULL
+        cdef size_t m_qidx = 0, m_hits = 0
+        cdef long nhits
+        with nogil:
+            nhits = tabix_intervals_query(&intervals.intervals,
+                                          cpositions.data.as_longs,
+                                          npositions,
+                                          &cqidx, &m_qidx,
+                                          &chits, &m_hits)
+        try:
+            if nhits < 0:
+                raise MemoryError("out of memory in IntervalIndex.query()")
+            c_array.resize(qidx, nhits)
+            c_array.resize(hits, nhits)
+            if nhits > 0:
+                memcpy(qidx.data.as_longs, cqidx, nhits * sizeof(long))
+                memcpy(hits.data.as_longs, chits, nhits * sizeof(long))
+        finally:
+            free(cqidx)
+            free(chits)
+
+        return qidx, hits
+
+
 cdef class Tabixfile(TabixFile):
     """Tabixfile is deprecated: use TabixFile instead"""
     pass
@@ -1202,4 +2427,6 @@ __all__ = [
     "tabix_iterator", 
     "tabix_generic_iterator", 
     "tabix_file_iterator", 
+    "tabix_batch_iterator",
+    "IntervalIndex",
 ]
@@ -2,6 +2,28 @@
 #    ctypedef struct FILE
 
 from libc.stdint cimport uint8_t, int32_t, uint32_t, int64_t, uint64_t
+from cpython.object cimport PyObject
+
+cdef struct string_cache_entry_t:
+    char * key
+    int len
+    uint32_t hash
+    PyObject * value
+
+cdef class StringCache:
+
+    cdef:
+        string_cache_entry_t * entries
+        # number of entries in the table and of strings stored
+        int size
+        int n
+        int max_strings
+
+    cdef readonly object encoding
+
+    cpdef clear(self)
+    cdef int resize(self, int size) except -1
+    cdef get(self, char * s, int l)
 
 cdef class TupleProxy:
 
@@ -13,6 +35,9 @@ cdef class TupleProxy:
         int nbytes
         int offset
         bint is_modified
+        # allocated sizes of data and fields, for re-use
+        int data_size
+        int fields_size
 
     cdef encoding
 
@@ -25,15 +50,38 @@ cdef class TupleProxy:
     cdef copy(self, char * buffer, size_t nbytes, bint reset=*)
     cdef update(self, char * buffer, size_t nbytes)
 
+# position of a key/value pair within the attributes field of a GTF
+# entry, relative to the start of the field
+cdef struct gtf_attribute_t:
+    int key_start
+    int key_len
+    int value_start
+    int value_len
+    bint quoted
+
 cdef class GTFProxy(TupleProxy) :
 
     cdef:
         char * _attributes
         cdef bint hasOwnAttributes
+        # index of key/value pairs in the attributes field
+        gtf_attribute_t * attribute_table
+        int nattributes
+        int attribute_table_size
+        # 0: not indexed, 1: only attribute_keys indexed, 2: all indexed
+        int attributes_indexed
+        # restrict indexing to these keys (bytes), None for all
+        tuple _attribute_keys
+        # decoded attribute keys and values
+        StringCache strings
 
     cpdef int getMaxFields(self)
     cpdef int getMinFields(self)
     cdef char * getAttributes(self)
+    cdef update(self, char * buffer, size_t nbytes)
+    cdef int indexAttributes(self, bint restrict) except -1
+    cdef StringCache getStrings(self)
+    cdef getAttributeValue(self, gtf_attribute_t * a)
 
 cdef class NamedTupleProxy(TupleProxy):
     pass
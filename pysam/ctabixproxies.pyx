@@ -1,4 +1,6 @@
 from cpython cimport PyBytes_FromStringAndSize
+from cpython.object cimport PyObject
+from cpython.ref cimport Py_INCREF, Py_DECREF
 
 from libc.stdio cimport printf, feof, fgets
 from libc.string cimport strcpy, strlen, memcmp, memcpy, memchr, strstr, strchr
@@ -13,6 +15,103 @@ cdef char *StrOrEmpty(char * buffer):
          return ""
      else: return buffer
 
+cdef class StringCache:
+    '''strings decoded from byte strings, re-used for repeated
+    values such as GTF attribute keys and common attribute values.
+
+    Strings are looked up by their bytes in an open addressing hash
+    table, thus a hit does not allocate. Once *max_strings* strings
+    are stored, the cache is emptied and filled anew, which bounds
+    its memory and lets it adapt to the values of later entries.
+    '''
+
+    def __cinit__(self, encoding="ascii", int max_strings=100000):
+        self.encoding = encoding
+        self.max_strings = max_strings
+        self.entries = NULL
+        self.size = 0
+        self.n = 0
+
+    def __dealloc__(self):
+        self.clear()
+
+    def __len__(self):
+        return self.n
+
+    cpdef clear(self):
+        '''remove all strings.'''
+        cdef int x
+        if self.entries != NULL:
+            for x from 0 <= x < self.size:
+                if self.entries[x].key != NULL:
+                    free(self.entries[x].key)
+                    Py_DECREF(<object>self.entries[x].value)
+            free(self.entries)
+        self.entries = NULL
+        self.size = 0
+        self.n = 0
+
+    cdef int resize(self, int size) except -1:
+        '''re-hash the strings into a table of *size* entries,
+        which needs to be a power of two.'''
+        cdef string_cache_entry_t * entries = \
+            <string_cache_entry_t*>calloc(size, sizeof(string_cache_entry_t))
+        cdef int x, idx
+        if entries == NULL:
+            raise MemoryError("could not allocate string cache")
+        for x from 0 <= x < self.size:
+            if self.entries[x].key != NULL:
+                idx = self.entries[x].hash & (size - 1)
+                while entries[idx].key != NULL:
+                    idx = (idx + 1) & (size - 1)
+                entries[idx] = self.entries[x]
+        free(self.entries)
+        self.entries = entries
+        self.size = size
+        return 0
+
+    cdef get(self, char * s, int l):
+        '''return the *l* bytes at *s* as a string.'''
+        cdef uint32_t h = 2166136261
+        cdef int x, idx
+        cdef string_cache_entry_t * e
+
+        # FNV-1a
+        for x from 0 <= x < l:
+            h = (h ^ <uint8_t>s[x]) * 16777619
+
+        if self.entries != NULL:
+            idx = h & (self.size - 1)
+            while self.entries[idx].key != NULL:
+                e = &self.entries[idx]
+                if e.hash == h and e.len == l and memcmp(e.key, s, l) == 0:
+                    return <object>e.value
+                idx = (idx + 1) & (self.size - 1)
+
+        r = force_str(PyBytes_FromStringAndSize(s, l), self.encoding)
+
+        if self.n >= self.max_strings:
+            self.clear()
+        # keep the table at most half full
+        if 2 * (self.n + 1) > self.size:
+            self.resize(max(64, 2 * self.size))
+
+        idx = h & (self.size - 1)
+        while self.entries[idx].key != NULL:
+            idx = (idx + 1) & (self.size - 1)
+        e = &self.entries[idx]
+        e.key = <char*>malloc(l + 1)
+        if e.key == NULL:
+            raise MemoryError("could not allocate string cache")
+        memcpy(e.key, s, l)
+        e.len = l
+        e.hash = h
+        Py_INCREF(r)
+        e.value = <PyObject*>r
+        self.n += 1
+        return r
+
+
 cdef int isNew(char * p, char * buffer, size_t nbytes):
     """return True if `p` is located within `buffer` of size
     `nbytes`
@@ -43,6 +142,8 @@ cdef class TupleProxy:
         # start counting at field offset
         self.offset = 0
         self.encoding = encoding
+        self.data_size = 0
+        self.fields_size = 0
 
     def __dealloc__(self):
         cdef int x
@@ -61,7 +162,7 @@ cdef class TupleProxy:
         if self.is_modified:
             raise NotImplementedError(
                 "copying modified tuples is not implemented")
-        cdef TupleProxy n = type(self)()
+        cdef TupleProxy n = type(self)(self.encoding)
         n.copy(self.data, self.nbytes, reset=True)
         return n
 
@@ -96,6 +197,7 @@ cdef class TupleProxy:
         Take ownership of the pointer.
         '''
         self.data = buffer
+        self.data_size = nbytes + 1
         self.nbytes = nbytes
         self.update(buffer, nbytes)
 
@@ -111,13 +213,29 @@ cdef class TupleProxy:
 
         Buffer is a '\0'-terminated string without the '\n'.
 
-        Take a copy of buffer.
+        Take a copy of buffer. The memory of a previous copy is
+        re-used if it is large enough.
         '''
         # +1 for '\0'
         cdef int s = sizeof(char) *  (nbytes + 1)
-        self.data = <char*>malloc(s)
-        if self.data == NULL:
-            raise ValueError("out of memory in TupleProxy.copy()")
+        cdef int x
+
+        # release fields set by the user, which refer to the old data
+        if self.is_modified:
+            for x from 0 <= x < self.nfields:
+                if isNew(self.fields[x], self.data, self.nbytes):
+                    free(self.fields[x])
+                    self.fields[x] = NULL
+            self.is_modified = 0
+
+        if s > self.data_size:
+            if self.data != NULL:
+                free(self.data)
+            self.data = <char*>malloc(s)
+            if self.data == NULL:
+                self.data_size = 0
+                raise ValueError("out of memory in TupleProxy.copy()")
+            self.data_size = s
         memcpy(<char*>self.data, buffer, s)
 
         if reset:
@@ -176,12 +294,10 @@ cdef class TupleProxy:
 
         #################################
         # clear data
-        if self.fields != NULL:
-            free(self.fields)
- 
-        for field from 0 <= field < self.nfields:
-            if isNew(self.fields[field], self.data, self.nbytes):
-                free(self.fields[field])
+        if self.is_modified:
+            for field from 0 <= field < self.nfields:
+                if isNew(self.fields[field], self.data, self.nbytes):
+                    free(self.fields[field])
                 
         self.is_modified = self.nfields = 0
 
@@ -196,9 +312,15 @@ cdef class TupleProxy:
                     max_fields += 1
             max_fields += 1
 
-        self.fields = <char **>calloc(max_fields, sizeof(char *)) 
-        if self.fields == NULL:
-            raise ValueError("out of memory in TupleProxy.update()")
+        # re-use the fields of a previous row if there are enough
+        if max_fields > self.fields_size:
+            if self.fields != NULL:
+                free(self.fields)
+            self.fields = <char **>calloc(max_fields, sizeof(char *))
+            if self.fields == NULL:
+                self.fields_size = 0
+                raise ValueError("out of memory in TupleProxy.update()")
+            self.fields_size = max_fields
 
         #################################
         # start filling
@@ -364,11 +486,150 @@ cdef class GTFProxy(TupleProxy):
         # automatically calls TupleProxy.__cinit__
         self.hasOwnAttributes = False
         self._attributes = NULL
+        self.attribute_table = NULL
+        self.nattributes = 0
+        self.attribute_table_size = 0
+        self.attributes_indexed = 0
+        self._attribute_keys = None
+        self.strings = None
 
     def __dealloc__(self):
         # automatically calls TupleProxy.__dealloc__
         if self.hasOwnAttributes:
             free(self._attributes)
+        if self.attribute_table != NULL:
+            free(self.attribute_table)
+
+    cdef update(self, char * buffer, size_t nbytes):
+        '''update internal data, discarding attributes set
+        through :meth:`fromDict`.'''
+        if self.hasOwnAttributes:
+            free(self._attributes)
+            self._attributes = NULL
+            self.hasOwnAttributes = False
+        self.attributes_indexed = 0
+        TupleProxy.update(self, buffer, nbytes)
+
+    def _setindex(self, index, value):
+        '''set item at idx index.'''
+        self.attributes_indexed = 0
+        TupleProxy._setindex(self, index, value)
+
+    cdef int indexAttributes(self, bint restrict) except -1:
+        '''record the position of each key/value pair in the
+        attributes field.
+
+        If *restrict* is set and :attr:`attribute_keys` is not None,
+        only keys in :attr:`attribute_keys` are recorded and parsing
+        stops once all of them have been found.
+
+        Values may be quoted and quoted values may contain a ";".
+        '''
+        cdef char * attributes = self.getAttributes()
+        cdef char * p = attributes
+        cdef char * key
+        cdef char * value
+        cdef int key_len, value_len, idx, nwanted = 0, nfound = 0
+        cdef uint64_t found = 0
+        cdef bint quoted
+        cdef bytes k
+        cdef gtf_attribute_t * a
+
+        if restrict and self._attribute_keys is not None:
+            nwanted = len(self._attribute_keys)
+            # only stop early if found keys can be tracked
+            if nwanted > 64:
+                nwanted = -1
+        else:
+            restrict = False
+
+        self.nattributes = 0
+        while True:
+            while p[0] == ' ' or p[0] == '\t' or p[0] == ';':
+                p += 1
+            if p[0] == '\0':
+                break
+
+            key = p
+            while p[0] != '\0' and p[0] != ' ' and \
+                  p[0] != '\t' and p[0] != ';':
+                p += 1
+            key_len = p - key
+            while p[0] == ' ' or p[0] == '\t':
+                p += 1
+
+            if p[0] == '"':
+                quoted = True
+                p += 1
+                value = p
+                while p[0] != '\0' and p[0] != '"':
+                    p += 1
+                value_len = p - value
+            else:
+                quoted = False
+                value = p
+                while p[0] != '\0' and p[0] != ';':
+                    p += 1
+                value_len = p - value
+                while value_len > 0 and (value[value_len - 1] == ' ' or
+                                         value[value_len - 1] == '\t'):
+                    value_len -= 1
+            # skip to the end of this key/value pair
+            while p[0] != '\0' and p[0] != ';':
+                p += 1
+
+            if restrict:
+                idx = 0
+                for k in self._attribute_keys:
+                    if len(k) == key_len and \
+                       memcmp(<char*>k, key, key_len) == 0:
+                        break
+                    idx += 1
+                else:
+                    continue
+                if idx < 64 and not (found & (<uint64_t>1 << idx)):
+                    found |= <uint64_t>1 << idx
+                    nfound += 1
+
+            if self.nattributes == self.attribute_table_size:
+                a = <gtf_attribute_t*>realloc(
+                    self.attribute_table,
+                    (self.attribute_table_size + 8) *
+                    sizeof(gtf_attribute_t))
+                if a == NULL:
+                    raise ValueError(
+                        "out of memory in GTFProxy.indexAttributes()")
+                self.attribute_table = a
+                self.attribute_table_size += 8
+
+            a = &self.attribute_table[self.nattributes]
+            a.key_start = key - attributes
+            a.key_len = key_len
+            a.value_start = value - attributes
+            a.value_len = value_len
+            a.quoted = quoted
+            self.nattributes += 1
+
+            if restrict and nfound == nwanted:
+                break
+
+        if restrict:
+            self.attributes_indexed = 1
+        else:
+            self.attributes_indexed = 2
+        return 0
+
+    cdef StringCache getStrings(self):
+        '''return the cache for attribute keys and values, which
+        is shared with the parser that created this entry.'''
+        if self.strings is None:
+            self.strings = StringCache(self.encoding)
+        return self.strings
+
+    cdef getAttributeValue(self, gtf_attribute_t * a):
+        '''return the value of an indexed attribute as a string.'''
+        return self.getStrings().get(self.getAttributes() + a.value_start,
+                                     a.value_len)
 
     cpdef int getMinFields(self):
         '''return minimum number of fields.'''
@@ -453,6 +714,26 @@ cdef class GTFProxy(TupleProxy):
                 self.hasOwnAttributes = False
             self._setindex(8, value)
 
+    property attribute_keys:
+        '''keys that attribute lookups are restricted to.
+
+        If set, looking up one of these keys only parses the
+        attributes field until all of them have been found. Other
+        keys remain accessible, but require parsing the complete
+        field.'''
+        def __get__(self):
+            if self._attribute_keys is None:
+                return None
+            return tuple([force_str(x, self.encoding)
+                          for x in self._attribute_keys])
+        def __set__(self, value):
+            if value is None:
+                self._attribute_keys = None
+            else:
+                self._attribute_keys = tuple(
+                    [force_bytes(x, self.encoding) for x in value])
+            self.attributes_indexed = 0
+
     cdef char * getAttributes(self):
         '''return pointer to attributes.'''
         cdef char * attributes
@@ -467,39 +748,24 @@ cdef class GTFProxy(TupleProxy):
     def asDict(self):
         """parse attributes - return as dict
         """
+        cdef char * attributes = self.getAttributes()
+        cdef StringCache strings = self.getStrings()
+        cdef gtf_attribute_t * a
+        cdef int x
 
-        # remove comments
-        attributes = self.attributes
-
-        # separate into fields
-        # Fields might contain a ";", for example in ENSEMBL GTF file
+        # Values might contain a ";", for example in ENSEMBL GTF file
         # for mouse, v78:
         # ...; transcript_name "TXNRD2;-001"; ....
-        # The current heuristic is to split on a semicolon followed by a
-        # space, see also http://mblab.wustl.edu/GTF22.html
+        # These are enclosed in quotes, which are respected by
+        # indexAttributes(), see also http://mblab.wustl.edu/GTF22.html
+        if self.attributes_indexed != 2:
+            self.indexAttributes(False)
 
-        # Remove white space to prevent a last empty field.
-        fields = [x.strip() for x in attributes.strip().split("; ")]
-        
         result = {}
-
-        for f in fields:
-
-            # strip semicolon (GTF files without a space after the last semicolon)
-            if f.endswith(";"):
-                f = f[:-1]
-
-            # split at most once in order to avoid separating
-            # multi-word values
-            d = [x.strip() for x in f.split(" ", 1)]
-
-            n,v = d[0], d[1]
-            if len(d) > 2:
-                v = d[1:]
-
-            if v[0] == '"' and v[-1] == '"':
-                v = v[1:-1]
-            else:
+        for x from 0 <= x < self.nattributes:
+            a = &self.attribute_table[x]
+            v = self.getAttributeValue(a)
+            if not a.quoted:
                 ## try to convert to a value
                 try:
                     v = float(v)
@@ -509,8 +775,8 @@ cdef class GTFProxy(TupleProxy):
                 except TypeError:
                     pass
 
-            result[n] = v
-        
+            result[strings.get(attributes + a.key_start, a.key_len)] = v
+
         return result
     
     def fromDict(self, d):
@@ -539,6 +805,7 @@ cdef class GTFProxy(TupleProxy):
 
         self.hasOwnAttributes = True
         self.is_modified = True
+        self.attributes_indexed = 0
 
     def __str__(self):
         cdef char * cpy
@@ -571,10 +838,14 @@ cdef class GTFProxy(TupleProxy):
 
     def keys(self):
         '''return a list of attributes defined in this entry.'''
-        r = self.attributes
-        return [x.strip().split(" ")[0]
-                # separator is ';' followed by space
-                for x in r.split("; ") if x.strip() != '']
+        cdef char * attributes = self.getAttributes()
+        cdef int x
+        if self.attributes_indexed != 2:
+            self.indexAttributes(False)
+        cdef StringCache strings = self.getStrings()
+        return [strings.get(attributes + self.attribute_table[x].key_start,
+                            self.attribute_table[x].key_len)
+                for x in range(self.nattributes)]
 
     def __getitem__(self, key):
         return self.__getattr__(key)
@@ -583,11 +854,9 @@ cdef class GTFProxy(TupleProxy):
         """Generic lookup of attribute from GFF/GTF attributes 
         Only called if there *isn't* an attribute with this name
         """
-        cdef char * start
         cdef char * query
-        cdef char * cpy
-        cdef char * end
-        cdef int l
+        cdef gtf_attribute_t * a
+        cdef int x, l
 
         #
         # important to use the getAttributes function.
@@ -606,31 +875,25 @@ cdef class GTFProxy(TupleProxy):
         if attributes == NULL:
             raise KeyError("key %s not found, no attributes" % item)
 
-        # add space in order to make sure
-        # to not pick up a field that is a prefix of another field
-        r = force_bytes(item + " ")
+        r = force_bytes(item, self.encoding)
         query = r
-        start = strstr(attributes, query)
-
-        if start == NULL:
-            raise AttributeError("'GTFProxy' has no attribute '%s'" % item)
-
-        start += strlen(query)
-        # skip gaps before
-        while start[0] == ' ':
-            start += 1
-
-        if start[0] == '"':
-            start += 1
-            end = start
-            while end[0] != '\0' and end[0] != '"':
-                end += 1
-            l = end - start
-            result = force_str(PyBytes_FromStringAndSize(start, l),
-                                self.encoding)
-            return result
-        else:
-            return force_str(start, self.encoding)
+        l = len(r)
+
+        # the attributes field is parsed once per entry, only
+        # looking for the requested keys if these have been given.
+        if self._attribute_keys is not None and r in self._attribute_keys:
+            if self.attributes_indexed == 0:
+                self.indexAttributes(True)
+        elif self.attributes_indexed != 2:
+            self.indexAttributes(False)
+
+        for x from 0 <= x < self.nattributes:
+            a = &self.attribute_table[x]
+            if a.key_len == l and \
+               memcmp(attributes + a.key_start, query, l) == 0:
+                return self.getAttributeValue(a)
+
+        raise AttributeError("'GTFProxy' has no attribute '%s'" % item)
 
     def setAttribute(self, name, value):
         '''convenience method to set an attribute.'''
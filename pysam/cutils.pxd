@@ -3,6 +3,8 @@
 #########################################################################
 cimport cython
 from cpython cimport array as c_array
+from libc.stdint cimport int64_t
+from pysam.chtslib cimport hFILE, BGZF, pysam_io_stats_t
 
 cpdef parse_region(reference=*, start=*, end=*, region=*)
 
@@ -13,6 +15,28 @@ cpdef c_array.array qualitystring_to_array(input_str, int offset=*)
 cpdef array_to_qualitystring(c_array.array arr, int offset=*)
 cpdef qualities_to_qualitystring(qualities, int offset=*)
 
+#########################################################################
+# Profiling of file I/O
+
+cdef class IOStats:
+    # counters updated by htslib
+    cdef pysam_io_stats_t counters
+    # records read and Python objects created for them
+    cdef int64_t records
+    cdef int64_t wrappers
+    # time spent reading without the GIL
+    cdef double nogil_seconds
+    # statistics of files opened on behalf of this one
+    cdef list children
+
+    cdef int profile(self, hFILE *fp) except -1
+    cdef IOStats child(self)
+    cdef double start(self)
+    cdef void stop(self, double start, BGZF *fp, int64_t nrecords)
+    cdef int add(self, dict counts) except -1
+
+cdef IOStats make_io_stats(profile)
+
 ########################################################################
 ########################################################################
 ########################################################################
@@ -14,6 +14,8 @@ from libc.stdlib cimport calloc, free
 from libc.string cimport strncpy
 from libc.stdio cimport fprintf, stderr, fflush
 from libc.stdio cimport stdout as c_stdout
+from pysam.chtslib cimport pysam_hfile_profile, pysam_bgzf_profile_update, \
+     pysam_clock, PYSAM_HTSLIB_INTERNALS
 
 #####################################################################
 # hard-coded constants
@@ -420,6 +422,153 @@ def _pysam_dispatch(collection,
     return retval, out_stderr, out_stdout
 
 
+#########################################################################
+# Profiling of file I/O
+
+# profilers active in a with statement
+cdef list active_profilers = []
+
+
+cdef class IOStats:
+    '''I/O counters of a file opened with profiling enabled.
+
+    Counters are collected by the file classes, see
+    :meth:`AlignmentFile.stats` and :class:`IOProfiler`.
+    '''
+
+    def __cinit__(self):
+        self.children = []
+
+    cdef int profile(self, hFILE *fp) except -1:
+        '''count reads, writes and seeks on *fp*.'''
+        if pysam_hfile_profile(fp, &self.counters) < 0:
+            raise MemoryError("could not profile file")
+        return 0
+
+    cdef IOStats child(self):
+        '''return statistics for another handle of the same file.
+
+        Counters of the child are included in those of this object.
+        As each handle has its own counters, handles can be used on
+        separate threads.
+        '''
+        cdef IOStats stats = IOStats()
+        self.children.append(stats)
+        return stats
+
+    cdef double start(self):
+        '''return the time before reading.'''
+        return pysam_clock()
+
+    cdef void stop(self, double start, BGZF *fp, int64_t nrecords):
+        '''account for a read started at *start* that returned
+        *nrecords* from *fp*.'''
+        self.nogil_seconds += pysam_clock() - start
+        self.records += nrecords
+        pysam_bgzf_profile_update(fp)
+
+    cdef int add(self, dict counts) except -1:
+        '''add *counts* returned by :meth:`to_dict` of a file in
+        another process.'''
+        self.counters.bytes_read += counts["bytes_read"]
+        self.counters.bytes_written += counts["bytes_written"]
+        self.counters.read_calls += counts["read_calls"]
+        self.counters.write_calls += counts["write_calls"]
+        self.counters.seeks += counts["seeks"]
+        self.counters.blocks += counts["blocks"]
+        self.counters.uncompressed_bytes += counts["uncompressed_bytes"]
+        self.counters.io_seconds += counts["io_seconds"]
+        self.records += counts["records"]
+        self.wrappers += counts["wrappers"]
+        self.nogil_seconds += counts["nogil_seconds"]
+        return 0
+
+    def to_dict(self):
+        '''return the counters as a dictionary.'''
+        cdef IOStats child
+        result = {"bytes_read": self.counters.bytes_read,
+                  "bytes_written": self.counters.bytes_written,
+                  "read_calls": self.counters.read_calls,
+                  "write_calls": self.counters.write_calls,
+                  "seeks": self.counters.seeks,
+                  "blocks": self.counters.blocks,
+                  "uncompressed_bytes": self.counters.uncompressed_bytes,
+                  "records": self.records,
+                  "wrappers": self.wrappers,
+                  "io_seconds": self.counters.io_seconds,
+                  "nogil_seconds": self.nogil_seconds}
+        for child in self.children:
+            for key, value in child.to_dict().items():
+                result[key] += value
+        return result
+
+
+cdef IOStats make_io_stats(profile):
+    '''return statistics for a file being opened.
+
+    Returns None unless *profile* is set or an :class:`IOProfiler` is
+    active. If *profile* is the :class:`IOStats` of another file, the
+    file is counted as a handle of that file.
+
+    Raises NotImplementedError if pysam has been built against an
+    external htslib, as profiling depends on its internals.
+    '''
+    if isinstance(profile, IOStats):
+        return (<IOStats>profile).child()
+    if not profile and not active_profilers:
+        return None
+    if not PYSAM_HTSLIB_INTERNALS:
+        raise NotImplementedError(
+            "I/O profiling requires the htslib bundled with pysam")
+    cdef IOStats stats = IOStats()
+    for profiler in active_profilers:
+        profiler.files.append(stats)
+    return stats
+
+
+class IOProfiler(object):
+    '''collect I/O statistics of all files opened within a with
+    statement::
+
+        with pysam.IOProfiler() as profiler:
+            with pysam.AlignmentFile("ex1.bam") as inf:
+                for read in inf:
+                    pass
+        print(profiler.stats())
+
+    Profiling is only available if pysam has been built with its
+    bundled htslib. Files opened while the profiler is active are
+    profiled as if opened with ``profile=True``. Their counters are summed up by
+    :meth:`stats`, which can be called before the files have been
+    closed.
+    '''
+
+    def __init__(self):
+        self.files = []
+
+    def __enter__(self):
+        active_profilers.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        active_profilers.remove(self)
+        return False
+
+    def stats(self):
+        '''return a dictionary with the sum of the counters of all
+        profiled files.
+
+        See :meth:`pysam.AlignmentFile.stats` for a description of the
+        counters.
+        '''
+        cdef IOStats stats
+        result = IOStats().to_dict()
+        for stats in self.files:
+            for key, value in stats.to_dict().items():
+                result[key] += value
+        return result
+
 __all__ = ["qualitystring_to_array",
            "array_to_qualitystring",
-           "qualities_to_qualitystring"]
+           "qualities_to_qualitystring",
+           "IOProfiler"]
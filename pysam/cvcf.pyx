@@ -63,6 +63,7 @@ import pysam
 
 gtsRegEx = re.compile("[|/\\\\]")
 alleleRegEx = re.compile('^[ACGTN]+$')
+refRegEx = re.compile('^[ACGTN]*\\Z')
 
 # Utility function.  Uses 0-based coordinates
 def get_sequence(chrom, start, end, fa):
@@ -105,12 +106,22 @@ cdef class VCFRecord( ctabixproxies.TupleProxy):
     '''vcf record.
 
     initialized from data and vcf meta
+
+    Columns are split in place by :class:`TupleProxy`.  The ALT, INFO
+    and FORMAT columns are only parsed when they are first accessed,
+    and sample columns only when they are requested by name.
     '''
 
     cdef vcf
     cdef char * contig
     cdef uint32_t pos
 
+    # parsed on first access, reset in update()
+    cdef _alt
+    cdef _info
+    cdef _format
+    cdef _expected
+
     def __init__(self, vcf):
         self.vcf = vcf
         self.encoding = vcf.encoding
@@ -146,63 +157,87 @@ cdef class VCFRecord( ctabixproxies.TupleProxy):
         # vcf counts from 1 - correct here
         self.pos = atoi(self.fields[1]) - 1
 
+        self._alt = self._info = self._format = self._expected = None
+
+    cdef _column(self, int idx):
+        '''return column *idx* as a string, "" if absent.'''
+        if idx >= self.nfields or self.fields[idx] == NULL:
+            return ""
+        return force_str(self.fields[idx], self.encoding)
+
+    cdef _location(self):
+        '''return chrom:pos, reported in errors instead of the full line.'''
+        return "%s:%i" % (force_str(self.contig, self.encoding), self.pos + 1)
+
     def __len__(self):
         return max(0, self.nfields - 9)
 
     property contig:
-        def __get__(self): return self.contig
+        def __get__(self): return force_str(self.contig, self.encoding)
 
     property pos:
         def __get__(self): return self.pos
 
     property id:
-        def __get__(self): return self.fields[2]
+        def __get__(self): return self._column(2)
 
     property ref:
         def __get__(self):
-            return self.fields[3]
+            return self._column(3)
 
     property alt:
         def __get__(self):
             # convert v3.3 to v4.0 alleles below
-            alt = self.fields[4]
-            if alt == ".": alt = []
-            else: alt = alt.upper().split(',')
-            return alt
+            if self._alt is None:
+                alt = self._column(4)
+                if alt == ".": self._alt = []
+                else: self._alt = alt.upper().split(',')
+            return list(self._alt)
 
     property qual:
         def __get__(self):
-            qual = self.fields[5]
-            if qual == b".": qual = -1
+            qual = self._column(5)
+            if qual == ".": qual = -1
             else:
                 try:    qual = float(qual)
-                except: self.vcf.error(str(self),self.QUAL_NOT_NUMERICAL)
+                except: self.vcf.error(self._location(),self.vcf.QUAL_NOT_NUMERICAL)
             return qual
 
     property filter:
         def __get__(self):
-            f = self.fields[6]
+            f = self._column(6)
             # postpone checking that filters exist.  Encode missing filter or no filtering as empty list
-            if f == b"." or f == b"PASS" or f == b"0": return []
+            if f == "." or f == "PASS" or f == "0": return []
             else: return f.split(';')
 
     property info:
         def __get__(self):
-            col = self.fields[7]
+            if self._info is not None:
+                return dict(self._info)
+            col = self._column(7)
             # dictionary of keys, and list of values
             info = {}
-            if col != b".":
+            if col != ".":
+                parse_formatdata = self.vcf.parse_formatdata
+                infodict = self.vcf._info
+                line = self._location()
                 for blurp in col.split(';'):
                     elts = blurp.split('=')
                     if len(elts) == 1: v = None
                     elif len(elts) == 2: v = elts[1]
-                    else: self.vcf.error(str(self),self.ERROR_INFO_STRING)
-                    info[elts[0]] = self.vcf.parse_formatdata(elts[0], v, self.vcf._info, str(self.vcf))
-            return info
+                    else: self.vcf.error(line,self.vcf.ERROR_INFO_STRING)
+                    info[elts[0]] = parse_formatdata(elts[0], v, infodict, line)
+            self._info = info
+            return dict(info)
 
     property format:
          def __get__(self):
-             return self.fields[8].split(':')
+             if self._format is None:
+                 col = self._column(8)
+                 # gracefully deal with absent FORMAT column
+                 if col == "": self._format = []
+                 else: self._format = col.split(':')
+             return list(self._format)
 
     property samples:
         def __get__(self):
@@ -211,28 +246,38 @@ cdef class VCFRecord( ctabixproxies.TupleProxy):
     def __getitem__(self, key):
 
         # parse sample columns
-        values = self.fields[self.vcf._sample2column[key]].split(':')
-        alt = self.alt
-        format = self.format
-
+        values = self._column(self.vcf._sample2column[key]).split(':')
+        vcf = self.vcf
+        if self._format is None:
+            self.format
+        format = self._format
+
+        # number of values per format key, shared by all samples
+        if self._expected is None:
+            alt = self.alt
+            self._expected = [vcf.get_expected(f, vcf._format, alt) for f in format]
+        expected_counts = self._expected
+
+        line = self._location()
         if len(values) > len(format):
-            self.vcf.error(str(self.line),self.BAD_NUMBER_OF_VALUES,"(found %s values in element %s; expected %s)" %\
-                           (len(values),key,len(format)))
+            vcf.error(line,vcf.BAD_NUMBER_OF_VALUES,"(found %s values in element %s; expected %s)" %\
+                      (len(values),key,len(format)))
 
         result = {}
         for idx in range(len(format)):
-            expected = self.vcf.get_expected(format[idx], self.vcf._format, alt)
+            expected = expected_counts[idx]
             if idx < len(values): value = values[idx]
             else:
                 if expected == -1: value = "."
                 else: value = ",".join(["."]*expected)
 
-            result[format[idx]] = self.vcf.parse_formatdata(format[idx], value, self.vcf._format, str(self.data))
-            if expected != -1 and len(result[format[idx]]) != expected:
-                self.vcf.error(str(self.data),self.BAD_NUMBER_OF_PARAMETERS,
-                               "id=%s, expected %s parameters, got %s" % (format[idx],expected,result[format[idx]]))
-                if len(result[format[idx]] ) < expected: result[format[idx]] += [result[format[idx]][-1]]*(expected-len(result[format[idx]]))
-                result[format[idx]] = result[format[idx]][:expected]
+            v = vcf.parse_formatdata(format[idx], value, vcf._format, line)
+            if expected != -1 and len(v) != expected:
+                vcf.error(line,vcf.BAD_NUMBER_OF_PARAMETERS,
+                          "id=%s, expected %s parameters, got %s" % (format[idx],expected,v))
+                if len(v) < expected: v += [v[-1]]*(expected-len(v))
+                v = v[:expected]
+            result[format[idx]] = v
 
         return result
 
@@ -699,8 +744,7 @@ class VCF(object):
             if self._version == 33: ref = get_sequence(chrom,pos,pos+1,self._reference)
             else:                   ref = ""
         else:
-            for c in ref:
-                if c not in "ACGTN": self.error(line,self.UNKNOWN_CHAR_IN_REF)
+            if not refRegEx.match(ref): self.error(line,self.UNKNOWN_CHAR_IN_REF)
             if "N" in ref: ref = get_sequence(chrom,pos,pos+len(ref),self._reference)
 
         # make sure reference is sane
@@ -837,29 +881,32 @@ class VCF(object):
                     alt = [faref_leftflank[pos-left-1] + allele for allele in alt]
                     pos -= 1
 
-        # parse sample columns
+        # parse sample columns.  The number of values per format key
+        # and the padding for absent values are the same for all samples.
         samples = []
+        if len(cols) > 9:
+            nformat = len(format)
+            expected_counts = [self.get_expected(f, self._format, alt) for f in format]
+            padding = ["." if expected == -1 else ",".join(["."]*expected)
+                       for expected in expected_counts]
+            parse_formatdata = self.parse_formatdata
+            formatdict = self._format
         for sample in cols[9:]:
             dict = {}
             values = sample.split(':')
-            if len(values) > len(format):
-                self.error(line,self.BAD_NUMBER_OF_VALUES,"(found %s values in element %s; expected %s)" % (len(values),sample,len(format)))
-            for idx in range(len(format)):
-                expected = self.get_expected(format[idx], self._format, alt)
-                if idx < len(values): value = values[idx]
-                else:
-                    if expected == -1: value = "."
-                    else: value = ",".join(["."]*expected)
-
-                dict[format[idx]] = self.parse_formatdata(format[idx],
-                                                          value,
-                                                          self._format,
-                                                          line)
-                if expected != -1 and len(dict[format[idx]]) != expected:
+            if len(values) > nformat:
+                self.error(line,self.BAD_NUMBER_OF_VALUES,"(found %s values in element %s; expected %s)" % (len(values),sample,nformat))
+            elif len(values) < nformat:
+                values += padding[len(values):]
+            for idx in range(nformat):
+                expected = expected_counts[idx]
+                v = parse_formatdata(format[idx], values[idx], formatdict, line)
+                if expected != -1 and len(v) != expected:
                     self.error(line,self.BAD_NUMBER_OF_PARAMETERS,
-                               "id=%s, expected %s parameters, got %s" % (format[idx],expected,dict[format[idx]]))
-                    if len(dict[format[idx]] ) < expected: dict[format[idx]] += [dict[format[idx]][-1]]*(expected-len(dict[format[idx]]))
-                    dict[format[idx]] = dict[format[idx]][:expected]
+                               "id=%s, expected %s parameters, got %s" % (format[idx],expected,v))
+                    if len(v) < expected: v += [v[-1]]*(expected-len(v))
+                    v = v[:expected]
+                dict[format[idx]] = v
             samples.append( dict )
 
         # done
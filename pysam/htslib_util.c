@@ -6,8 +6,13 @@
 #include "htslib/hts.h"
 #include "htslib/knetfile.h"
 #include "htslib/kseq.h"
+#include "htslib/cram.h"
+#include "htslib/tbx.h"
+#include "htslib/hfile.h"
 #include "htslib_util.h"
 #include <stdio.h>
+#include <string.h>
+#include <time.h>
 
 #ifndef inline
 #define inline __inline
@@ -90,6 +95,63 @@ bam1_t * pysam_bam_update(bam1_t * b,
   return b;
 }
 
+// MurmurHash64A, by Austin Appleby, placed in the public domain.
+uint64_t pysam_hash64(const void * data, const size_t len, uint64_t seed)
+{
+  const uint64_t m = 0xc6a4a7935bd1e995ULL;
+  const int r = 47;
+  const uint8_t * p = (const uint8_t *)data;
+  const uint8_t * end = p + (len & ~(size_t)7);
+  uint64_t h = seed ^ (len * m);
+  uint64_t k;
+
+  while (p != end)
+    {
+      memcpy(&k, p, 8);
+      p += 8;
+      k *= m;
+      k ^= k >> r;
+      k *= m;
+      h ^= k;
+      h *= m;
+    }
+
+  switch (len & 7)
+    {
+    case 7: h ^= (uint64_t)p[6] << 48;
+    case 6: h ^= (uint64_t)p[5] << 40;
+    case 5: h ^= (uint64_t)p[4] << 32;
+    case 4: h ^= (uint64_t)p[3] << 24;
+    case 3: h ^= (uint64_t)p[2] << 16;
+    case 2: h ^= (uint64_t)p[1] << 8;
+    case 1: h ^= (uint64_t)p[0];
+      h *= m;
+    };
+
+  h ^= h >> r;
+  h *= m;
+  h ^= h >> r;
+  return h;
+}
+
+// resize the variable length data within a bam1_t entry.
+uint8_t * pysam_bam_resize(bam1_t * b, const size_t size)
+{
+  if (b->m_data < size)
+    {
+      uint32_t m_data = size;
+      uint8_t * data;
+      kroundup32(m_data);
+      data = (uint8_t*)realloc(b->data, m_data);
+      if (data == NULL)
+	return NULL;
+      b->data = data;
+      b->m_data = m_data;
+    }
+  b->l_data = size;
+  return b->data;
+}
+
 // translate a nucleotide character to binary code
 unsigned char pysam_translate_sequence(const unsigned char s)
 {
@@ -159,3 +221,211 @@ int aux_type2size(uint8_t type)
 
 
 
+
+#if PYSAM_HTSLIB_INTERNALS
+
+// layout of the block cache in htslib/bgzf.c, which is private
+// to that file.
+typedef struct {
+  int size;
+  uint8_t *block;
+  int64_t end_offset;
+} pysam_bgzf_cache_t;
+KHASH_MAP_INIT_INT64(bgzf_cache, pysam_bgzf_cache_t)
+
+int pysam_bgzf_cache_nblocks(BGZF *fp)
+{
+  if (fp == NULL || fp->is_write || fp->cache == NULL)
+    return 0;
+  return kh_size((khash_t(bgzf_cache)*)fp->cache);
+}
+
+#else
+
+int pysam_bgzf_cache_nblocks(BGZF *fp)
+{
+  return 0;
+}
+
+#endif
+
+double pysam_clock()
+{
+  struct timespec t;
+  clock_gettime(CLOCK_MONOTONIC, &t);
+  return t.tv_sec + t.tv_nsec * 1e-9;
+}
+
+hFILE *pysam_hts_get_hfile(htsFile *fp)
+{
+  BGZF *bgzfp;
+  if (fp->is_cram)
+    return cram_fd_get_fp(fp->fp.cram);
+  bgzfp = pysam_hts_get_bgzf(fp);
+  if (bgzfp != NULL)
+    return bgzfp->fp;
+  return fp->fp.hfile;
+}
+
+BGZF *pysam_hts_get_bgzf(htsFile *fp)
+{
+  if (fp->is_cram)
+    return NULL;
+  // text files are written through an hFILE unless compressed
+  if (fp->is_write)
+    return (fp->is_bin || fp->format.compression != no_compression) ?
+      fp->fp.bgzf : NULL;
+  return hts_get_bgzfp(fp);
+}
+
+#if PYSAM_HTSLIB_INTERNALS
+
+// Mirrors struct hFILE_backend in hfile_internal.h, which is not
+// installed with htslib.
+typedef struct {
+  ssize_t (*read)(hFILE *fp, void *buffer, size_t nbytes);
+  ssize_t (*write)(hFILE *fp, const void *buffer, size_t nbytes);
+  off_t (*seek)(hFILE *fp, off_t offset, int whence);
+  int (*flush)(hFILE *fp);
+  int (*close)(hFILE *fp);
+} pysam_hfile_backend_t;
+
+// Backend installed on a profiled hFILE. The backend needs to be the
+// first member so that the hFILE can point to this structure.
+typedef struct {
+  pysam_hfile_backend_t backend;
+  const pysam_hfile_backend_t *base;
+  pysam_io_stats_t *stats;
+  // BGZF state when last observed
+  int64_t block_address;
+  int64_t uncompressed_address;
+} pysam_hfile_profile_t;
+
+#define PROFILE(fp) ((pysam_hfile_profile_t*)(fp)->backend)
+
+static ssize_t profile_read(hFILE *fp, void *buffer, size_t nbytes)
+{
+  pysam_hfile_profile_t *p = PROFILE(fp);
+  double start = pysam_clock();
+  ssize_t n = p->base->read(fp, buffer, nbytes);
+  p->stats->io_seconds += pysam_clock() - start;
+  p->stats->read_calls += 1;
+  if (n > 0)
+    p->stats->bytes_read += n;
+  return n;
+}
+
+static ssize_t profile_write(hFILE *fp, const void *buffer, size_t nbytes)
+{
+  pysam_hfile_profile_t *p = PROFILE(fp);
+  double start = pysam_clock();
+  ssize_t n = p->base->write(fp, buffer, nbytes);
+  p->stats->io_seconds += pysam_clock() - start;
+  p->stats->write_calls += 1;
+  if (n > 0)
+    p->stats->bytes_written += n;
+  return n;
+}
+
+static off_t profile_seek(hFILE *fp, off_t offset, int whence)
+{
+  pysam_hfile_profile_t *p = PROFILE(fp);
+  double start = pysam_clock();
+  off_t n = p->base->seek(fp, offset, whence);
+  p->stats->io_seconds += pysam_clock() - start;
+  p->stats->seeks += 1;
+  return n;
+}
+
+static int profile_flush(hFILE *fp)
+{
+  return PROFILE(fp)->base->flush(fp);
+}
+
+static int profile_close(hFILE *fp)
+{
+  pysam_hfile_profile_t *p = PROFILE(fp);
+  const pysam_hfile_backend_t *base = p->base;
+  // hclose() frees fp after the backend has closed the stream
+  fp->backend = (const struct hFILE_backend*)base;
+  free(p);
+  return base->close(fp);
+}
+
+static pysam_hfile_profile_t *get_profile(hFILE *fp)
+{
+  if (fp == NULL || fp->backend == NULL ||
+      ((pysam_hfile_backend_t*)fp->backend)->read != profile_read)
+    return NULL;
+  return PROFILE(fp);
+}
+
+int pysam_hfile_profile(hFILE *fp, pysam_io_stats_t *stats)
+{
+  pysam_hfile_profile_t *p;
+  if (fp == NULL)
+    return -1;
+  // already profiled, e.g. when re-opening a file
+  if ((p = get_profile(fp)) != NULL)
+    {
+      p->stats = stats;
+      return 0;
+    }
+  if ((p = calloc(1, sizeof(pysam_hfile_profile_t))) == NULL)
+    return -1;
+  p->base = (const pysam_hfile_backend_t*)fp->backend;
+  p->stats = stats;
+  p->backend.read = profile_read;
+  p->backend.write = profile_write;
+  p->backend.seek = profile_seek;
+  p->backend.flush = profile_flush;
+  p->backend.close = profile_close;
+  // count what has been read into the buffer while opening the file
+  stats->bytes_read += fp->offset + (fp->end - fp->buffer);
+  fp->backend = (const struct hFILE_backend*)p;
+  return 0;
+}
+
+// Mirrors the start of struct __faidx_t in faidx.c
+typedef struct {
+  BGZF *bgzf;
+} pysam_faidx_t;
+
+BGZF *pysam_fai_get_bgzf(faidx_t *fai)
+{
+  return ((pysam_faidx_t*)fai)->bgzf;
+}
+
+void pysam_bgzf_profile_update(BGZF *fp)
+{
+  pysam_hfile_profile_t *p;
+  if (fp == NULL || (p = get_profile(fp->fp)) == NULL)
+    return;
+  if (fp->block_address != p->block_address)
+    {
+      p->stats->blocks += 1;
+      p->block_address = fp->block_address;
+    }
+  if (fp->uncompressed_address > p->uncompressed_address)
+    p->stats->uncompressed_bytes +=
+      fp->uncompressed_address - p->uncompressed_address;
+  p->uncompressed_address = fp->uncompressed_address;
+}
+
+#else
+
+int pysam_hfile_profile(hFILE *fp, pysam_io_stats_t *stats)
+{
+  return -1;
+}
+
+BGZF *pysam_fai_get_bgzf(faidx_t *fai)
+{
+  return NULL;
+}
+
+void pysam_bgzf_profile_update(BGZF *fp)
+{
+}
+
+#endif
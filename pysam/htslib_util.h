@@ -4,6 +4,23 @@
 #include "htslib/sam.h"
 #include "htslib/vcf.h"
 #include "htslib/khash.h"
+#include "htslib/bgzf.h"
+#include "htslib/hfile.h"
+#include "htslib/faidx.h"
+
+/*! set to 1 if structures private to htslib can be accessed.
+
+  Block cache statistics and I/O profiling mirror the layouts of
+  structures that are private to htslib and change between
+  versions. They are only enabled when building against the htslib
+  bundled with pysam, whose version setup.py passes as
+  PYSAM_BUNDLED_HTSLIB (major * 100 + minor).
+ */
+#if defined(PYSAM_BUNDLED_HTSLIB) && PYSAM_BUNDLED_HTSLIB == 103
+#define PYSAM_HTSLIB_INTERNALS 1
+#else
+#define PYSAM_HTSLIB_INTERNALS 0
+#endif
 
 int hts_useek(htsFile *fp, long uoffset, int where);
 long hts_utell(htsFile *fp);
@@ -56,12 +73,100 @@ bam1_t * pysam_bam_update(bam1_t * b,
 			  const size_t nbytes_new,
 			  uint8_t * pos);
 
+/*!
+  @abstract Resize the variable length data within a bam1_t entry
+
+  Memory is only re-allocated if the entry can not hold *size*
+  bytes. Existing data is not re-arranged.
+
+  @discussion Returns b->data or NULL if memory could not be allocated
+
+  @param  b           bam1_t data
+  @param  size        new size of variable length data
+*/
+uint8_t * pysam_bam_resize(bam1_t * b, const size_t size);
+
+/*!
+  @abstract Compute a 64-bit hash of a block of memory
+
+  The hash is MurmurHash64A by Austin Appleby. Hashes of several
+  blocks can be combined by passing the hash of the previous block
+  as *seed*.
+
+  @param  data        pointer to memory
+  @param  len         number of bytes
+  @param  seed        seed value
+*/
+uint64_t pysam_hash64(const void * data, const size_t len, uint64_t seed);
+
 // translate a nucleotide character to binary code
 unsigned char pysam_translate_sequence(const unsigned char s);
 
 // return byte size of type
 int aux_type2size(uint8_t type);
 
+//////////////////////////////////////////////////////////////////
+/*! return the number of inflated blocks held in the block cache
+  of a BGZF file opened for reading.
+
+  Returns 0 if htslib has been compiled without BGZF_CACHE or if
+  PYSAM_HTSLIB_INTERNALS is not set.
+ */
+int pysam_bgzf_cache_nblocks(BGZF *fp);
+
+//////////////////////////////////////////////////////////////////
+/*! I/O counters of a profiled file.
+
+  Reads, writes and seeks are counted on the hFILE and include the
+  time spent in them. Blocks and uncompressed bytes are counted by
+  observing the BGZF stream after reading, see
+  pysam_bgzf_profile_update.
+ */
+typedef struct {
+  int64_t bytes_read;
+  int64_t bytes_written;
+  int64_t read_calls;
+  int64_t write_calls;
+  int64_t seeks;
+  int64_t blocks;
+  int64_t uncompressed_bytes;
+  double io_seconds;
+} pysam_io_stats_t;
+
+/*! count reads, writes and seeks on *fp* in *stats*.
+
+  *stats* needs to remain valid until *fp* has been closed. Bytes
+  already read into the buffer of *fp* are counted as well.
+
+  Returns 0 on success and -1 on error or if PYSAM_HTSLIB_INTERNALS
+  is not set.
+*/
+int pysam_hfile_profile(hFILE *fp, pysam_io_stats_t *stats);
+
+/*! update block counters after reading from *fp*.
+
+  Blocks are counted when the current block has changed since the
+  last update, so a read spanning more than two blocks is counted as
+  a single block. Nothing is counted unless the hFILE of *fp* is
+  profiled.
+*/
+void pysam_bgzf_profile_update(BGZF *fp);
+
+/*! return the hFILE an htsFile reads from or writes to. */
+hFILE *pysam_hts_get_hfile(htsFile *fp);
+
+/*! return the BGZF stream of an htsFile or NULL if there is none. */
+BGZF *pysam_hts_get_bgzf(htsFile *fp);
+
+/*! return the BGZF stream of an indexed fasta file.
+
+  Returns NULL if PYSAM_HTSLIB_INTERNALS is not set.
+*/
+BGZF *pysam_fai_get_bgzf(faidx_t *fai);
+
+/*! return a monotonic time in seconds. */
+double pysam_clock();
+
 
 //-------------------------------------------------------
 // Wrapping accessor macros in sam.h
@@ -27,3 +27,657 @@ getline(char **line, size_t *linelen, FILE *fp)
 }
 #endif
 
+
+#include <string.h>
+#include <pthread.h>
+#include <zlib.h>
+#include "htslib/khash.h"
+#include "htslib_util.h"
+#include "tabix_util.h"
+
+// the s2i hash of htslib/tbx.c is declared in htslib_util.h
+
+#if PYSAM_HTSLIB_INTERNALS
+
+// layout of the interval struct private to htslib/tbx.c
+typedef struct {
+  int64_t beg, end;
+  char *ss, *se;
+  int tid;
+} tabix_intv_t;
+
+// layout of the bins and leading part of the index struct
+// private to htslib/hts.c
+typedef struct {
+  int32_t m, n;
+  uint64_t loff;
+  hts_pair64_t *list;
+} tabix_bins_t;
+
+KHASH_MAP_INIT_INT(tabix_bin, tabix_bins_t)
+
+typedef struct {
+  int fmt, min_shift, n_lvls, n_bins;
+  uint32_t l_meta;
+  int32_t n, m;
+  uint64_t n_no_coor;
+  khash_t(tabix_bin) **bidx;
+} tabix_idx_t;
+
+// not declared in htslib/tbx.h
+int tbx_parse1(const tbx_conf_t *conf, int len, char *line, tabix_intv_t *intv);
+void tbx_set_meta(tbx_t *tbx);
+
+// as get_tid() in htslib/tbx.c
+static int tabix_indexer_tid(tbx_t *tbx, const char *ss)
+{
+  int absent;
+  khash_t(s2i) *d = (khash_t(s2i)*)tbx->dict;
+  khint_t k = kh_put(s2i, d, ss, &absent);
+  if (absent)
+    {
+      kh_key(d, k) = strdup(ss);
+      kh_val(d, k) = kh_size(d) - 1;
+    }
+  return kh_val(d, k);
+}
+
+tabix_indexer_t *tabix_indexer_init(const tbx_conf_t *conf, int min_shift)
+{
+  tabix_indexer_t *w = (tabix_indexer_t*)calloc(1, sizeof(tabix_indexer_t));
+  if (w == NULL)
+    return NULL;
+  w->tbx = (tbx_t*)calloc(1, sizeof(tbx_t));
+  if (w->tbx == NULL)
+    {
+      free(w);
+      return NULL;
+    }
+  w->tbx->conf = *conf;
+  w->tbx->dict = kh_init(s2i);
+  // see tbx_index() in htslib/tbx.c
+  if (min_shift > 0)
+    {
+      w->min_shift = min_shift;
+      w->n_lvls = (TBX_MAX_SHIFT - min_shift + 2) / 3;
+      w->fmt = HTS_FMT_CSI;
+    }
+  else
+    {
+      w->min_shift = 14;
+      w->n_lvls = 5;
+      w->fmt = HTS_FMT_TBI;
+    }
+  return w;
+}
+
+// write line *s* of length *l* and index it. s[l] is either the
+// newline, which is written as well, or the terminal '\0'.
+static int tabix_indexer_line(tabix_indexer_t *w, BGZF *fp,
+			      char *s, size_t l, int has_newline)
+{
+  tabix_intv_t intv;
+  tbx_t *tbx = w->tbx;
+  int ret, c, len;
+
+  if (bgzf_write(fp, s, l + has_newline) < 0)
+    return -1;
+
+  ++w->lineno;
+  if (l == 0 || w->lineno <= tbx->conf.line_skip ||
+      s[0] == tbx->conf.meta_char)
+    {
+      w->last_off = bgzf_tell(fp);
+      return 0;
+    }
+
+  if (tbx->idx == NULL)
+    {
+      tbx->idx = hts_idx_init(0, w->fmt, w->last_off, w->min_shift, w->n_lvls);
+      if (tbx->idx == NULL)
+	return -1;
+    }
+
+  len = (s[l - 1] == '\r') ? l - 1 : l;
+  c = s[len];
+  s[len] = '\0';
+  ret = tbx_parse1(&tbx->conf, len, s, &intv);
+  if (ret == 0)
+    {
+      int d = *intv.se;
+      *intv.se = '\0';
+      intv.tid = tabix_indexer_tid(tbx, intv.ss);
+      *intv.se = d;
+    }
+  s[len] = c;
+  if (ret != 0 || intv.beg < 0 || intv.end < 0)
+    return -2;
+
+  if (hts_idx_push(tbx->idx, intv.tid, intv.beg, intv.end, bgzf_tell(fp), 1) < 0)
+    return -2;
+  return 0;
+}
+
+int tabix_indexer_write(tabix_indexer_t *w, BGZF *fp,
+			char *buffer, size_t length)
+{
+  char *p = buffer, *end = buffer + length, *nl;
+  int ret;
+
+  while (p < end)
+    {
+      nl = (char*)memchr(p, '\n', end - p);
+      if (nl == NULL)
+	{
+	  kputsn(p, end - p, &w->line);
+	  break;
+	}
+      if (w->line.l > 0)
+	{
+	  // complete the line started in a previous buffer
+	  kputsn(p, nl - p + 1, &w->line);
+	  ret = tabix_indexer_line(w, fp, w->line.s, w->line.l - 1, 1);
+	  w->line.l = 0;
+	}
+      else
+	ret = tabix_indexer_line(w, fp, p, nl - p, 1);
+      if (ret < 0)
+	return ret;
+      p = nl + 1;
+    }
+  return 0;
+}
+
+int tabix_indexer_finish(tabix_indexer_t *w, BGZF *fp)
+{
+  int ret;
+  if (w->line.l > 0)
+    {
+      ret = tabix_indexer_line(w, fp, w->line.s, w->line.l, 0);
+      w->line.l = 0;
+      if (ret < 0)
+	return ret;
+    }
+  if (bgzf_flush(fp) < 0)
+    return -1;
+  // empty file
+  if (w->tbx->idx == NULL)
+    {
+      w->tbx->idx = hts_idx_init(0, w->fmt, w->last_off, w->min_shift, w->n_lvls);
+      if (w->tbx->idx == NULL)
+	return -1;
+    }
+  hts_idx_finish(w->tbx->idx, bgzf_tell(fp));
+  tbx_set_meta(w->tbx);
+  return 0;
+}
+
+void tabix_indexer_destroy(tabix_indexer_t *w)
+{
+  if (w == NULL)
+    return;
+  tbx_destroy(w->tbx);
+  free(w->line.s);
+  free(w);
+}
+
+int tabix_index_window_sizes(const hts_idx_t *idx, int tid,
+			     int64_t **sizes, int *min_shift)
+{
+  const tabix_idx_t *x = (const tabix_idx_t*)idx;
+  khash_t(tabix_bin) *h;
+  tabix_bins_t *b;
+  khint_t k;
+  int i, w, n = 0;
+  int64_t *s;
+
+  *sizes = NULL;
+  *min_shift = x->min_shift;
+  if (tid < 0 || tid >= x->n || x->bidx[tid] == NULL)
+    return 0;
+  h = x->bidx[tid];
+
+  // bins above n_bins hold meta data
+  for (k = kh_begin(h); k != kh_end(h); ++k)
+    if (kh_exist(h, k) && kh_key(h, k) < x->n_bins)
+      {
+	w = hts_bin_bot(kh_key(h, k), x->n_lvls);
+	if (w >= n)
+	  n = w + 1;
+      }
+  if (n == 0)
+    return 0;
+
+  s = (int64_t*)calloc(n, sizeof(int64_t));
+  if (s == NULL)
+    return -1;
+  for (k = kh_begin(h); k != kh_end(h); ++k)
+    if (kh_exist(h, k) && kh_key(h, k) < x->n_bins)
+      {
+	// records in larger bins count for their first window
+	w = hts_bin_bot(kh_key(h, k), x->n_lvls);
+	b = &kh_val(h, k);
+	for (i = 0; i < b->n; ++i)
+	  s[w] += (b->list[i].v >> 16) - (b->list[i].u >> 16) + 1;
+      }
+  *sizes = s;
+  return n;
+}
+
+#else
+
+tabix_indexer_t *tabix_indexer_init(const tbx_conf_t *conf, int min_shift)
+{
+  return NULL;
+}
+
+int tabix_indexer_write(tabix_indexer_t *w, BGZF *fp,
+			char *buffer, size_t length)
+{
+  return -1;
+}
+
+int tabix_indexer_finish(tabix_indexer_t *w, BGZF *fp)
+{
+  return -1;
+}
+
+void tabix_indexer_destroy(tabix_indexer_t *w)
+{
+}
+
+int tabix_index_window_sizes(const hts_idx_t *idx, int tid,
+			     int64_t **sizes, int *min_shift)
+{
+  *sizes = NULL;
+  *min_shift = 0;
+  return -1;
+}
+
+#endif
+
+struct tabix_reader_t {
+  gzFile fp;
+  pthread_t thread;
+  pthread_mutex_t lock;
+  pthread_cond_t filled, emptied;
+  tabix_chunk_t *chunks;
+  size_t chunk_size;
+  // incomplete line at the end of the data read so far
+  char *carry;
+  size_t carry_l, carry_m;
+  // chunks[head] is the oldest of count filled chunks
+  int nchunks, head, count;
+  // chunks[head] has been handed to the caller
+  int borrowed;
+  int eof, error, closing;
+};
+
+static int tabix_reader_reserve(void **p, size_t *m, size_t size)
+{
+  void *q;
+  if (size <= *m)
+    return 0;
+  if (size < *m * 2)
+    size = *m * 2;
+  if ((q = realloc(*p, size)) == NULL)
+    return -1;
+  *p = q;
+  *m = size;
+  return 0;
+}
+
+// Read the next lines into *c*. Lines are read in units of
+// chunk_size bytes until at least one line is complete, so that long
+// lines are not split. Comments and empty lines are removed and the
+// remaining lines are moved together, each terminated by '\0'.
+//
+// Returns 1 on success, 0 at the end of the file and -1 on error.
+static int tabix_reader_fill(tabix_reader_t *r, tabix_chunk_t *c)
+{
+  size_t fill = r->carry_l, last, start, end, out = 0;
+  char *p;
+  int n, eof = 0;
+
+  if (tabix_reader_reserve((void**)&c->data, &c->m_data,
+			   fill + r->chunk_size + 1) < 0)
+    return -1;
+  memcpy(c->data, r->carry, fill);
+  r->carry_l = 0;
+
+  for (;;)
+    {
+      n = gzread(r->fp, c->data + fill, r->chunk_size);
+      if (n < 0)
+	return -1;
+      fill += n;
+      if (n == 0)
+	{
+	  eof = 1;
+	  break;
+	}
+      // the carried over part does not contain a newline
+      if (memchr(c->data + fill - n, '\n', n) != NULL)
+	break;
+      if (tabix_reader_reserve((void**)&c->data, &c->m_data,
+			       fill + r->chunk_size + 1) < 0)
+	return -1;
+    }
+
+  if (fill == 0)
+    return 0;
+
+  if (eof)
+    {
+      // last line without a newline
+      if (c->data[fill - 1] != '\n')
+	c->data[fill++] = '\n';
+      last = fill;
+    }
+  else
+    {
+      for (last = fill; c->data[last - 1] != '\n'; --last)
+	;
+      if (tabix_reader_reserve((void**)&r->carry, &r->carry_m,
+			       fill - last) < 0)
+	return -1;
+      memcpy(r->carry, c->data + last, fill - last);
+      r->carry_l = fill - last;
+    }
+
+  c->n = 0;
+  for (start = 0; start < last; start = end + 1)
+    {
+      p = (char*)memchr(c->data + start, '\n', last - start);
+      end = p - c->data;
+      // skip comments and empty lines
+      if (start == end || c->data[start] == '#' || c->data[start] == '\r')
+	continue;
+      if (tabix_reader_reserve((void**)&c->offsets, &c->m_offsets,
+			       (c->n + 2) * sizeof(size_t)) < 0)
+	return -1;
+      if (out != start)
+	memmove(c->data + out, c->data + start, end - start);
+      c->offsets[c->n++] = out;
+      out += end - start;
+      c->data[out++] = '\0';
+    }
+  if (tabix_reader_reserve((void**)&c->offsets, &c->m_offsets,
+			   (c->n + 1) * sizeof(size_t)) < 0)
+    return -1;
+  c->offsets[c->n] = out;
+  return 1;
+}
+
+static void *tabix_reader_run(void *data)
+{
+  tabix_reader_t *r = (tabix_reader_t*)data;
+  int slot, ret;
+  for (;;)
+    {
+      pthread_mutex_lock(&r->lock);
+      while (r->count == r->nchunks && !r->closing)
+	pthread_cond_wait(&r->emptied, &r->lock);
+      if (r->closing)
+	{
+	  pthread_mutex_unlock(&r->lock);
+	  break;
+	}
+      slot = (r->head + r->count) % r->nchunks;
+      pthread_mutex_unlock(&r->lock);
+
+      // the slot is not visible to the caller until counted
+      ret = tabix_reader_fill(r, &r->chunks[slot]);
+
+      pthread_mutex_lock(&r->lock);
+      if (ret > 0)
+	r->count++;
+      else if (ret == 0)
+	r->eof = 1;
+      else
+	r->error = 1;
+      pthread_cond_signal(&r->filled);
+      pthread_mutex_unlock(&r->lock);
+      if (ret <= 0)
+	break;
+    }
+  return NULL;
+}
+
+static void tabix_reader_free(tabix_reader_t *r)
+{
+  int i;
+  if (r->chunks != NULL)
+    for (i = 0; i < r->nchunks; ++i)
+      {
+	free(r->chunks[i].data);
+	free(r->chunks[i].offsets);
+      }
+  free(r->chunks);
+  free(r->carry);
+  free(r);
+}
+
+tabix_reader_t *tabix_reader_open(int fd, size_t chunk_size, int nchunks)
+{
+  tabix_reader_t *r;
+  if (chunk_size == 0 || nchunks < 1)
+    {
+      close(fd);
+      return NULL;
+    }
+  r = (tabix_reader_t*)calloc(1, sizeof(tabix_reader_t));
+  if (r == NULL)
+    {
+      close(fd);
+      return NULL;
+    }
+  r->chunk_size = chunk_size;
+  r->nchunks = nchunks;
+  // buffers are allocated when first filled
+  r->chunks = (tabix_chunk_t*)calloc(nchunks, sizeof(tabix_chunk_t));
+  if (r->chunks == NULL)
+    goto fail;
+  r->fp = gzdopen(fd, "r");
+  if (r->fp == NULL)
+    goto fail;
+  pthread_mutex_init(&r->lock, NULL);
+  pthread_cond_init(&r->filled, NULL);
+  pthread_cond_init(&r->emptied, NULL);
+  if (pthread_create(&r->thread, NULL, tabix_reader_run, r) != 0)
+    {
+      pthread_mutex_destroy(&r->lock);
+      pthread_cond_destroy(&r->filled);
+      pthread_cond_destroy(&r->emptied);
+      gzclose(r->fp);
+      tabix_reader_free(r);
+      return NULL;
+    }
+  return r;
+
+ fail:
+  close(fd);
+  tabix_reader_free(r);
+  return NULL;
+}
+
+int tabix_reader_next(tabix_reader_t *r, tabix_chunk_t **chunk)
+{
+  int ret;
+  pthread_mutex_lock(&r->lock);
+  if (r->borrowed)
+    {
+      r->head = (r->head + 1) % r->nchunks;
+      r->count--;
+      r->borrowed = 0;
+      pthread_cond_signal(&r->emptied);
+    }
+  while (r->count == 0 && !r->eof && !r->error)
+    pthread_cond_wait(&r->filled, &r->lock);
+  if (r->count > 0)
+    {
+      *chunk = &r->chunks[r->head];
+      r->borrowed = 1;
+      ret = 1;
+    }
+  else
+    ret = r->error ? -1 : 0;
+  pthread_mutex_unlock(&r->lock);
+  return ret;
+}
+
+void tabix_reader_close(tabix_reader_t *r)
+{
+  if (r == NULL)
+    return;
+  pthread_mutex_lock(&r->lock);
+  r->closing = 1;
+  pthread_cond_signal(&r->emptied);
+  pthread_mutex_unlock(&r->lock);
+  pthread_join(r->thread, NULL);
+  pthread_mutex_destroy(&r->lock);
+  pthread_cond_destroy(&r->filled);
+  pthread_cond_destroy(&r->emptied);
+  gzclose(r->fp);
+  tabix_reader_free(r);
+}
+
+void tabix_intervals_index(tabix_intervals_t *iv)
+{
+  long i, last_i = 0, x, n = iv->n;
+  int64_t last = 0, e;
+  int k;
+
+  iv->height = 0;
+  if (n <= 0)
+    return;
+
+  // leaves are at even positions
+  for (i = 0; i < n; i += 2)
+    {
+      last_i = i;
+      last = iv->maxends[i] = iv->ends[i];
+    }
+
+  for (k = 1; (1L << k) <= n; ++k)
+    {
+      x = 1L << (k - 1);
+      for (i = (x << 1) - 1; i < n; i += x << 2)
+	{
+	  e = iv->ends[i];
+	  if (iv->maxends[i - x] > e)
+	    e = iv->maxends[i - x];
+	  // the right child might lie beyond the end of the array,
+	  // in which case its subtree ends with the last node
+	  if (i + x < n)
+	    {
+	      if (iv->maxends[i + x] > e)
+		e = iv->maxends[i + x];
+	    }
+	  else if (last > e)
+	    e = last;
+	  iv->maxends[i] = e;
+	}
+      // largest end in the subtree of the last node at level k
+      last_i = (last_i >> k & 1) ? last_i : last_i + x;
+      if (last_i < n && iv->maxends[last_i] > last)
+	last = iv->maxends[last_i];
+    }
+  iv->height = k - 1;
+}
+
+// append the positions of the intervals overlapping [beg, end) to
+// *found*, which holds *n* elements in *m* bytes.
+static int tabix_intervals_collect(const tabix_intervals_t *iv,
+				   int64_t beg, int64_t end,
+				   long **found, size_t *n, size_t *m)
+{
+  // nodes to visit and whether their left subtree has been visited
+  struct { long x; int k, left_done; } stack[128], z;
+  int t = 0;
+  long y;
+
+  if (iv->n <= 0)
+    return 0;
+
+  stack[t].x = (1L << iv->height) - 1;
+  stack[t].k = iv->height;
+  stack[t++].left_done = 0;
+
+  // in-order traversal, so that intervals are found by start
+  while (t > 0)
+    {
+      z = stack[--t];
+      if (z.k == 0 || z.left_done)
+	{
+	  // nodes beyond the array only have children beyond it on
+	  // the right
+	  if (z.x >= iv->n || iv->starts[z.x] >= end)
+	    continue;
+	  if (iv->ends[z.x] > beg)
+	    {
+	      if (tabix_reader_reserve((void**)found, m,
+				       (*n + 1) * sizeof(long)) < 0)
+		return -1;
+	      (*found)[(*n)++] = z.x;
+	    }
+	  if (z.k > 0)
+	    {
+	      stack[t].x = z.x + (1L << (z.k - 1));
+	      stack[t].k = z.k - 1;
+	      stack[t++].left_done = 0;
+	    }
+	}
+      else
+	{
+	  stack[t] = z;
+	  stack[t++].left_done = 1;
+	  // a left child beyond the array has nodes within it
+	  y = z.x - (1L << (z.k - 1));
+	  if (y >= iv->n || iv->maxends[y] > beg)
+	    {
+	      stack[t].x = y;
+	      stack[t].k = z.k - 1;
+	      stack[t++].left_done = 0;
+	    }
+	}
+    }
+  return 0;
+}
+
+long tabix_intervals_overlap(const tabix_intervals_t *iv,
+			     int64_t beg, int64_t end,
+			     long **found, size_t *m_found)
+{
+  size_t n = 0;
+  if (tabix_intervals_collect(iv, beg, end, found, &n, m_found) < 0)
+    return -1;
+  return n;
+}
+
+long tabix_intervals_query(const tabix_intervals_t *iv,
+			   const long *positions, long npos,
+			   long **qidx, size_t *m_qidx,
+			   long **hits, size_t *m_hits)
+{
+  size_t n = 0, first;
+  long x;
+
+  for (x = 0; x < npos; ++x)
+    {
+      first = n;
+      if (tabix_intervals_collect(iv, positions[x], (int64_t)positions[x] + 1,
+				  hits, &n, m_hits) < 0)
+	return -1;
+      if (n == first)
+	continue;
+      if (tabix_reader_reserve((void**)qidx, m_qidx, n * sizeof(long)) < 0)
+	return -1;
+      for (; first < n; ++first)
+	{
+	  (*qidx)[first] = x;
+	  (*hits)[first] = iv->ids[(*hits)[first]];
+	}
+    }
+  return n;
+}
@@ -1,3 +1,6 @@
+#ifndef TABIX_UTIL_H
+#define TABIX_UTIL_H
+
 /* See issue 122
    On some MACOSX systems getline is not defined.
  */
@@ -6,7 +9,153 @@
 ssize_t getline(char **line, size_t *linelen, FILE *fp);
 #endif
 
+#include "htslib/bgzf.h"
+#include "htslib/kstring.h"
+#include "htslib/tbx.h"
+
+//////////////////////////////////////////////////////////////////
+/*! state for building a tabix index while compressing a file
+
+  Lines are indexed as they are written, using the virtual
+  file offsets of the output, so that the compressed file does not
+  need to be read again.
+ */
+typedef struct {
+  tbx_t *tbx;
+  int min_shift, n_lvls, fmt;
+  int64_t lineno;
+  uint64_t last_off;
+  // incomplete line carried over between writes
+  kstring_t line;
+} tabix_indexer_t;
+
+/*! create an indexer for *conf*.
+
+  A *min_shift* > 0 builds a CSI index, otherwise a TBI index.
+
+  Lines are parsed using a structure private to htslib. Returns
+  NULL if PYSAM_HTSLIB_INTERNALS is not set.
+ */
+tabix_indexer_t *tabix_indexer_init(const tbx_conf_t *conf, int min_shift);
+
+/*! write *length* bytes of *buffer* to *fp* and index all complete
+  lines. The buffer is modified temporarily.
+
+  Returns 0 on success, -1 on write error and -2 if a line could not
+  be parsed.
+ */
+int tabix_indexer_write(tabix_indexer_t *w, BGZF *fp,
+			char *buffer, size_t length);
+
+/*! write and index an incomplete last line and finish the index.
+
+  Returns as tabix_indexer_write.
+ */
+int tabix_indexer_finish(tabix_indexer_t *w, BGZF *fp);
+
+void tabix_indexer_destroy(tabix_indexer_t *w);
+
+//////////////////////////////////////////////////////////////////
+/*! estimate the compressed size of the records in each window of
+  sequence *tid* from the chunks in the bins of the index.
+
+  Window i starts at position i << *min_shift*. Records in bins
+  spanning several windows are counted in the first one. *sizes*
+  is allocated and needs to be freed by the caller.
+
+  Returns the number of windows, 0 if there are no records and -1
+  on error or if PYSAM_HTSLIB_INTERNALS is not set.
+ */
+int tabix_index_window_sizes(const hts_idx_t *idx, int tid,
+			     int64_t **sizes, int *min_shift);
+
+//////////////////////////////////////////////////////////////////
+/*! reader decompressing a file on a separate thread
+
+  The file is read in chunks into a ring of buffers, so that
+  decompression and processing of the data overlap. The reader
+  thread also splits the data into lines.
+ */
+typedef struct tabix_reader_t tabix_reader_t;
+
+/*! lines read by a tabix_reader_t
+
+  *data* holds *n* '\0'-terminated lines without comments and
+  empty lines. Line i starts at offsets[i] and is
+  offsets[i + 1] - offsets[i] - 1 bytes long.
+ */
+typedef struct {
+  char *data;
+  size_t *offsets;
+  int n;
+  // allocated sizes in bytes
+  size_t m_data, m_offsets;
+} tabix_chunk_t;
+
+/*! start reading from the (gzip compressed or plain) file
+  descriptor *fd* in chunks of *chunk_size* bytes using *nchunks*
+  buffers. The descriptor is closed by tabix_reader_close.
 
+  Returns NULL on error, in which case the descriptor is closed.
+ */
+tabix_reader_t *tabix_reader_open(int fd, size_t chunk_size, int nchunks);
 
+/*! return the next chunk of lines in *chunk*, releasing the
+  previous one. Chunks contain complete lines only, though they
+  might contain no lines at all. The chunk stays valid until the
+  next call.
 
+  Returns 1 on success, 0 at the end of the file and -1 on error.
+ */
+int tabix_reader_next(tabix_reader_t *r, tabix_chunk_t **chunk);
+
+/*! stop reading and close the file. */
+void tabix_reader_close(tabix_reader_t *r);
+
+//////////////////////////////////////////////////////////////////
+/*! intervals sorted by start for overlap queries
+
+  The array is laid out as an implicit binary search tree, as in
+  cgranges: the interval at position i is a node at level k if the
+  k lowest bits of i are set. Each node holds the largest end in
+  its subtree, so that a query takes O(log n + hits) time, however
+  long the intervals are.
+ */
+typedef struct {
+  int64_t *starts, *ends, *maxends;
+  // numbers of the intervals
+  long *ids;
+  long n;
+  // level of the root
+  int height;
+} tabix_intervals_t;
 
+/*! compute *maxends* and *height* of intervals sorted by start. */
+void tabix_intervals_index(tabix_intervals_t *iv);
+
+/*! find the intervals overlapping [beg, end).
+
+  Their positions in the arrays are stored in *found* by increasing
+  start. *found* is *m_found* bytes large and grown as needed.
+
+  Returns the number of intervals found and -1 on error.
+ */
+long tabix_intervals_overlap(const tabix_intervals_t *iv,
+			     int64_t beg, int64_t end,
+			     long **found, size_t *m_found);
+
+/*! find the intervals containing each of *npos* *positions*.
+
+  For each hit, the index of the position is stored in *qidx* and
+  the number of the interval in *hits*. Hits are sorted by position
+  index and then by interval start. *qidx* and *hits* are *m_qidx*
+  and *m_hits* bytes large and grown as needed.
+
+  Returns the number of hits and -1 on error.
+ */
+long tabix_intervals_query(const tabix_intervals_t *iv,
+			   const long *positions, long npos,
+			   long **qidx, size_t *m_qidx,
+			   long **hits, size_t *m_hits);
+
+#endif
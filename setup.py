@@ -396,6 +396,16 @@ else:
 
 define_macros = []
 
+# htslib_util.c accesses structures private to htslib. Their layouts
+# are only known for the bundled htslib, see htslib_util.h.
+if HTSLIB_LIBRARY_DIR is None:
+    with open(os.path.join("htslib", "version.h")) as inf:
+        htslib_version = re.search(
+            r'#define HTS_VERSION "(\d+)\.(\d+)', inf.read()).groups()
+    define_macros.append(
+        ("PYSAM_BUNDLED_HTSLIB",
+         str(int(htslib_version[0]) * 100 + int(htslib_version[1]))))
+
 chtslib = Extension(
     "pysam.libchtslib",
     [source_pattern % "htslib",
@@ -474,6 +484,7 @@ calignedsegment = Extension(
 ctabix = Extension(
     "pysam.ctabix",
     [source_pattern % "tabix",
+     "pysam/htslib_util.c",
      "pysam/tabix_util.c"] +
     htslib_sources +
     os_c_files,
@@ -487,7 +498,9 @@ ctabix = Extension(
 
 cutils = Extension(
     "pysam.cutils",
-    [source_pattern % "utils", "pysam/pysam_util.c"] +
+    [source_pattern % "utils",
+     "pysam/pysam_util.c",
+     "pysam/htslib_util.c"] +
     glob.glob(os.path.join("samtools", "*.pysam.c")) +
     # glob.glob(os.path.join("samtools", "*", "*.pysam.c")) +
     glob.glob(os.path.join("bcftools", "*.pysam.c")) +
@@ -505,7 +518,8 @@ cutils = Extension(
 
 cfaidx = Extension(
     "pysam.cfaidx",
-    [source_pattern % "faidx"] +
+    [source_pattern % "faidx",
+     "pysam/htslib_util.c"] +
     htslib_sources +
     os_c_files,
     library_dirs=["pysam"] + htslib_library_dirs,
@@ -521,7 +535,7 @@ ctabixproxies = Extension(
     [source_pattern % "tabixproxies"] +
     os_c_files,
     library_dirs=htslib_library_dirs,
-    include_dirs=include_os,
+    include_dirs=["pysam", "."] + include_os + htslib_include_dirs,
     libraries=external_htslib_libraries + internal_htslib_libraries,
     language="c",
     extra_compile_args=extra_compile_args,
@@ -542,7 +556,8 @@ cvcf = Extension(
 
 cbcf = Extension(
     "pysam.cbcf",
-    [source_pattern % "bcf"] +
+    [source_pattern % "bcf",
+     "pysam/htslib_util.c"] +
     htslib_sources +
     os_c_files,
     library_dirs=htslib_library_dirs,
@@ -4,6 +4,7 @@ import unittest
 import collections
 import copy
 import array
+import pickle
 
 from TestUtils import checkFieldEqual
 
@@ -93,6 +94,28 @@ class TestAlignedSegment(ReadTest):
         b.tid = 2
         self.assertNotEqual(hash(a), hash(b))
 
+    def testHashingIncludesData(self):
+        a = self.buildRead()
+        b = self.buildRead()
+        b.query_name = "read_54321"
+        self.assertNotEqual(hash(a), hash(b))
+
+    def testContentHash(self):
+        a = self.buildRead()
+        b = self.buildRead()
+        b.mapping_quality = 60
+        b.set_tag("NM", 2)
+        self.assertEqual(a.content_hash(), b.content_hash())
+        self.assertNotEqual(hash(a), hash(b))
+
+        b.is_reverse = True
+        self.assertNotEqual(a.content_hash(), b.content_hash())
+        self.assertEqual(
+            a.content_hash(fields=("query_sequence", "reference_start")),
+            b.content_hash(fields=("query_sequence", "reference_start")))
+        self.assertNotEqual(a.content_hash(seed=1), a.content_hash())
+        self.assertRaises(ValueError, a.content_hash, fields=("qname",))
+
     def testUpdate(self):
         '''check if updating fields affects other variable length data
         '''
@@ -180,6 +203,96 @@ class TestAlignedSegment(ReadTest):
 
         return a
 
+    def testFromFields(self):
+        a = self.buildRead()
+        b = pysam.AlignedSegment.from_fields(
+            query_name="read_12345",
+            flag=0,
+            reference_id=0,
+            reference_start=20,
+            mapping_quality=20,
+            cigartuples=((0, 10), (2, 1), (0, 9), (1, 1), (0, 20)),
+            next_reference_id=0,
+            next_reference_start=200,
+            template_length=167,
+            query_sequence=b"ACGT" * 10,
+            query_qualities=pysam.qualitystring_to_array("1234") * 10)
+        self.assertEqual(a, b)
+        self.assertEqual(a.bin, b.bin)
+
+    def testSetFieldsReplacesContent(self):
+        a = self.buildRead()
+        a.set_tag("NM", 1)
+        a.set_fields(query_name="r2",
+                     reference_id=1,
+                     reference_start=5,
+                     cigarstring="3M1S",
+                     query_sequence="ACGT",
+                     tags=[("RG", "grp")])
+        self.assertEqual(a.query_name, "r2")
+        self.assertEqual(a.cigartuples, [(0, 3), (4, 1)])
+        self.assertEqual(a.query_sequence, "ACGT")
+        self.assertEqual(a.query_qualities, None)
+        self.assertEqual(a.tags, [("RG", "grp")])
+        self.assertEqual(a.next_reference_id, -1)
+
+        a.set_fields(query_name="r3", query_sequence="ACG",
+                     query_qualities=bytearray([30, 31, 32]))
+        self.assertEqual(list(a.query_qualities), [30, 31, 32])
+        self.assertEqual(a.cigartuples, None)
+        self.assertEqual(a.tags, [])
+
+        self.assertRaises(ValueError, a.set_fields,
+                          query_sequence="ACG", query_qualities=[30])
+        self.assertRaises(ValueError, a.set_fields,
+                          cigartuples=[(0, 3)], cigarstring="3M")
+
+    def testSetFieldsWithoutName(self):
+        a = self.buildRead()
+        for query_name in (None, ""):
+            a.set_fields(query_name=query_name, cigarstring="3M",
+                         query_sequence="ACG")
+            self.assertEqual(a.query_name, "*")
+            self.assertEqual(a.cigarstring, "3M")
+            self.assertEqual(a.query_sequence, "ACG")
+            b = pysam.AlignedSegment.from_bytes(a.to_bytes())
+            self.assertEqual(b.query_name, "*")
+
+    def testSetFieldsFromStridedBuffers(self):
+        a = self.buildRead()
+        a.set_fields(query_name="r1",
+                     query_sequence=memoryview(b"AXCXGX")[::2],
+                     query_qualities=memoryview(bytearray(
+                         [30, 0, 31, 0, 32, 0]))[::2])
+        self.assertEqual(a.query_sequence, "ACG")
+        self.assertEqual(list(a.query_qualities), [30, 31, 32])
+
+        a.query_qualities = memoryview(bytearray([33, 0, 34, 0, 35]))[::2]
+        self.assertEqual(list(a.query_qualities), [33, 34, 35])
+
+    def testSequenceBytes(self):
+        a = self.buildRead()
+        a.query_sequence = "ACGTN"
+        self.assertEqual(a.query_sequence_bytes, b"ACGTN")
+        self.assertEqual(a.query_alignment_sequence, "ACGTN")
+        a.cigarstring = "1S3M1S"
+        self.assertEqual(a.query_alignment_sequence, "CGT")
+        a.query_sequence = None
+        self.assertEqual(a.query_sequence_bytes, None)
+
+    def testSequencePacked(self):
+        a = self.buildRead()
+        a.query_sequence = "ACGTN"
+        packed = a.query_sequence_packed
+        # A=1, C=2, G=4, T=8, N=15
+        self.assertEqual(list(bytearray(packed)), [0x12, 0x48, 0xf0])
+        # the copy is not affected by changes to the alignment
+        a.query_name = "a" * 200
+        a.query_sequence = "TTTTT"
+        self.assertEqual(list(bytearray(packed)), [0x12, 0x48, 0xf0])
+        a.query_sequence = None
+        self.assertEqual(a.query_sequence_packed, None)
+
     def testUpdateTlen(self):
         '''check if updating tlen works'''
         a = self.buildRead()
@@ -226,6 +339,140 @@ class TestAlignedSegment(ReadTest):
         self.assertEqual(100,
                          len(a.get_reference_positions(full_length=True)))
 
+    def testPositionsAsArray(self):
+        a = self.buildRead()
+        a.cigartuples = ((4, 2), (0, 10), (2, 1), (0, 9), (1, 1), (0, 18))
+        positions = a.get_reference_positions(as_array=True)
+        self.assertTrue(isinstance(positions, array.array))
+        self.assertEqual(list(positions), a.get_reference_positions())
+        self.assertEqual(
+            list(a.get_reference_positions(full_length=True,
+                                           as_array=True)),
+            [-1 if x is None else x for x in
+             a.get_reference_positions(full_length=True)])
+
+        for matches_only in (False, True):
+            pairs = a.get_aligned_pairs(matches_only=matches_only)
+            qpos, rpos = a.get_aligned_pairs(matches_only=matches_only,
+                                             as_array=True)
+            self.assertEqual(qpos.typecode, "i")
+            self.assertEqual(list(qpos),
+                             [-1 if x is None else x for x, y in pairs])
+            self.assertEqual(list(rpos),
+                             [-1 if y is None else y for x, y in pairs])
+
+    def testAlignedPairsAsArrayWithSequence(self):
+        a = self.buildRead()
+        a.query_sequence = "A" * 9
+        a.cigarstring = "5M2D2I2M"
+        a.set_tag("MD", "4C^TT2")
+        qpos, rpos, bases = a.get_aligned_pairs(with_seq=True,
+                                                as_array=True)
+        pairs = a.get_aligned_pairs(with_seq=True)
+        self.assertEqual(list(qpos),
+                         [-1 if x is None else x for x, y, z in pairs])
+        self.assertEqual(list(rpos),
+                         [-1 if y is None else y for x, y, z in pairs])
+        self.assertEqual([chr(x) if x else None for x in bases],
+                         [z for x, y, z in pairs])
+
+    def testAlignedPairsMatchesOnlyWithSequence(self):
+        # reference bases after a deletion are those following it
+        a = self.buildRead()
+        a.query_sequence = "A" * 9
+        a.cigarstring = "5M2D2I2M"
+        a.set_tag("MD", "4C^TT2")
+        pairs = a.get_aligned_pairs(matches_only=True, with_seq=True)
+        self.assertEqual([z for x, y, z in pairs], list("AAAAcAA"))
+        qpos, rpos, bases = a.get_aligned_pairs(matches_only=True,
+                                                with_seq=True,
+                                                as_array=True)
+        self.assertEqual(list(qpos), [x for x, y, z in pairs])
+        self.assertEqual(list(rpos), [y for x, y, z in pairs])
+        self.assertEqual([chr(x) for x in bases], [z for x, y, z in pairs])
+
+    def testCigarStats(self):
+        a = self.buildRead()
+        a.cigarstring = "2H3S10M1D9M2N1I17M5S"
+        stats = a.cigar_stats()
+        self.assertEqual(stats.query_length, a.infer_query_length())
+        self.assertEqual(stats.query_alignment_length, 37)
+        self.assertEqual(stats.aligned_length, 36)
+        self.assertEqual(stats.reference_length, a.reference_length)
+        self.assertEqual((stats.soft_clip_start, stats.soft_clip_end,
+                          stats.hard_clip_start, stats.hard_clip_end),
+                         (3, 5, 2, 0))
+        self.assertEqual((stats.insertions, stats.inserted_bases,
+                          stats.deletions, stats.deleted_bases,
+                          stats.skipped_bases),
+                         (1, 1, 1, 1, 2))
+
+        a.cigartuples = None
+        self.assertEqual(list(a.cigar_stats()), [0] * len(stats))
+
+    def testCigarStatsToArrays(self):
+        a = self.buildRead()
+        b = self.buildRead()
+        b.cigarstring = "5S35M"
+        stats = pysam.cigar_stats_to_arrays([a, b])
+        self.assertEqual(list(stats.reference_length),
+                         [a.reference_length, b.reference_length])
+        self.assertEqual(list(stats.soft_clip_start), [0, 5])
+        self.assertEqual(stats.deletions.typecode, "l")
+
+    def testCigarArray(self):
+        a = self.buildRead()
+        cigar = a.cigar_array
+        self.assertEqual(cigar.typecode, "I")
+        self.assertEqual([(x & 0xf, x >> 4) for x in cigar],
+                         a.cigartuples)
+        self.assertEqual(pysam.cigar_query_length(cigar),
+                         a.infer_query_length())
+        self.assertEqual(pysam.cigar_reference_length(cigar),
+                         a.reference_length)
+
+        # soft clip the first 5 bases
+        cigar[0] = (10 - 5) << 4 | 0
+        cigar.insert(0, 5 << 4 | 4)
+        a.reference_start += 5
+        a.cigar_array = cigar
+        self.assertEqual(a.cigarstring, "5S5M1D9M1I20M")
+        self.assertEqual(a.reference_end, 60)
+
+        a.cigar_array = [40 << 4 | 0]
+        self.assertEqual(a.cigartuples, [(0, 40)])
+
+        # other buffer types are converted
+        a.cigar_array = array.array("i", [30 << 4 | 0])
+        self.assertEqual(a.cigartuples, [(0, 30)])
+        self.assertRaises(OverflowError, setattr, a, "cigar_array",
+                          array.array("i", [-1]))
+        self.assertRaises(TypeError, setattr, a, "cigar_array",
+                          array.array("f", [1.0]))
+        self.assertRaises(TypeError, pysam.cigar_query_length,
+                          array.array("f", [1.0]))
+        self.assertEqual(a.cigartuples, [(0, 30)])
+        # strided buffer
+        cigar = array.array("I", [20 << 4 | 0, 0, 10 << 4 | 4, 0])
+        a.cigar_array = memoryview(cigar)[::2]
+        self.assertEqual(a.cigartuples, [(0, 20), (4, 10)])
+
+        a.cigar_array = None
+        self.assertEqual(a.cigar_array, None)
+        self.assertEqual(a.cigartuples, None)
+
+    def testCigarArrayUpdatesAlignment(self):
+        a = self.buildRead()
+        self.assertEqual(a.query_alignment_sequence, "ACGT" * 10)
+        self.assertEqual(len(a.query_alignment_qualities), 40)
+        # soft clip two bases at either end
+        a.cigar_array = array.array("I", [2 << 4 | 4, 36 << 4 | 0,
+                                          2 << 4 | 4])
+        self.assertEqual(a.query_alignment_sequence,
+                         ("ACGT" * 10)[2:-2])
+        self.assertEqual(pysam.qualities_to_qualitystring(
+            a.query_alignment_qualities), ("1234" * 10)[2:-2])
+
     def testBlocks(self):
         a = self.buildRead()
         self.assertEqual(a.get_blocks(),
@@ -368,6 +615,89 @@ class TestAlignedPairs(unittest.TestCase):
             self.assertEqual(len(set(y)), 1)
 
 
+
+class TestReferenceFromFasta(unittest.TestCase):
+    filename = os.path.join(DATADIR, "ex2.bam")
+    fastafile = os.path.join(DATADIR, "ex1.fa")
+
+    def getCalmdTags(self):
+        '''return (MD, NM) of each read as computed by samtools calmd.'''
+        output = pysam.calmd(self.filename, self.fastafile)
+        if isinstance(output, bytes):
+            output = output.decode("ascii")
+        tags = []
+        for line in output.splitlines():
+            if line.startswith("@"):
+                continue
+            fields = dict((x[:2], x[5:]) for x in line.split("\t")[11:])
+            tags.append((fields.get("MD"),
+                         int(fields["NM"]) if "NM" in fields else None))
+        return tags
+
+    def testComputeMD(self):
+        expected = self.getCalmdTags()
+        nchecked = 0
+        with pysam.AlignmentFile(self.filename) as inf, \
+                pysam.FastaFile(self.fastafile) as fasta:
+            reads = list(inf.fetch(until_eof=True))
+            self.assertEqual(len(reads), len(expected))
+            for read, tags in zip(reads, expected):
+                if read.is_unmapped:
+                    continue
+                self.assertEqual(read.compute_md(fasta), tags)
+                # mismatches besides deletions
+                deleted = sum([l for op, l in read.cigartuples if op == 2])
+                if deleted and tags[1] > deleted:
+                    nchecked += 1
+        self.assertTrue(nchecked > 0)
+
+    def testFillMD(self):
+        expected = self.getCalmdTags()
+        with pysam.AlignmentFile(self.filename) as inf, \
+                pysam.FastaFile(self.fastafile) as fasta:
+            reads = list(inf.fetch(until_eof=True))
+            for read, tags in zip(pysam.fill_md(reads, fasta), expected):
+                if read.is_unmapped:
+                    self.assertFalse(read.has_tag("MD"))
+                    continue
+                self.assertEqual((read.get_tag("MD"), read.get_tag("NM")),
+                                 tags)
+
+    def testReferenceSequenceFromMD(self):
+        # MD tags from samtools calmd and the fasta file agree
+        expected = self.getCalmdTags()
+        with pysam.AlignmentFile(self.filename) as inf, \
+                pysam.FastaFile(self.fastafile) as fasta:
+            for read, (md, nm) in zip(inf.fetch(until_eof=True), expected):
+                if read.is_unmapped:
+                    continue
+                read.set_tag("MD", md, "Z")
+                self.assertEqual(read.get_reference_sequence(),
+                                 read.get_reference_sequence(fasta))
+                self.assertEqual(
+                    read.get_aligned_pairs(with_seq=True),
+                    read.get_aligned_pairs(with_seq=True, fastafile=fasta))
+
+    def testReferenceSequence(self):
+        with pysam.AlignmentFile(self.filename) as inf, \
+                pysam.FastaFile(self.fastafile) as fasta:
+            for read in inf.fetch(until_eof=True):
+                if read.is_unmapped:
+                    continue
+                self.assertEqual(
+                    read.get_reference_sequence(fasta).upper(),
+                    fasta.fetch(read.reference_name,
+                                read.reference_start,
+                                read.reference_end).upper())
+
+    def testWithoutAlignmentFile(self):
+        a = pysam.AlignedSegment()
+        a.query_sequence = "ACGT"
+        a.cigarstring = "4M"
+        with pysam.FastaFile(self.fastafile) as fasta:
+            self.assertRaises(ValueError, a.compute_md, fasta)
+
+
 class TestTags(ReadTest):
 
     def testMissingTag(self):
@@ -392,6 +722,44 @@ class TestTags(ReadTest):
         a.set_tag("NM", None)
         a.set_tag("NM", None)
 
+    def testGetTagsSubset(self):
+        a = self.buildRead()
+        a.tags = (("NM", 1), ("RG", "GJP00TM04"), ("XA", "A"),
+                  ("FZ", array.array("H", range(3))), ("AS", 30))
+        self.assertEqual(a.get_tags_subset(["AS", "RG", "XS", "NM"]),
+                         [30, "GJP00TM04", None, 1])
+        self.assertEqual(a.get_tags_subset(["XS"], default=-1), [-1])
+        self.assertEqual(list(a.get_tags_subset(["FZ"])[0]), [0, 1, 2])
+        self.assertEqual(a.get_tags_subset([]), [])
+        self.assertRaises(ValueError, a.get_tags_subset, ["NMX"])
+
+    def testTagsToArrays(self):
+        reads = []
+        for x, tags in enumerate(((("NM", 1), ("CB", "AAC")),
+                                  (("CB", "TTG"),),
+                                  (("NM", 3), ("CB", "AAC"), ("XF", 0.5)))):
+            a = self.buildRead()
+            a.tags = tags
+            reads.append(a)
+
+        nm, cb, xf, xs = pysam.tags_to_arrays(reads,
+                                              ["NM", "CB", "XF", "XS"])
+        self.assertEqual(nm.typecode, "l")
+        self.assertEqual(list(nm), [1, -1, 3])
+        codes, values = cb
+        self.assertEqual(list(codes), [0, 1, 0])
+        self.assertEqual(values, ["AAC", "TTG"])
+        self.assertEqual(xf.typecode, "d")
+        self.assertNotEqual(xf[0], xf[0])
+        self.assertEqual(xf[2], 0.5)
+        self.assertEqual(list(xs), [-1, -1, -1])
+
+        nm, = pysam.tags_to_arrays(reads, ["NM"], dtypes=["i"], missing=0)
+        self.assertEqual(nm.typecode, "i")
+        self.assertEqual(list(nm), [1, 0, 3])
+        self.assertRaises(ValueError, pysam.tags_to_arrays,
+                          reads, ["CB"], ["i"])
+
     def testArrayTags(self):
         read = self.buildRead()
         supported_dtypes = "bhBHf"
@@ -652,6 +1020,38 @@ class TestCopy(ReadTest):
         self.assertEqual(b.query_name, 'ReadB')
 
 
+class TestSerialization(ReadTest):
+
+    def testBytes(self):
+        a = self.buildRead()
+        a.set_tag("NM", 1)
+        b = pysam.AlignedSegment.from_bytes(a.to_bytes())
+        self.assertEqual(a, b)
+        self.assertEqual(b.get_tag("NM"), 1)
+
+    def testPickle(self):
+        a = self.buildRead()
+        b = pickle.loads(pickle.dumps(a, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(a, b)
+        b.query_name = "ReadB"
+        self.assertEqual(a.query_name, "read_12345")
+
+    def testPackSegments(self):
+        with pysam.AlignmentFile(
+                os.path.join(DATADIR, "ex2.bam"), "rb") as inf:
+            reads = list(inf)
+        data = pysam.pack_segments(reads)
+        self.assertEqual(pysam.unpack_segments(data), reads)
+        self.assertEqual(pysam.unpack_segments(memoryview(data), 2),
+                         reads[:2])
+        self.assertEqual(pysam.unpack_segments(b""), [])
+
+    def testUnpackTruncated(self):
+        data = pysam.pack_segments([self.buildRead()])
+        self.assertRaises(ValueError, pysam.unpack_segments, data[:-1])
+        self.assertRaises(ValueError, pysam.unpack_segments, data[:10])
+
+
 class TestAsString(unittest.TestCase):
 
     def testAsString(self):
@@ -1876,6 +1876,91 @@ class TestDoubleFetch(unittest.TestCase):
             self.assertEqual(a.compare(b), 0)
 
 
+class TestBlockCache(unittest.TestCase):
+
+    filename = os.path.join(DATADIR, 'ex1.bam')
+
+    def testFetch(self):
+        with pysam.AlignmentFile(self.filename, 'rb') as samfile:
+            expected = [r.tostring(samfile)
+                        for r in samfile.fetch('chr1', 100, 1000)]
+
+        with pysam.AlignmentFile(self.filename, 'rb',
+                                 cache_size=1 << 22) as samfile:
+            for x in range(3):
+                self.assertEqual(
+                    [r.tostring(samfile)
+                     for r in samfile.fetch('chr1', 100, 1000)],
+                    expected)
+            stats = samfile.get_cache_statistics()
+
+        self.assertEqual(sorted(stats), ['blocks', 'cache_size'])
+        self.assertTrue(stats['blocks'] > 0)
+
+
+class TestIOStats(unittest.TestCase):
+
+    filename = os.path.join(DATADIR, 'ex1.bam')
+
+    def testRead(self):
+        with pysam.AlignmentFile(self.filename, 'rb',
+                                 profile=True) as samfile:
+            nreads = len(list(samfile.fetch(until_eof=True)))
+            nregion = len(list(samfile.fetch('chr1', 100, 1000)))
+        stats = samfile.stats()
+        self.assertEqual(stats['records'], nreads + nregion)
+        self.assertEqual(stats['wrappers'], nreads + nregion)
+        self.assertTrue(stats['bytes_read'] >=
+                        os.path.getsize(self.filename))
+        self.assertTrue(stats['blocks'] > 0)
+        self.assertTrue(stats['uncompressed_bytes'] >
+                        stats['bytes_read'])
+        self.assertTrue(stats['seeks'] > 0)
+        self.assertEqual(stats['bytes_written'], 0)
+
+    def testMultipleIterators(self):
+        with pysam.AlignmentFile(self.filename, 'rb',
+                                 profile=True) as samfile:
+            n = len(list(samfile.fetch('chr1', 100, 1000,
+                                       multiple_iterators=True)))
+            self.assertEqual(samfile.stats()['records'], n)
+
+    def testWrite(self):
+        fn = "tmp_iostats.bam"
+        n = 0
+        with pysam.AlignmentFile(self.filename, 'rb') as inf:
+            with pysam.AlignmentFile(fn, 'wb', template=inf,
+                                     profile=True) as outf:
+                for read in inf:
+                    outf.write(read)
+                    n += 1
+        stats = outf.stats()
+        self.assertEqual(stats['records'], n)
+        self.assertEqual(stats['bytes_written'], os.path.getsize(fn))
+        self.assertEqual(stats['bytes_read'], 0)
+        os.unlink(fn)
+
+    def testNotProfiled(self):
+        with pysam.AlignmentFile(self.filename, 'rb') as samfile:
+            self.assertRaises(ValueError, samfile.stats)
+
+    def testProfiler(self):
+        with pysam.IOProfiler() as profiler:
+            with pysam.AlignmentFile(self.filename, 'rb') as samfile:
+                n = len(list(samfile))
+            with pysam.FastaFile(
+                    os.path.join(DATADIR, 'ex1.fa')) as fastafile:
+                fastafile.fetch('chr1', 0, 100)
+        with pysam.AlignmentFile(self.filename, 'rb') as samfile:
+            self.assertRaises(ValueError, samfile.stats)
+            list(samfile)
+        stats = profiler.stats()
+        self.assertEqual(stats['records'], n + 1)
+        self.assertTrue(stats['bytes_read'] >=
+                        os.path.getsize(self.filename) +
+                        fastafile.stats()['bytes_read'])
+
+
 class TestRemoteFileFTP(unittest.TestCase):
 
     '''test remote access.
@@ -2474,6 +2559,174 @@ class TestExplicitIndex(unittest.TestCase):
         samfile.fetch("chr1")
 
 
+class TestWriteIndex(unittest.TestCase):
+
+    filename = "ex1.bam"
+
+    def setUp(self):
+        self.tmpfilename = "tmp_%i.bam" % id(self)
+        self.tmpindex = self.tmpfilename + ".bai"
+
+    def tearDown(self):
+        for fn in (self.tmpfilename, self.tmpindex,
+                   self.tmpfilename + ".other.bai"):
+            if os.path.exists(fn):
+                os.unlink(fn)
+
+    def write(self, **kwargs):
+        with pysam.AlignmentFile(
+                os.path.join(DATADIR, self.filename)) as inf:
+            with pysam.AlignmentFile(self.tmpfilename, "wb",
+                                     template=inf,
+                                     write_index=True,
+                                     **kwargs) as outf:
+                for read in inf:
+                    outf.write(read)
+
+    def testIndexIsUsable(self):
+        self.write()
+        self.assertTrue(os.path.exists(self.tmpindex))
+        with pysam.AlignmentFile(
+                os.path.join(DATADIR, self.filename)) as ref:
+            with pysam.AlignmentFile(self.tmpfilename) as inf:
+                self.assertEqual(inf.mapped, ref.mapped)
+                self.assertEqual(inf.unmapped, ref.unmapped)
+                for contig in ref.references:
+                    self.assertEqual(inf.count(contig, 100, 1000),
+                                     ref.count(contig, 100, 1000))
+
+    def testExplicitIndexFilename(self):
+        self.write(filepath_index=self.tmpfilename + ".other.bai")
+        self.assertFalse(os.path.exists(self.tmpindex))
+        with pysam.AlignmentFile(
+                os.path.join(DATADIR, self.filename)) as ref:
+            with pysam.AlignmentFile(
+                    self.tmpfilename,
+                    filepath_index=self.tmpfilename + ".other.bai") as inf:
+                self.assertEqual(len(list(inf.fetch("chr1"))),
+                                 len(list(ref.fetch("chr1"))))
+
+    def testUnsortedRaisesError(self):
+        with pysam.AlignmentFile(
+                os.path.join(DATADIR, self.filename)) as inf:
+            reads = list(inf)
+        outf = pysam.AlignmentFile(self.tmpfilename, "wb",
+                                   template=inf,
+                                   write_index=True)
+        later = [x for x in reads
+                 if x.reference_id == reads[0].reference_id and
+                 x.reference_start > reads[0].reference_start][0]
+        outf.write(later)
+        self.assertRaises(ValueError, outf.write, reads[0])
+        outf.close()
+        self.assertFalse(os.path.exists(self.tmpindex))
+
+    def testSAMRaisesError(self):
+        with pysam.AlignmentFile(
+                os.path.join(DATADIR, self.filename)) as inf:
+            self.assertRaises(ValueError, pysam.AlignmentFile,
+                              self.tmpfilename, "wh",
+                              template=inf,
+                              write_index=True)
+
+
+class TestMarkDuplicates(unittest.TestCase):
+
+    filename = "ex1.bam"
+
+    def setUp(self):
+        self.tmpfilename = "tmp_%i.bam" % id(self)
+        with pysam.AlignmentFile(
+                os.path.join(DATADIR, self.filename)) as inf:
+            self.header = inf.header
+            self.reads = list(inf.fetch(until_eof=True))
+
+    def tearDown(self):
+        if os.path.exists(self.tmpfilename):
+            os.unlink(self.tmpfilename)
+
+    def mark(self, reads, **kwargs):
+        with pysam.AlignmentFile(self.tmpfilename, "wb",
+                                 header=self.header) as outf:
+            counts = pysam.mark_duplicates(reads, outf, **kwargs)
+        with pysam.AlignmentFile(self.tmpfilename) as inf:
+            return counts, list(inf.fetch(until_eof=True))
+
+    def build_copies(self):
+        '''add a low quality copy after each mapped read.'''
+        reads = []
+        for read in self.reads:
+            reads.append(read)
+            if read.is_unmapped:
+                continue
+            copy = pysam.AlignedSegment.from_bytes(read.to_bytes())
+            copy.query_name = read.query_name + "_copy"
+            copy.query_qualities = array.array(
+                "B", [2] * read.query_length)
+            reads.append(copy)
+        return reads
+
+    def testOrderIsKept(self):
+        counts, output = self.mark(self.reads)
+        self.assertEqual(counts["reads"], len(self.reads))
+        self.assertEqual([x.query_name for x in output],
+                         [x.query_name for x in self.reads])
+        self.assertEqual(counts["duplicates"],
+                         len([x for x in output if x.is_duplicate]))
+
+    def testCopiesAreDuplicates(self):
+        reads = self.build_copies()
+        counts, output = self.mark(reads)
+        self.assertEqual(len(output), len(reads))
+        copies = [x for x in output if x.query_name.endswith("_copy")]
+        self.assertTrue(len(copies) > 0)
+        self.assertTrue(all([x.is_duplicate for x in copies]))
+        self.assertTrue(counts["pairs"] > 0)
+
+    def testRemoveDuplicates(self):
+        reads = self.build_copies()
+        counts, output = self.mark(reads, remove_duplicates=True)
+        self.assertEqual(len(output), len(reads) - counts["duplicates"])
+        self.assertFalse(any([x.is_duplicate for x in output]))
+        self.assertFalse(any([x.query_name.endswith("_copy")
+                              for x in output]))
+
+    def testLibrariesAreSeparate(self):
+        counts, output = self.mark(self.reads)
+        nduplicates = counts["duplicates"]
+
+        self.header = dict(self.header)
+        self.header["RG"] = [{"ID": "rg1", "SM": "sample", "LB": "lib1"},
+                             {"ID": "rg2", "SM": "sample", "LB": "lib2"},
+                             {"ID": "rg3", "SM": "sample", "LB": "lib1"}]
+        reads = self.build_copies()
+        for read in reads:
+            if read.query_name.endswith("_copy"):
+                read.set_tag("RG", "rg2")
+            else:
+                read.set_tag("RG", "rg1")
+        # copies are only marked against each other
+        counts, output = self.mark(reads)
+        self.assertEqual(counts["duplicates"], 2 * nduplicates)
+        self.assertEqual(len([x for x in output if x.is_duplicate and
+                              x.query_name.endswith("_copy")]),
+                         nduplicates)
+
+        # read groups of the same library are marked together
+        for read in reads:
+            if read.query_name.endswith("_copy"):
+                read.set_tag("RG", "rg3")
+        counts, output = self.mark(reads)
+        self.assertTrue(all([x.is_duplicate for x in output
+                             if x.query_name.endswith("_copy")]))
+
+    def testInvalidDistanceRaisesError(self):
+        with pysam.AlignmentFile(self.tmpfilename, "wb",
+                                 header=self.header) as outf:
+            self.assertRaises(ValueError, pysam.mark_duplicates,
+                              self.reads, outf, max_distance=0)
+
+
 class TestVerbosity(unittest.TestCase):
 
     '''test if setting/getting of verbosity works.'''
@@ -413,6 +413,220 @@ class TestConstructionVCFGZWithoutContigs(TestConstructionVCFWithContigs):
     filename = "example_vcf42.vcf.gz"
 
 
+class TestWriteIndex(unittest.TestCase):
+
+    filename = "example_vcf42_withcontigs.vcf.gz"
+
+    def testBCF(self):
+        fn_out = get_temp_filename(suffix=".bcf")
+        with pysam.VariantFile(os.path.join(DATADIR, self.filename)) as inf:
+            with pysam.VariantFile(fn_out, "wb", header=inf.header,
+                                   write_index=True) as outf:
+                for record in inf:
+                    outf.write(record)
+
+        self.assertTrue(os.path.exists(fn_out + ".csi"))
+        with pysam.VariantFile(fn_out) as inf:
+            self.assertEqual(len(list(inf.fetch("20"))), 3)
+
+        os.unlink(fn_out)
+        os.unlink(fn_out + ".csi")
+
+    def testVCFRaisesError(self):
+        fn_out = get_temp_filename(suffix=".vcf")
+        with pysam.VariantFile(os.path.join(DATADIR, self.filename)) as inf:
+            self.assertRaises(ValueError, pysam.VariantFile,
+                              fn_out, "w", header=inf.header,
+                              write_index=True)
+        os.unlink(fn_out)
+
+
+class TestSubsetSamplesVCF(unittest.TestCase):
+    """reading a subset of samples must yield the same values as
+    dropping the remaining sample columns after reading."""
+
+    filename = "example_vcf42_withcontigs.vcf.gz"
+    samples = ["NA00001", "NA00003"]
+
+    def setUp(self):
+        self.fn = os.path.join(DATADIR, self.filename)
+        self.fn_tmp = None
+
+    def tearDown(self):
+        if self.fn_tmp is not None:
+            os.unlink(self.fn_tmp)
+            os.unlink(self.fn_tmp + ".csi")
+
+    def get_expected(self, records):
+        result = []
+        for line in records:
+            fields = line.rstrip("\n").split("\t")
+            result.append("\t".join(fields[:9] + [fields[9], fields[11]]))
+        return result
+
+    def read(self, fetch):
+        with pysam.VariantFile(self.fn) as inf:
+            inf.subset_samples(self.samples)
+            self.assertEqual(list(inf.header.samples), self.samples)
+            if fetch:
+                records = inf.fetch("20")
+            else:
+                records = inf
+            return [str(x).rstrip("\n") for x in records]
+
+    def testIteration(self):
+        with pysam.VariantFile(self.fn) as inf:
+            expected = self.get_expected([str(x) for x in inf])
+        self.assertEqual(self.read(fetch=False), expected)
+
+    def testFetch(self):
+        with pysam.VariantFile(self.fn) as inf:
+            expected = self.get_expected([str(x) for x in inf.fetch("20")])
+        self.assertEqual(self.read(fetch=True), expected)
+
+    def testSampleValues(self):
+        with pysam.VariantFile(self.fn) as inf:
+            inf.subset_samples(self.samples)
+            record = next(inf)
+            self.assertEqual(len(record.samples), 2)
+            self.assertEqual(record.samples["NA00003"]["DP"], 2)
+            self.assertRaises(KeyError, record.samples.__getitem__, "NA00002")
+
+    def testDropAllSamples(self):
+        with pysam.VariantFile(self.fn) as inf:
+            inf.subset_samples([])
+            records = list(inf)
+        self.assertEqual(len(records), 5)
+        self.assertEqual(len(records[0].samples), 0)
+
+
+class TestSubsetSamplesBCF(TestSubsetSamplesVCF):
+
+    def setUp(self):
+        self.fn = self.fn_tmp = get_temp_filename(suffix=".bcf")
+        with pysam.VariantFile(os.path.join(DATADIR, self.filename)) as inf:
+            with pysam.VariantFile(self.fn, "wb", header=inf.header,
+                                   write_index=True) as outf:
+                for record in inf:
+                    outf.write(record)
+
+
+class TestBlockCache(unittest.TestCase):
+
+    filename = "example_vcf42.vcf.gz"
+
+    def testFetch(self):
+        fn = os.path.join(DATADIR, self.filename)
+        with pysam.VariantFile(fn) as inf:
+            expected = [str(r) for r in inf.fetch("20")]
+
+        with pysam.VariantFile(fn, cache_size=1 << 22) as inf:
+            for x in range(3):
+                self.assertEqual([str(r) for r in inf.fetch("20")],
+                                 expected)
+            stats = inf.get_cache_statistics()
+
+        self.assertEqual(stats["cache_size"], 1 << 22)
+        self.assertEqual(sorted(stats), ["blocks", "cache_size"])
+        self.assertTrue(stats["blocks"] > 0)
+
+
+class TestIOStats(unittest.TestCase):
+
+    filename = "example_vcf42.vcf.gz"
+
+    def testRead(self):
+        fn = os.path.join(DATADIR, self.filename)
+        with pysam.VariantFile(fn, profile=True) as inf:
+            n = len(list(inf))
+            nregion = len(list(inf.fetch("20")))
+        stats = inf.stats()
+        self.assertEqual(stats["records"], n + nregion)
+        self.assertEqual(stats["wrappers"], n + nregion)
+        self.assertTrue(stats["bytes_read"] >= os.path.getsize(fn))
+        self.assertTrue(stats["blocks"] > 0)
+
+    def testNotProfiled(self):
+        with pysam.VariantFile(os.path.join(DATADIR, self.filename)) as inf:
+            self.assertRaises(ValueError, inf.stats)
+
+
+class TestConcatBCF(unittest.TestCase):
+    """concatenate chunks of a file and compare to the original."""
+
+    filename = "example_vcf42_withcontigs.vcf.gz"
+    mode = "wb"
+    suffix = ".bcf"
+    index_suffix = ".csi"
+
+    def setUp(self):
+        self.vcf_in = pysam.VariantFile(os.path.join(DATADIR, self.filename))
+        records = list(self.vcf_in)
+        self.records = [str(x) for x in records]
+        self.chunks = []
+        for start in range(0, len(records), 2):
+            fn = get_temp_filename(suffix=self.suffix)
+            with pysam.VariantFile(fn, self.mode,
+                                   header=self.vcf_in.header) as outf:
+                for record in records[start:start + 2]:
+                    outf.write(record)
+            self.chunks.append(self.write_chunk(fn))
+        self.fn_out = get_temp_filename(suffix=self.suffix)
+        os.unlink(self.fn_out)
+
+    def write_chunk(self, fn):
+        return fn
+
+    def tearDown(self):
+        for fn in self.chunks + [self.fn_out, self.fn_out + self.index_suffix]:
+            if os.path.exists(fn):
+                os.unlink(fn)
+
+    def check(self, naive):
+        pysam.bcf_concat(self.chunks, self.fn_out, naive=naive)
+        self.assertTrue(os.path.exists(self.fn_out + self.index_suffix))
+        with pysam.VariantFile(self.fn_out) as inf:
+            self.assertEqual([str(x) for x in inf], self.records)
+            self.assertEqual(len(list(inf.fetch("20"))), 3)
+
+    def testNaive(self):
+        self.check(naive=True)
+
+    def testRecords(self):
+        self.check(naive=False)
+
+    def testDifferentHeadersNaive(self):
+        header = self.vcf_in.header.copy()
+        header.add_meta("source", "pysam")
+        fn = get_temp_filename(suffix=self.suffix)
+        with pysam.VariantFile(fn, self.mode, header=header):
+            pass
+        self.chunks.append(self.write_chunk(fn))
+        with self.assertRaises(ValueError) as cm:
+            pysam.bcf_concat(self.chunks, self.fn_out, naive=True)
+        self.assertTrue("`{}`".format(fn) in str(cm.exception))
+        # no partial output is left behind
+        self.assertFalse(os.path.exists(self.fn_out))
+        # records are re-encoded against the merged header
+        pysam.bcf_concat(self.chunks, self.fn_out, naive=False)
+        with pysam.VariantFile(self.fn_out) as inf:
+            self.assertEqual(len(list(inf)), len(self.records))
+
+
+class TestConcatVCFGZ(TestConcatBCF):
+
+    mode = "w"
+    suffix = ".vcf.gz"
+    index_suffix = ".tbi"
+
+    def write_chunk(self, fn):
+        # VariantFile writes uncompressed VCF
+        os.rename(fn, fn[:-len(".gz")])
+        pysam.tabix_compress(fn[:-len(".gz")], fn, force=True)
+        os.unlink(fn[:-len(".gz")])
+        return fn
+
+
 
 if __name__ == "__main__":
     unittest.main()
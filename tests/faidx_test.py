@@ -52,6 +52,18 @@ class TestFastaFile(unittest.TestCase):
         self.assertEqual(1575, self.file.get_reference_length("chr1"))
         self.assertEqual(1584, self.file.get_reference_length("chr2"))
 
+    def testStats(self):
+        self.assertRaises(ValueError, self.file.stats)
+        with pysam.FastaFile(os.path.join(DATADIR, "ex1.fa"),
+                             profile=True) as inf:
+            for contig in self.sequences:
+                inf.fetch(contig)
+        stats = inf.stats()
+        self.assertEqual(stats["records"], len(self.sequences))
+        self.assertEqual(stats["wrappers"], len(self.sequences))
+        self.assertTrue(stats["bytes_read"] >=
+                        os.path.getsize(os.path.join(DATADIR, "ex1.fa")))
+
     def tearDown(self):
         self.file.close()
 
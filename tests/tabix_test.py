@@ -14,6 +14,7 @@ import unittest
 import glob
 import re
 import copy
+import random
 from TestUtils import checkURL
 
 DATADIR = 'tabix_data'
@@ -140,6 +141,41 @@ class TestCompression(unittest.TestCase):
         checkBinaryEqual(self.tmpfilename + ".gz", self.filename)
         checkBinaryEqual(self.tmpfilename + ".gz.tbi", self.filename_idx)
 
+    def testCompressionThreads(self):
+        pysam.tabix_compress(self.tmpfilename, self.tmpfilename + ".gz",
+                             threads=2)
+        checkBinaryEqual(self.tmpfilename, self.tmpfilename + ".gz")
+
+    def testCompressionAndIndex(self):
+        '''index built while compressing is the same as when
+        indexing afterwards.'''
+        pysam.tabix_compress(self.tmpfilename, self.tmpfilename + ".gz",
+                             index=True, preset=self.preset)
+        reference = self.tmpfilename + ".ref.gz"
+        pysam.tabix_compress(self.tmpfilename, reference)
+        pysam.tabix_index(reference, preset=self.preset)
+        try:
+            self.assertTrue(checkBinaryEqual(self.tmpfilename + ".gz",
+                                             reference))
+            self.assertTrue(checkBinaryEqual(self.tmpfilename + ".gz.tbi",
+                                             reference + ".tbi"))
+        finally:
+            os.unlink(reference)
+            os.unlink(reference + ".tbi")
+
+    def testCompressionAndIndexThreads(self):
+        self.assertRaises(ValueError, pysam.tabix_compress,
+                          self.tmpfilename, self.tmpfilename + ".gz",
+                          threads=2, index=True, preset=self.preset)
+        pysam.tabix_index(self.tmpfilename, threads=2, preset=self.preset)
+        self.assertFalse(os.path.exists(self.tmpfilename))
+        with pysam.TabixFile(self.tmpfilename + ".gz") as inf, \
+             pysam.TabixFile(self.filename) as ref:
+            self.assertEqual(inf.contigs, ref.contigs)
+            for contig in ref.contigs:
+                self.assertEqual(list(inf.fetch(contig)),
+                                 list(ref.fetch(contig)))
+
     def tearDown(self):
 
         try:
@@ -168,6 +204,363 @@ class TestCompressionVCF(TestCompression):
     preset = "vcf"
 
 
+class TestFetchMany(unittest.TestCase):
+
+    filename = os.path.join(DATADIR, "example.gtf.gz")
+
+    queries = [("chr1", 1000, 5000),
+               ("chr2", 0, 100000),
+               ("chr1", 0, 100000),
+               ("chrUnknown", 1, 2),
+               ("chr1", 20000, 20000),
+               ("chr1", 3000, 3001)]
+
+    def setUp(self):
+        self.tabix = pysam.TabixFile(self.filename)
+
+    def tearDown(self):
+        self.tabix.close()
+
+    def get_expected(self, parser=None):
+        result = []
+        for x, (contig, start, end) in enumerate(self.queries):
+            if contig == "chrUnknown" or start == end:
+                continue
+            result.extend([(x, str(r)) for r in
+                           self.tabix.fetch(contig, start, end,
+                                            parser=parser)])
+        return sorted(result)
+
+    def fetch_many(self, parser=None, **kwargs):
+        contigs, starts, ends = zip(*self.queries)
+        return sorted([(x, str(r)) for x, r in
+                       self.tabix.fetch_many(contigs, starts, ends,
+                                             parser=parser, **kwargs)])
+
+    def testUnparsed(self):
+        self.assertEqual(self.fetch_many(), self.get_expected())
+
+    def testParsed(self):
+        self.assertEqual(self.fetch_many(parser=pysam.asGTF()),
+                         self.get_expected(parser=pysam.asGTF()))
+
+    def testMultipleIterators(self):
+        self.assertEqual(self.fetch_many(multiple_iterators=True),
+                         self.get_expected())
+
+    def testMismatchedLengths(self):
+        self.assertRaises(ValueError, self.tabix.fetch_many,
+                          ["chr1"], [0, 1], [10])
+
+    def testCorruptFileRaisesError(self):
+        tmpfilename = "tmp_%i.gtf.gz" % id(self)
+        shutil.copyfile(self.filename + ".tbi", tmpfilename + ".tbi")
+        with open(self.filename, "rb") as inf:
+            data = bytearray(inf.read())
+        # damage the compressed data after the block header
+        for x in range(200, 260):
+            data[x] ^= 0xff
+        with open(tmpfilename, "wb") as outf:
+            outf.write(data)
+        try:
+            with pysam.TabixFile(tmpfilename) as tabix:
+                self.assertRaises(IOError, list,
+                                  tabix.fetch_many(["chr1"], [0], [100000]))
+        finally:
+            os.unlink(tmpfilename)
+            os.unlink(tmpfilename + ".tbi")
+
+
+class TestIterationWithoutPersistence(unittest.TestCase):
+
+    filename = os.path.join(DATADIR, "example.gtf.gz")
+
+    def setUp(self):
+        self.tabix = pysam.TabixFile(self.filename)
+
+    def tearDown(self):
+        self.tabix.close()
+
+    def check(self, parser):
+        expected = [str(r) for r in
+                    self.tabix.fetch("chr1", parser=parser)]
+        rows = []
+        for r in self.tabix.fetch("chr1", parser=parser, persist=False):
+            self.assertEqual(str(r), expected[len(rows)])
+            rows.append(r)
+        self.assertEqual(len(rows), len(expected))
+        # the same row object is returned throughout
+        self.assertTrue(all(r is rows[0] for r in rows))
+
+    def testTuple(self):
+        self.check(pysam.asTuple())
+
+    def testGTF(self):
+        self.check(pysam.asGTF())
+
+    def testCopy(self):
+        expected = [str(r) for r in
+                    self.tabix.fetch("chr1", parser=pysam.asGTF())]
+        kept = [copy.copy(r) for r in
+                self.tabix.fetch("chr1", parser=pysam.asGTF(),
+                                 persist=False)]
+        self.assertEqual([str(r) for r in kept], expected)
+
+    def testModifiedRow(self):
+        for r in self.tabix.fetch("chr1", parser=pysam.asGTF(),
+                                  persist=False):
+            self.assertNotEqual(r.contig, "chrX")
+            r.contig = "chrX"
+
+
+class TestMap(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpfilename = "tmp_%i.bed" % id(self)
+        with open(self.tmpfilename, "w") as outf:
+            for contig in ("chr1", "chr2"):
+                for x in range(0, 2000000, 100):
+                    outf.write("%s\t%i\t%i\tname%i\n" %
+                               (contig, x, x + 150, x))
+        self.tmpfilename = pysam.tabix_index(self.tmpfilename,
+                                             preset="bed")
+        self.tabix = pysam.TabixFile(self.tmpfilename)
+
+    def tearDown(self):
+        self.tabix.close()
+        os.unlink(self.tmpfilename)
+        os.unlink(self.tmpfilename + ".tbi")
+
+    def testMap(self):
+        expected = [str(r) for r in self.tabix.fetch("chr1")] + \
+            [str(r) for r in self.tabix.fetch("chr2")]
+        for workers in (1, 3):
+            results = self.tabix.map(
+                lambda contig, start, end, rows:
+                (contig, start, end, [str(r) for r in rows]),
+                workers=workers)
+            self.assertTrue(len(results) > 2)
+            self.assertEqual([r for x in results for r in x[3]],
+                             expected)
+            self.assertEqual(results[0][:2], ("chr1", 0))
+            # shards are adjacent
+            for a, b in zip(results[:-1], results[1:]):
+                if a[0] == b[0]:
+                    self.assertEqual(a[2], b[1])
+
+    def testRegions(self):
+        regions = [("chr2", 100050, 1500000), "chr1", ("chr2", 0, 200)]
+        results = self.tabix.map(
+            lambda contig, start, end, rows: [r.name for r in rows],
+            regions=regions,
+            parser=pysam.asBed(),
+            workers=2,
+            shards=20)
+        expected = [r.name for r in
+                    self.tabix.fetch("chr2", 100050, 1500000,
+                                     parser=pysam.asBed())] + \
+            [r.name for r in self.tabix.fetch("chr1",
+                                              parser=pysam.asBed())] + \
+            ["name0", "name100"]
+        self.assertEqual([r for x in results for r in x], expected)
+
+    def testWorkerProcesses(self):
+        pids = self.tabix.map(lambda *args: os.getpid(),
+                              workers=2, shards=8)
+        self.assertTrue(len(pids) > 2)
+        self.assertFalse(os.getpid() in pids)
+        self.assertEqual(self.tabix.map(lambda *args: os.getpid(),
+                                        shards=8),
+                         [os.getpid()] * len(pids))
+
+    def testErrors(self):
+        self.assertRaises(ZeroDivisionError, self.tabix.map,
+                          lambda *args: 1 / 0, workers=2)
+        self.assertRaises(ValueError, self.tabix.map,
+                          lambda *args: None, workers=0)
+        self.assertRaises(ValueError, self.tabix.map,
+                          lambda *args: None, regions=[("chr1", 10, 5)])
+
+
+class TestToArrays(unittest.TestCase):
+
+    filename = os.path.join(DATADIR, "example.gtf.gz")
+
+    def setUp(self):
+        self.tabix = pysam.TabixFile(self.filename)
+
+    def tearDown(self):
+        self.tabix.close()
+
+    def testDefaultColumns(self):
+        contigs, starts, ends = self.tabix.to_arrays("chr1", 1000, 50000)
+        rows = list(self.tabix.fetch("chr1", 1000, 50000,
+                                     parser=pysam.asTuple()))
+        codes, values = contigs
+        self.assertEqual([values[x] for x in codes],
+                         [r[0] for r in rows])
+        self.assertEqual(list(starts), [int(r[3]) for r in rows])
+        self.assertEqual(list(ends), [int(r[4]) for r in rows])
+
+    def testColumns(self):
+        rows = list(self.tabix.fetch("chr2", parser=pysam.asTuple()))
+        features, starts, scores = self.tabix.to_arrays(
+            "chr2", columns=[2, 3, 5], dtypes=["s", "i", "d"])
+        codes, values = features
+        self.assertEqual([values[x] for x in codes],
+                         [r[2] for r in rows])
+        self.assertEqual(sorted(values), sorted(set(r[2] for r in rows)))
+        self.assertEqual(starts.typecode, "i")
+        self.assertEqual(list(starts), [int(r[3]) for r in rows])
+        # missing scores are NaN
+        self.assertTrue(all(x != x for x in scores))
+
+    def testEmptyRegion(self):
+        contigs, starts, ends = self.tabix.to_arrays("chr1", 10, 10)
+        self.assertEqual(len(contigs[0]), 0)
+        self.assertEqual(len(starts), 0)
+
+    def testErrors(self):
+        self.assertRaises(ValueError, self.tabix.to_arrays, "chr1",
+                          columns=[20])
+        self.assertRaises(ValueError, self.tabix.to_arrays, "chr1",
+                          columns=[1], dtypes=["l"])
+        self.assertRaises(ValueError, self.tabix.to_arrays, "chr1",
+                          columns=[1], dtypes=["x"])
+
+
+class TestBlockCache(unittest.TestCase):
+
+    filename = os.path.join(DATADIR, "example.gtf.gz")
+
+    def testFetch(self):
+        with pysam.TabixFile(self.filename) as inf:
+            expected = list(inf.fetch("chr1", 1000, 50000))
+            self.assertEqual(inf.get_cache_statistics()["blocks"], 0)
+
+        with pysam.TabixFile(self.filename, cache_size=1 << 22) as inf:
+            for x in range(3):
+                self.assertEqual(list(inf.fetch("chr1", 1000, 50000)),
+                                 expected)
+            stats = inf.get_cache_statistics()
+
+        self.assertEqual(stats["cache_size"], 1 << 22)
+        self.assertEqual(sorted(stats), ["blocks", "cache_size"])
+        self.assertTrue(stats["blocks"] > 0)
+
+    def testInvalidSize(self):
+        self.assertRaises(ValueError, pysam.TabixFile, self.filename,
+                          cache_size=-1)
+
+
+class TestIOStats(unittest.TestCase):
+
+    filename = os.path.join(DATADIR, "example.gtf.gz")
+
+    def testRead(self):
+        with pysam.TabixFile(self.filename, profile=True) as inf:
+            rows = list(inf.fetch("chr1", 1000, 50000))
+            contigs, starts, ends = inf.to_arrays("chr1")
+        stats = inf.stats()
+        self.assertEqual(stats["records"], len(rows) + len(starts))
+        self.assertEqual(stats["wrappers"], len(rows))
+        self.assertTrue(stats["bytes_read"] > 0)
+        self.assertTrue(stats["uncompressed_bytes"] > 0)
+
+    def testMap(self):
+        with pysam.IOProfiler() as profiler:
+            with pysam.TabixFile(self.filename) as inf:
+                counts = inf.map(lambda contig, start, end, rows:
+                                 len(list(rows)), workers=2)
+        self.assertEqual(inf.stats()["records"], sum(counts))
+        self.assertEqual(profiler.stats(), inf.stats())
+
+    def testNotProfiled(self):
+        with pysam.TabixFile(self.filename) as inf:
+            self.assertRaises(ValueError, inf.stats)
+
+
+class TestIntervalIndex(unittest.TestCase):
+
+    filename = os.path.join(DATADIR, "example.bed.gz")
+
+    def setUp(self):
+        with pysam.TabixFile(self.filename) as inf:
+            self.rows = list(inf.fetch(parser=pysam.asBed()))
+        self.index = pysam.IntervalIndex(self.rows)
+
+    def get_expected(self, contig, positions):
+        qidx, hits = [], []
+        for x, pos in enumerate(positions):
+            found = [(r.start, y) for y, r in enumerate(self.rows)
+                     if r.contig == contig and r.start <= pos < r.end]
+            for start, y in sorted(found):
+                qidx.append(x)
+                hits.append(y)
+        return qidx, hits
+
+    def check(self, contig, positions):
+        qidx, hits = self.index.query(contig, positions)
+        expected_qidx, expected_hits = self.get_expected(contig, positions)
+        self.assertEqual(list(qidx), expected_qidx)
+        self.assertEqual(sorted(zip(qidx, hits)),
+                         sorted(zip(expected_qidx, expected_hits)))
+
+    def testBuild(self):
+        self.assertEqual(len(self.index), len(self.rows))
+        self.assertEqual(sorted(self.index.contigs),
+                         sorted(set(r.contig for r in self.rows)))
+
+    def testQuery(self):
+        for contig in self.index.contigs:
+            self.check(contig, list(range(0, 10000, 7)))
+
+    def testUnsortedPositions(self):
+        self.check("chr1", [5000, 10, 1737, 1736, 2090, 4274, 1873])
+
+    def testUnknownContig(self):
+        qidx, hits = self.index.query("chrUnknown", [1, 2, 3])
+        self.assertEqual(len(qidx), 0)
+        self.assertEqual(len(hits), 0)
+
+    def testAddAfterQuery(self):
+        self.check("chr1", [1800])
+        n = self.index.add("chr1", 1790, 1810)
+        self.assertEqual(n, len(self.rows))
+        qidx, hits = self.index.query("chr1", [1800])
+        self.assertTrue(n in list(hits))
+
+    def testLongIntervals(self):
+        rng = random.Random(1)
+        for n in (1, 2, 3, 7, 8, 9, 100, 257):
+            intervals = [(0, 1000000)]
+            for x in range(n - 1):
+                start = rng.randint(0, 10000)
+                intervals.append((start, start + rng.choice((1, 10, 5000))))
+            index = pysam.IntervalIndex(
+                [("chr1", start, end) for start, end in intervals])
+            positions = [rng.randint(0, 12000) for x in range(200)]
+            qidx, hits = index.query("chr1", positions)
+            expected = []
+            for x, pos in enumerate(positions):
+                expected.extend(
+                    (x, start, y) for y, (start, end) in enumerate(intervals)
+                    if start <= pos < end)
+            self.assertEqual(list(qidx), [x[0] for x in expected])
+            self.assertEqual(
+                sorted(zip(qidx, [intervals[y][0] for y in hits], hits)),
+                sorted(expected))
+            # hits of a position are sorted by start
+            found = [(x, intervals[y][0]) for x, y in zip(qidx, hits)]
+            self.assertEqual(found, sorted(found))
+
+    def testTuples(self):
+        index = pysam.IntervalIndex([("chr1", 10, 20), ("chr1", 15, 30)])
+        qidx, hits = index.query("chr1", [9, 10, 19, 20, 30])
+        self.assertEqual(list(qidx), [1, 2, 2, 3])
+        self.assertEqual(list(hits), [0, 0, 1, 1])
+
+
 class IterationTest(unittest.TestCase):
 
     with_comments = False
@@ -584,6 +977,65 @@ class TestIteratorsFileUncompressed(TestIterators):
     is_compressed = False
 
 
+class TestIteratorsBatch(unittest.TestCase):
+
+    filename = os.path.join(DATADIR, "example.gtf.gz")
+
+    def setUp(self):
+        self.compare = loadAndConvert(self.filename)
+
+    def check(self, **kwargs):
+        with open(self.filename, "rb") as infile:
+            batches = list(pysam.tabix_batch_iterator(
+                infile, pysam.asTuple(), **kwargs))
+        self.assertEqual(self.compare,
+                         [list(r) for batch in batches for r in batch])
+        return batches
+
+    def testIteration(self):
+        batches = self.check(batch_size=10)
+        self.assertEqual([len(b) for b in batches[:-1]],
+                         [10] * (len(batches) - 1))
+
+    def testSmallChunks(self):
+        # lines span several chunks
+        self.check(batch_size=7, chunk_size=13, nchunks=2)
+
+    def testUnparsed(self):
+        with open(self.filename, "rb") as infile:
+            batches = list(pysam.tabix_batch_iterator(
+                infile, None, batch_size=10, chunk_size=100, nchunks=2))
+        rows = []
+        for data, offsets in batches:
+            self.assertEqual(offsets[0], 0)
+            self.assertEqual(offsets[-1], len(data))
+            self.assertTrue(len(offsets) <= 11)
+            rows.extend(data[offsets[x]:offsets[x + 1] - 1]
+                        for x in range(len(offsets) - 1))
+        self.assertEqual(self.compare,
+                         [r.decode("ascii").split("\t") for r in rows])
+
+    def testUncompressedWithoutNewline(self):
+        tmpfilename = "tmp_TestIteratorsBatch"
+        with open(tmpfilename, "w") as outfile:
+            outfile.write("#comment\na\t1\n\nb\t2")
+        with open(tmpfilename) as infile:
+            rows = [list(r) for batch in
+                    pysam.tabix_iterator(infile, pysam.asTuple(),
+                                         batch_size=1)
+                    for r in batch]
+        os.unlink(tmpfilename)
+        self.assertEqual(rows, [["a", "1"], ["b", "2"]])
+
+    def testErrors(self):
+        infile = open(self.filename, "rb")
+        self.assertRaises(ValueError, pysam.tabix_batch_iterator,
+                          infile, pysam.asTuple(), batch_size=0)
+        infile.close()
+        self.assertRaises(ValueError, pysam.tabix_batch_iterator,
+                          infile, pysam.asTuple())
+
+
 class TestGTF(TestParser):
 
     def testRead(self):
@@ -600,6 +1052,55 @@ class TestGTF(TestParser):
             self.assertEqual("\t".join(map(str, c)),
                              str(r))
 
+    def testAttributes(self):
+
+        for x, r in enumerate(self.tabix.fetch(parser=pysam.asGTF())):
+            c = self.compare[x]
+            fields = [f.strip().split(" ", 1)
+                      for f in c[8].split(";") if f.strip()]
+            self.assertEqual(r.keys(), [f[0] for f in fields])
+            d = r.asDict()
+            for key, value in fields:
+                self.assertEqual(getattr(r, key), value.strip('"'))
+                self.assertEqual(str(d[key]), value.strip('"'))
+
+    def testRestrictedAttributes(self):
+
+        parser = pysam.asGTF(attributes=("transcript_id", "gene_id"))
+        for x, r in enumerate(self.tabix.fetch(parser=parser)):
+            c = self.compare[x]
+            self.assertEqual(r.attribute_keys, ("transcript_id", "gene_id"))
+            self.assertTrue(r.gene_id.startswith("ENSG"))
+            self.assertTrue(r.gene_id in c[8])
+            # keys outside the restricted set are still accessible
+            self.assertTrue(r.gene_name in c[8])
+            self.assertEqual(r.keys()[0], "gene_id")
+
+    def testSharedStrings(self):
+
+        # entries of one parser share attribute values
+        seen = {}
+        rows = list(self.tabix.fetch(parser=pysam.asGTF()))
+        for r in rows:
+            value = r.gene_id
+            self.assertTrue(seen.setdefault(value, value) is value)
+        self.assertTrue(len(seen) < len(rows))
+        # but not with entries of another parser
+        r = next(self.tabix.fetch(rows[0].contig, parser=pysam.asGTF()))
+        self.assertFalse(r.gene_id is seen[r.gene_id])
+
+    def testQuotedSemicolon(self):
+
+        r = self.tabix.fetch(parser=pysam.asGTF()).next()
+        r.attributes = 'gene_id "A;B"; exon_number 2; gene_name "C";'
+        self.assertEqual(r.gene_id, "A;B")
+        self.assertEqual(r.exon_number, "2")
+        self.assertEqual(r.gene_name, "C")
+        self.assertEqual(r.asDict(),
+                         {"gene_id": "A;B", "exon_number": 2,
+                          "gene_name": "C"})
+        self.assertRaises(AttributeError, getattr, r, "id")
+
 
 class TestIterationMalformattedGTFFiles(unittest.TestCase):
 
@@ -1043,6 +1544,48 @@ for vcf_file in vcf_files:
     globals()[n] = type(n, (TestVCFFromVCF,), dict(filename=vcf_file,))
 
 
+class TestVCFRecord(TestVCF):
+    """records returned by VCF.fetch() are parsed lazily, but must
+    agree with the dictionaries returned by VCF.parse()."""
+
+    def setUp(self):
+        TestVCF.setUp(self)
+        with open(self.filename) as f:
+            self.compare = list(pysam.VCF().parse(f))
+        self.vcf = pysam.VCF()
+        self.vcf.connect(self.tmpfilename + ".gz")
+
+    def tearDown(self):
+        self.vcf.tabixfile.close()
+        TestVCF.tearDown(self)
+
+    def testFields(self):
+        records = list(self.vcf.fetch())
+        self.assertEqual(len(records), len(self.compare))
+        for r, c in zip(records, self.compare):
+            self.assertEqual(r.contig, c["chrom"])
+            self.assertEqual(r.pos, c["pos"])
+            self.assertEqual(r.id, c["id"])
+            self.assertEqual(r.alt, c["alt"])
+            self.assertEqual(r.qual, c["qual"])
+            self.assertEqual(r.filter, c["filter"])
+            self.assertEqual(r.info, c["info"])
+            self.assertEqual(r.format, c["format"])
+
+    def testSamples(self):
+        samples = self.vcf.getsamples()
+        for r, c in zip(self.vcf.fetch(), self.compare):
+            for sample in samples:
+                self.assertEqual(r[sample], c[sample])
+
+    def testUnknownCharacterInRef(self):
+        vcf = pysam.VCF()
+        fields = ["chr1", "10", ".", "A", "G", "10", "PASS", "."]
+        self.assertEqual(vcf.parse_data("\t".join(fields))["ref"], "A")
+        fields[3] = "A\n"
+        self.assertRaises(ValueError, vcf.parse_data, "\t".join(fields))
+
+
 class TestVCFFromVariantFile(TestVCFFromVCF):
 
     columns = ("chrom", "pos", "id",